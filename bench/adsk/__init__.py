@@ -0,0 +1,16 @@
+"""Minimal stand-in for Fusion 360's ``adsk`` package.
+
+Implements just enough of ``adsk.core`` and ``adsk.fusion`` for
+``mesh_align_plugin`` to be imported and exercised on a machine without
+Fusion (benchmarks, CI). The geometry classes are written in plain Python,
+independently of the NumPy kernel, so they double as a reference
+implementation of the Matrix3D calls the plugin originally relied on.
+"""
+from . import core, fusion
+
+_auto_terminate = True
+
+
+def autoTerminate(value):
+    global _auto_terminate
+    _auto_terminate = bool(value)
@@ -0,0 +1,372 @@
+"""Pure-Python subset of ``adsk.core`` used by the mesh align plugin"""
+import math
+
+
+class Base(object):
+    @classmethod
+    def cast(cls, obj):
+        return obj if isinstance(obj, cls) else None
+
+
+def _ident():
+    return [1.0, 0.0, 0.0, 0.0,
+            0.0, 1.0, 0.0, 0.0,
+            0.0, 0.0, 1.0, 0.0,
+            0.0, 0.0, 0.0, 1.0]
+
+
+def _matmul(a, b):
+    return [sum(a[r * 4 + k] * b[k * 4 + c] for k in range(4)) for r in range(4) for c in range(4)]
+
+
+class Point3D(Base):
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x, self.y, self.z = float(x), float(y), float(z)
+
+    @staticmethod
+    def create(x=0.0, y=0.0, z=0.0):
+        return Point3D(x, y, z)
+
+    def copy(self):
+        return Point3D(self.x, self.y, self.z)
+
+    def asArray(self):
+        return (self.x, self.y, self.z)
+
+    def asVector(self):
+        return Vector3D(self.x, self.y, self.z)
+
+    def distanceTo(self, other):
+        return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2)
+
+    def translateBy(self, vector):
+        self.x += vector.x
+        self.y += vector.y
+        self.z += vector.z
+        return True
+
+    def vectorTo(self, other):
+        return Vector3D(other.x - self.x, other.y - self.y, other.z - self.z)
+
+    def transformBy(self, matrix):
+        m = matrix._m
+        x, y, z = self.x, self.y, self.z
+        self.x = m[0] * x + m[1] * y + m[2] * z + m[3]
+        self.y = m[4] * x + m[5] * y + m[6] * z + m[7]
+        self.z = m[8] * x + m[9] * y + m[10] * z + m[11]
+        return True
+
+    def isEqualTo(self, other):
+        return self.distanceTo(other) <= 1e-10
+
+
+class Vector3D(Base):
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x, self.y, self.z = float(x), float(y), float(z)
+
+    @staticmethod
+    def create(x=0.0, y=0.0, z=0.0):
+        return Vector3D(x, y, z)
+
+    def copy(self):
+        return Vector3D(self.x, self.y, self.z)
+
+    def asArray(self):
+        return (self.x, self.y, self.z)
+
+    def asPoint(self):
+        return Point3D(self.x, self.y, self.z)
+
+    @property
+    def length(self):
+        return math.sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+
+    def normalize(self):
+        length = self.length
+        if length <= 1e-15:
+            return False
+        self.x /= length
+        self.y /= length
+        self.z /= length
+        return True
+
+    def scaleBy(self, scale):
+        self.x *= scale
+        self.y *= scale
+        self.z *= scale
+        return True
+
+    def add(self, other):
+        self.x += other.x
+        self.y += other.y
+        self.z += other.z
+        return True
+
+    def subtract(self, other):
+        self.x -= other.x
+        self.y -= other.y
+        self.z -= other.z
+        return True
+
+    def dotProduct(self, other):
+        return self.x * other.x + self.y * other.y + self.z * other.z
+
+    def crossProduct(self, other):
+        return Vector3D(self.y * other.z - self.z * other.y,
+                        self.z * other.x - self.x * other.z,
+                        self.x * other.y - self.y * other.x)
+
+    def isParallelTo(self, other):
+        return self.crossProduct(other).length <= 1e-10 * max(self.length * other.length, 1e-300)
+
+    def transformBy(self, matrix):
+        m = matrix._m
+        x, y, z = self.x, self.y, self.z
+        self.x = m[0] * x + m[1] * y + m[2] * z
+        self.y = m[4] * x + m[5] * y + m[6] * z
+        self.z = m[8] * x + m[9] * y + m[10] * z
+        return True
+
+
+class Matrix3D(Base):
+    """Row-major 4x4 matrix acting on column vectors, like Fusion's Matrix3D"""
+
+    def __init__(self):
+        self._m = _ident()
+
+    @staticmethod
+    def create():
+        return Matrix3D()
+
+    def copy(self):
+        result = Matrix3D()
+        result._m = list(self._m)
+        return result
+
+    def asArray(self):
+        return tuple(self._m)
+
+    def setWithArray(self, values):
+        values = [float(v) for v in values]
+        if len(values) != 16:
+            return False
+        self._m = values
+        return True
+
+    def setToIdentity(self):
+        self._m = _ident()
+        return True
+
+    def getCell(self, row, column):
+        return self._m[row * 4 + column]
+
+    def setCell(self, row, column, value):
+        self._m[row * 4 + column] = float(value)
+        return True
+
+    @property
+    def translation(self):
+        return Vector3D(self._m[3], self._m[7], self._m[11])
+
+    def transformBy(self, matrix):
+        """this = matrix * this (apply this, then matrix)"""
+        self._m = _matmul(matrix._m, self._m)
+        return True
+
+    def isEqualTo(self, other):
+        return all(abs(a - b) <= 1e-10 for a, b in zip(self._m, other._m))
+
+    def invert(self):
+        # Rigid transforms only: inverse rotation is the transpose
+        m = self._m
+        r = [[m[0], m[4], m[8]], [m[1], m[5], m[9]], [m[2], m[6], m[10]]]
+        t = [m[3], m[7], m[11]]
+        result = _ident()
+        for i in range(3):
+            for j in range(3):
+                result[i * 4 + j] = r[i][j]
+            result[i * 4 + 3] = -sum(r[i][k] * t[k] for k in range(3))
+        self._m = result
+        return True
+
+    def setToAlignCoordinateSystems(self, fromOrigin, fromXAxis, fromYAxis, fromZAxis,
+                                    toOrigin, toXAxis, toYAxis, toZAxis):
+        src = [fromXAxis, fromYAxis, fromZAxis]
+        tgt = [toXAxis, toYAxis, toZAxis]
+        # R = T * S^T with the axes as matrix columns
+        rot = [[sum(getattr(tgt[k], 'xyz'[i]) * getattr(src[k], 'xyz'[j]) for k in range(3))
+                for j in range(3)] for i in range(3)]
+        f = (fromOrigin.x, fromOrigin.y, fromOrigin.z)
+        t = (toOrigin.x, toOrigin.y, toOrigin.z)
+        m = _ident()
+        for i in range(3):
+            for j in range(3):
+                m[i * 4 + j] = rot[i][j]
+            m[i * 4 + 3] = t[i] - sum(rot[i][k] * f[k] for k in range(3))
+        self._m = m
+        return True
+
+    def setToRotation(self, angle, axis, origin):
+        a = axis.copy()
+        a.normalize()
+        c, s = math.cos(angle), math.sin(angle)
+        x, y, z = a.x, a.y, a.z
+        rot = [[c + x * x * (1 - c), x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+               [y * x * (1 - c) + z * s, c + y * y * (1 - c), y * z * (1 - c) - x * s],
+               [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, c + z * z * (1 - c)]]
+        o = (origin.x, origin.y, origin.z)
+        m = _ident()
+        for i in range(3):
+            for j in range(3):
+                m[i * 4 + j] = rot[i][j]
+            m[i * 4 + 3] = o[i] - sum(rot[i][k] * o[k] for k in range(3))
+        self._m = m
+        return True
+
+
+class Plane(Base):
+    def __init__(self, origin, normal):
+        self.origin = origin.copy()
+        self.normal = normal.copy()
+        self.normal.normalize()
+        # Any in-plane direction will do until setUVDirections is called
+        helper = Vector3D(1, 0, 0) if abs(self.normal.x) < 0.9 else Vector3D(0, 1, 0)
+        self.uDirection = self.normal.crossProduct(helper)
+        self.uDirection.normalize()
+        self.vDirection = self.normal.crossProduct(self.uDirection)
+
+    @staticmethod
+    def create(origin, normal):
+        return Plane(origin, normal)
+
+    @staticmethod
+    def createUsingDirections(origin, uDirection, vDirection):
+        plane = Plane(origin, uDirection.crossProduct(vDirection))
+        plane.setUVDirections(uDirection, vDirection)
+        return plane
+
+    def setUVDirections(self, uDirection, vDirection):
+        self.uDirection = uDirection.copy()
+        self.vDirection = vDirection.copy()
+        self.uDirection.normalize()
+        self.vDirection.normalize()
+        return True
+
+    def copy(self):
+        plane = Plane(self.origin, self.normal)
+        plane.setUVDirections(self.uDirection, self.vDirection)
+        return plane
+
+
+class ObjectCollection(Base):
+    def __init__(self):
+        self._items = []
+
+    @staticmethod
+    def create():
+        return ObjectCollection()
+
+    def add(self, item):
+        self._items.append(item)
+        return True
+
+    @property
+    def count(self):
+        return len(self._items)
+
+    def item(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+class Color(Base):
+    def __init__(self, red, green, blue, opacity):
+        self.red, self.green, self.blue, self.opacity = red, green, blue, opacity
+
+    @staticmethod
+    def create(red, green, blue, opacity):
+        return Color(red, green, blue, opacity)
+
+
+class ValueInput(Base):
+    def __init__(self, value):
+        self.value = value
+
+    @staticmethod
+    def createByString(text):
+        return ValueInput(text)
+
+    @staticmethod
+    def createByReal(value):
+        return ValueInput(value)
+
+
+class DropDownStyles(object):
+    LabeledIconDropDownStyle = 0
+    CheckBoxDropDownStyle = 1
+    TextListDropDownStyle = 2
+
+
+class UserInterface(Base):
+    """Records message boxes instead of showing them"""
+
+    def __init__(self):
+        self.messages = []
+
+    def messageBox(self, text, title='', *args):
+        self.messages.append(text)
+        return 0
+
+
+class Application(Base):
+    _instance = None
+
+    def __init__(self):
+        self.userInterface = UserInterface()
+        self.activeProduct = None
+
+    @staticmethod
+    def get():
+        if Application._instance is None:
+            Application._instance = Application()
+        return Application._instance
+
+
+# Event handler bases and argument types; only their names matter headlessly
+class EventHandler(Base):
+    def __init__(self):
+        pass
+
+
+class CommandCreatedEventHandler(EventHandler):
+    pass
+
+
+class CommandEventHandler(EventHandler):
+    pass
+
+
+class InputChangedEventHandler(EventHandler):
+    pass
+
+
+class CustomEventHandler(EventHandler):
+    pass
+
+
+class CommandCreatedEventArgs(Base):
+    pass
+
+
+class CommandEventArgs(Base):
+    pass
+
+
+class InputChangedEventArgs(Base):
+    pass
+
+
+class CustomEventArgs(Base):
+    pass
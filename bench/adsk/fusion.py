@@ -0,0 +1,250 @@
+"""Pure-Python subset of ``adsk.fusion`` used by the mesh align plugin
+
+Besides the class names the plugin casts to, this provides small concrete
+fakes (Component, MeshBody, ConstructionPlane, ...) that record what the
+plugin does to them, so perform_alignment can run end to end.
+"""
+import itertools
+
+from . import core
+
+_tokens = itertools.count(1)
+
+
+class Design(core.Base):
+    pass
+
+
+class DesignTypes(object):
+    DirectDesignType = 0
+    ParametricDesignType = 1
+
+
+class TriangleMeshQualityOptions(object):
+    LowQualityTriangleMesh = 8
+    NormalQualityTriangleMesh = 11
+    HighQualityTriangleMesh = 13
+    VeryHighQualityTriangleMesh = 15
+
+
+class BoundingBox3D(core.Base):
+    def __init__(self, minPoint, maxPoint):
+        self.minPoint = minPoint
+        self.maxPoint = maxPoint
+
+
+class TriangleMesh(core.Base):
+    def __init__(self, coordinates, indices):
+        self.nodeCoordinatesAsDouble = list(coordinates)
+        self.nodeCoordinatesAsFloat = list(coordinates)
+        self.nodeIndices = list(indices)
+
+    @property
+    def nodeCount(self):
+        return len(self.nodeCoordinatesAsDouble) // 3
+
+    @property
+    def triangleCount(self):
+        return len(self.nodeIndices) // 3
+
+
+class MoveFeature(core.Base):
+    def __init__(self, entities, transform):
+        self.inputEntities = entities
+        self.transform = transform
+        # The base feature in edit when the move was added, if any
+        self.baseFeature = BaseFeature.editing
+
+
+class BaseFeature(core.Base):
+    """Records its edit session; moves added meanwhile point back to it"""
+
+    # Fusion has at most one base feature in edit at a time
+    editing = None
+
+    def __init__(self):
+        self.edits = 0
+
+    def startEdit(self):
+        if BaseFeature.editing is not None:
+            raise RuntimeError('Another base feature is in edit')
+        BaseFeature.editing = self
+        return True
+
+    def finishEdit(self):
+        if BaseFeature.editing is not self:
+            raise RuntimeError('This base feature is not in edit')
+        BaseFeature.editing = None
+        self.edits += 1
+        return True
+
+
+class BaseFeatures(core.Base):
+    def __init__(self):
+        self.items = []
+
+    def add(self):
+        feature = BaseFeature()
+        self.items.append(feature)
+        return feature
+
+
+class MoveFeatureInput(core.Base):
+    def __init__(self, entities, transform):
+        self.inputEntities = entities
+        self.transform = transform
+
+
+class MoveFeatures(core.Base):
+    """Applies moves directly to the fake bodies and keeps a timeline list
+
+    Like Fusion, a move inside a base feature edit only takes bodies that
+    base feature owns.
+    """
+
+    def __init__(self):
+        self.timeline = []
+
+    def createInput(self, inputEntities, transform):
+        return MoveFeatureInput(inputEntities, transform)
+
+    def add(self, input):
+        if BaseFeature.editing is not None and any(
+                body.baseFeature is not BaseFeature.editing for body in input.inputEntities):
+            raise RuntimeError('The base feature in edit does not own every body')
+        feature = MoveFeature(input.inputEntities, input.transform.copy())
+        for body in input.inputEntities:
+            body._move(input.transform)
+        self.timeline.append(feature)
+        return feature
+
+
+class Features(core.Base):
+    def __init__(self):
+        self.moveFeatures = MoveFeatures()
+        self.baseFeatures = BaseFeatures()
+
+
+class Component(core.Base):
+    def __init__(self, name='Component'):
+        self.name = name
+        self.id = 'component-{}'.format(next(_tokens))
+        self.features = Features()
+        self.meshBodies = _Collection()
+        self.bRepBodies = _Collection()
+        self.constructionPlanes = ConstructionPlanes()
+        self.constructionAxes = _Collection()
+        self.constructionPoints = _Collection()
+        self.sketches = _Collection()
+        self.occurrences = _Collection()
+
+
+class _Collection(core.Base):
+    def __init__(self):
+        self._items = []
+
+    @property
+    def count(self):
+        return len(self._items)
+
+    def item(self, index):
+        return self._items[index]
+
+    def add(self, item):
+        self._items.append(item)
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+class MeshBody(core.Base):
+    """Mesh body holding node coordinates and triangle indices in Python lists"""
+
+    def __init__(self, parentComponent, coordinates=(), indices=(), name='Mesh'):
+        self.parentComponent = parentComponent
+        self.name = name
+        self.entityToken = 'mesh-{}'.format(next(_tokens))
+        self.assemblyContext = None
+        self.baseFeature = BaseFeature.editing
+        self._coordinates = [float(v) for v in coordinates]
+        self._indices = [int(i) for i in indices]
+        parentComponent.meshBodies.add(self)
+
+    @property
+    def displayMesh(self):
+        return TriangleMesh(self._coordinates, self._indices)
+
+    @property
+    def mesh(self):
+        return self.displayMesh
+
+    @property
+    def boundingBox(self):
+        if not self._coordinates:
+            return BoundingBox3D(core.Point3D(), core.Point3D())
+        xs, ys, zs = self._coordinates[0::3], self._coordinates[1::3], self._coordinates[2::3]
+        return BoundingBox3D(core.Point3D(min(xs), min(ys), min(zs)),
+                             core.Point3D(max(xs), max(ys), max(zs)))
+
+    def _move(self, matrix):
+        m = matrix.asArray()
+        c = self._coordinates
+        for i in range(0, len(c), 3):
+            x, y, z = c[i], c[i + 1], c[i + 2]
+            c[i] = m[0] * x + m[1] * y + m[2] * z + m[3]
+            c[i + 1] = m[4] * x + m[5] * y + m[6] * z + m[7]
+            c[i + 2] = m[8] * x + m[9] * y + m[10] * z + m[11]
+
+
+class BRepBody(core.Base):
+    pass
+
+
+class ConstructionPlane(core.Base):
+    def __init__(self, geometry, name='Plane'):
+        self.geometry = geometry
+        self.name = name
+        self.entityToken = 'plane-{}'.format(next(_tokens))
+
+
+class ConstructionPlaneInput(core.Base):
+    def __init__(self):
+        self.plane = None
+        self.targetBaseFeature = None
+
+    def setByPlane(self, plane):
+        self.plane = plane.copy()
+        return True
+
+
+class ConstructionPlanes(_Collection):
+    """Planes given by geometry; like Fusion, a parametric one needs a base feature in edit"""
+
+    def createInput(self):
+        return ConstructionPlaneInput()
+
+    def add(self, input):
+        if input.targetBaseFeature is not None and input.targetBaseFeature is not BaseFeature.editing:
+            raise RuntimeError('The target base feature is not in edit')
+        plane = ConstructionPlane(input.plane.copy())
+        plane.baseFeature = input.targetBaseFeature
+        _Collection.add(self, plane)
+        return plane
+
+
+class CustomGraphicsCoordinates(core.Base):
+    def __init__(self, coordinates):
+        self.coordinates = list(coordinates)
+
+    @staticmethod
+    def create(coordinates):
+        return CustomGraphicsCoordinates(coordinates)
+
+
+class CustomGraphicsSolidColorEffect(core.Base):
+    def __init__(self, color):
+        self.color = color
+
+    @staticmethod
+    def create(color):
+        return CustomGraphicsSolidColorEffect(color)
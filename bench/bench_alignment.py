@@ -0,0 +1,319 @@
+"""Headless benchmark and accuracy suite for the mesh align plugin.
+
+Runs on any machine with NumPy by putting the fake ``adsk`` package from
+this folder on sys.path before importing mesh_align_plugin.
+
+    python bench/bench_alignment.py                  # accuracy check + timings
+    python bench/bench_alignment.py --sizes 1,100 --repeat 3 --json bench.json
+    python bench/bench_alignment.py --profile profile.csv  # also dump per-phase timings
+    python bench/bench_alignment.py --update-golden  # regenerate golden_transforms.json
+    python bench/bench_alignment.py --triangles 0    # skip the mesh index timings
+
+The accuracy check compares the plugin's transforms with
+golden_transforms.json, which holds transforms produced by the original
+Matrix3D-based algorithm (re-implemented below on the fake adsk classes).
+The mesh index timings build a TriangleBVH over a synthetic scan of about
+a million triangles and time closest-point queries at several distances
+from it; the build is checked against SPATIAL_BUILD_BUDGET. The deviation
+check of a slightly misaligned copy of the scan against it is checked
+against QUALITY_BUDGET. The exit
+status is non-zero when any transform drifts beyond tolerance or a timing
+misses its budget.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(1, os.path.dirname(BENCH_DIR))
+
+import numpy as np
+
+import adsk.core
+import adsk.fusion
+import mesh_align_core
+import mesh_align_plugin
+import mesh_align_quality
+import mesh_align_sampling
+from mesh_align_profile import PROFILER
+from mesh_align_spatial import TriangleBVH
+
+GOLDEN_FILE = os.path.join(BENCH_DIR, 'golden_transforms.json')
+GOLDEN_CASES = 32
+GOLDEN_TOLERANCE = 1e-9
+
+# Mesh index timings: triangles of the synthetic scan, build time budget
+# (seconds) and the queries timed, as (name, count, offset from the
+# surface as a fraction of the mesh size)
+SPATIAL_TRIANGLES = 1000000
+SPATIAL_BUILD_BUDGET = 1.0
+SPATIAL_QUERIES = (('closest_points (on surface)', 20000, 0.0),
+                   ('closest_points (1% off)', 10000, 0.01),
+                   ('closest_points (5% off)', 5000, 0.05),
+                   ('closest_points (far)', 500, 3.0))
+
+# Seconds the deviation check of a scan of SPATIAL_TRIANGLES may take once
+# its reference is indexed ("a fraction of a second")
+QUALITY_BUDGET = 1.0
+
+
+def random_planes(rng, count):
+    """Random plane arrays (count, 3, 3) with unit normals and in-plane uDirections"""
+    origins = rng.uniform(-50.0, 50.0, size=(count, 3))
+    normals = mesh_align_core.normalize(rng.normal(size=(count, 3)))
+    u_directions = mesh_align_core.normalize(np.cross(normals, rng.normal(size=(count, 3))))
+    return mesh_align_core.make_planes(origins, normals, u_directions)
+
+
+def to_plane(plane_array):
+    """Fake adsk.core.Plane carrying the origin/normal/uDirection of a plane array"""
+    origin, normal, u_direction = plane_array
+    plane = adsk.core.Plane.create(adsk.core.Point3D.create(*origin), adsk.core.Vector3D.create(*normal))
+    plane.setUVDirections(adsk.core.Vector3D.create(*u_direction),
+                          adsk.core.Vector3D.create(*np.cross(normal, u_direction)))
+    return plane
+
+
+def reference_single_plane(src_geom, tgt_geom):
+    """The original Matrix3D implementation of compute_single_plane_transform"""
+    src_z = src_geom.normal.crossProduct(src_geom.uDirection)
+    src_z.normalize()
+    tgt_z = tgt_geom.normal.crossProduct(tgt_geom.uDirection)
+    tgt_z.normalize()
+    matrix = adsk.core.Matrix3D.create()
+    matrix.setToAlignCoordinateSystems(
+        src_geom.origin, src_geom.uDirection, src_geom.normal, src_z,
+        tgt_geom.origin, tgt_geom.uDirection, tgt_geom.normal, tgt_z)
+    return matrix
+
+
+def reference_two_plane(src_geom1, tgt_geom1, src_geom2, tgt_geom2):
+    """The original Matrix3D implementation of compute_two_plane_transform"""
+    src_x = src_geom1.normal.crossProduct(src_geom2.normal)
+    src_x.normalize()
+    tgt_x = tgt_geom1.normal.crossProduct(tgt_geom2.normal)
+    tgt_x.normalize()
+    src_y = src_geom1.normal.copy()
+    tgt_y = tgt_geom1.normal.copy()
+    src_z = src_x.crossProduct(src_y)
+    src_z.normalize()
+    tgt_z = tgt_x.crossProduct(tgt_y)
+    tgt_z.normalize()
+    matrix = adsk.core.Matrix3D.create()
+    matrix.setToAlignCoordinateSystems(
+        src_geom1.origin.copy(), src_x, src_y, src_z,
+        tgt_geom1.origin.copy(), tgt_x, tgt_y, tgt_z)
+    return matrix
+
+
+def update_golden(path=GOLDEN_FILE, cases=GOLDEN_CASES, seed=1234):
+    """Write golden transforms computed with the reference implementation"""
+    rng = np.random.default_rng(seed)
+    planes = random_planes(rng, cases * 4).reshape(cases, 4, 3, 3)
+    records = []
+    for src1, tgt1, src2, tgt2 in planes:
+        geoms = [to_plane(p) for p in (src1, tgt1, src2, tgt2)]
+        records.append({
+            'src1': src1.tolist(), 'tgt1': tgt1.tolist(),
+            'src2': src2.tolist(), 'tgt2': tgt2.tolist(),
+            'single': list(reference_single_plane(geoms[0], geoms[1]).asArray()),
+            'two': list(reference_two_plane(*geoms).asArray()),
+        })
+    with open(path, 'w') as f:
+        json.dump({'seed': seed, 'cases': records}, f, indent=1)
+    return len(records)
+
+
+def check_golden(path=GOLDEN_FILE, tolerance=GOLDEN_TOLERANCE):
+    """Compare adapter and batched-kernel transforms against the golden file
+
+    Returns a dict with the worst absolute error per path and a pass flag.
+    """
+    with open(path) as f:
+        cases = json.load(f)['cases']
+    errors = {'single_adapter': 0.0, 'two_adapter': 0.0, 'single_batched': 0.0, 'two_batched': 0.0}
+    for case in cases:
+        geoms = [to_plane(np.array(case[k])) for k in ('src1', 'tgt1', 'src2', 'tgt2')]
+        single = np.array(mesh_align_plugin.compute_single_plane_transform(geoms[0], geoms[1]).asArray())
+        two = np.array(mesh_align_plugin.compute_two_plane_transform(*geoms).asArray())
+        errors['single_adapter'] = max(errors['single_adapter'], np.abs(single - case['single']).max())
+        errors['two_adapter'] = max(errors['two_adapter'], np.abs(two - case['two']).max())
+
+    stack = dict((k, np.array([c[k] for c in cases])) for k in ('src1', 'tgt1', 'src2', 'tgt2'))
+    single = mesh_align_core.single_plane_transforms(stack['src1'], stack['tgt1']).reshape(len(cases), 16)
+    two = mesh_align_core.two_plane_transforms(
+        stack['src1'], stack['tgt1'], stack['src2'], stack['tgt2']).reshape(len(cases), 16)
+    errors['single_batched'] = np.abs(single - [c['single'] for c in cases]).max()
+    errors['two_batched'] = np.abs(two - [c['two'] for c in cases]).max()
+
+    errors = dict((k, float(v)) for k, v in errors.items())
+    return {'cases': len(cases), 'max_error': errors,
+            'passed': all(v <= tolerance for v in errors.values())}
+
+
+def make_mesh_body(rng, triangles=200):
+    """Small random fake mesh body in its own component"""
+    component = adsk.fusion.Component('Bench')
+    coordinates = rng.uniform(-10.0, 10.0, size=triangles * 3 * 3)
+    indices = np.arange(triangles * 3)
+    return adsk.fusion.MeshBody(component, coordinates, indices)
+
+
+def make_scan_mesh(triangles):
+    """Closed bumpy torus (vertices, triangles) of about the given triangle count, ~100 mm across"""
+    rings = max(int(np.sqrt(triangles / 8.0)), 3)
+    segments = max(triangles // (2 * rings), 3)
+    u, v = np.meshgrid(np.linspace(0.0, 2.0 * np.pi, segments, endpoint=False),
+                       np.linspace(0.0, 2.0 * np.pi, rings, endpoint=False), indexing='ij')
+    tube = 12.0 * (1.0 + 0.1 * np.sin(5.0 * u) * np.cos(3.0 * v))
+    vertices = np.stack([(40.0 + tube * np.cos(v)) * np.cos(u), (40.0 + tube * np.cos(v)) * np.sin(u),
+                         tube * np.sin(v)], axis=-1).reshape(-1, 3)
+    i, j = np.meshgrid(np.arange(segments), np.arange(rings), indexing='ij')
+    a, b = i * rings + j, i * rings + (j + 1) % rings
+    c, d = (i + 1) % segments * rings + j, (i + 1) % segments * rings + (j + 1) % rings
+    faces = np.stack([np.stack([a, c, b], axis=-1), np.stack([b, c, d], axis=-1)], axis=2).reshape(-1, 3)
+    return vertices, faces
+
+
+def time_call(fn, repeat):
+    """Best wall time of fn() over repeat runs, in seconds"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmarks(sizes, repeat, seed=0):
+    """Time the plugin's hot paths for each batch size; returns a list of result rows"""
+    rng = np.random.default_rng(seed)
+    ui = adsk.core.Application.get().userInterface
+    rows = []
+    for size in sizes:
+        planes = random_planes(rng, size * 4).reshape(size, 4, 3, 3)
+        geoms = [[to_plane(p) for p in case] for case in planes]
+        construction = [[adsk.fusion.ConstructionPlane(g) for g in case] for case in geoms]
+        matrices = [mesh_align_plugin.compute_two_plane_transform(*case) for case in geoms]
+        identity = adsk.core.Matrix3D.create()
+        meshes = [make_mesh_body(rng) for _ in range(size)]
+
+        def two_plane_adapter():
+            for case in geoms:
+                mesh_align_plugin.compute_two_plane_transform(*case)
+
+        def two_plane_batched():
+            mesh_align_core.two_plane_transforms(planes[:, 0], planes[:, 1], planes[:, 2], planes[:, 3])
+
+        def matrix_equal():
+            for matrix in matrices:
+                mesh_align_plugin._is_matrix_equal(matrix, identity)
+
+        def perform_alignment():
+            # Clear the memo so every run pays for the full computation
+            mesh_align_plugin._alignment_cache.clear()
+            for mesh, (src1, tgt1, src2, tgt2) in zip(meshes, construction):
+                mesh_align_plugin.perform_alignment(mesh, src1, tgt1, src2, tgt2, ui)
+
+        for name, fn in (('compute_two_plane_transform', two_plane_adapter),
+                         ('two_plane_transforms (batched)', two_plane_batched),
+                         ('_is_matrix_equal', matrix_equal),
+                         ('perform_alignment', perform_alignment)):
+            seconds = time_call(fn, repeat)
+            rows.append({'name': name, 'size': size, 'seconds': seconds,
+                         'per_item_us': seconds / size * 1e6})
+    if ui.messages:
+        raise RuntimeError('perform_alignment reported: {}'.format(ui.messages[-1]))
+    return rows
+
+
+def run_spatial_benchmarks(triangles, repeat, seed=0):
+    """Time the mesh index build and its closest-point queries; returns a list of result rows"""
+    rng = np.random.default_rng(seed)
+    vertices, faces = make_scan_mesh(triangles)
+    size = np.ptp(vertices, axis=0).max()
+    index = []
+
+    def build_index():
+        index[:] = [TriangleBVH(vertices, faces)]
+
+    build = time_call(build_index, repeat)
+    rows = [{'name': 'TriangleBVH build', 'size': len(faces), 'seconds': build,
+             'per_item_us': build / len(faces) * 1e6, 'budget': SPATIAL_BUILD_BUDGET}]
+    for name, count, offset in SPATIAL_QUERIES:
+        directions = mesh_align_core.normalize(rng.normal(size=(count, 3)))
+        points = vertices[rng.integers(0, len(vertices), count)] + directions * (offset * size + 1e-3)
+        seconds = time_call(lambda: index[0].closest_points(points), repeat)
+        rows.append({'name': name, 'size': count, 'seconds': seconds, 'per_item_us': seconds / count * 1e6})
+
+    # The plugin's deviation check of the scan against itself, moved by a
+    # small misalignment, with the reference already indexed
+    surface = mesh_align_quality.SurfaceReference(
+        vertices, faces, mesh_align_plugin.REFERENCE_SAMPLE_COUNT, mesh_align_plugin.SAMPLING_METHOD,
+        lambda: index[0])
+    misaligned = mesh_align_core.rotation_about_axis(0.002, [1.0, 2.0, 3.0], [0.0, 0.0, 0.0])
+    moved = vertices @ misaligned[:3, :3].T + misaligned[:3, 3] + [0.05, 0.0, 0.0]
+    points = mesh_align_sampling.downsample(moved, mesh_align_plugin.QUALITY_SAMPLE_COUNT,
+                                            mesh_align_plugin.SAMPLING_METHOD)
+    seconds = time_call(lambda: mesh_align_plugin.measure_quality(points, 0.5, surface), repeat)
+    rows.append({'name': 'measure_quality', 'size': len(points), 'seconds': seconds,
+                 'per_item_us': seconds / len(points) * 1e6, 'budget': QUALITY_BUDGET})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1,10,100,1000', help='comma-separated batch sizes')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement (best is kept)')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--profile', help='record per-phase timings and export them to this .csv/.json file')
+    parser.add_argument('--update-golden', action='store_true', help='regenerate the golden transforms and exit')
+    parser.add_argument('--triangles', type=int, default=SPATIAL_TRIANGLES,
+                        help='triangles of the mesh for the index timings (0 skips them)')
+    args = parser.parse_args(argv)
+
+    if args.update_golden:
+        print('Wrote {} golden cases to {}'.format(update_golden(), GOLDEN_FILE))
+        return 0
+
+    accuracy = check_golden()
+    print('Accuracy vs golden transforms ({} cases): {}'.format(
+        accuracy['cases'], 'PASS' if accuracy['passed'] else 'FAIL'))
+    for name, error in sorted(accuracy['max_error'].items()):
+        print('  {:<16} max abs error {:.3e}'.format(name, error))
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    PROFILER.enabled = bool(args.profile)
+    rows = run_benchmarks(sizes, args.repeat)
+    if args.triangles > 0:
+        rows += run_spatial_benchmarks(args.triangles, args.repeat)
+    print('')
+    print('{:<32} {:>6} {:>12} {:>14}'.format('benchmark', 'size', 'total ms', 'per item us'))
+    for row in rows:
+        print('{:<32} {:>6} {:>12.3f} {:>14.2f}'.format(
+            row['name'], row['size'], row['seconds'] * 1e3, row['per_item_us']))
+    budgeted = [row for row in rows if 'budget' in row]
+    for row in budgeted:
+        row['passed'] = row['seconds'] <= row['budget']
+        print('Timing {} ({}): {:.3f} s of {:.3f} s: {}'.format(
+            row['name'], row['size'], row['seconds'], row['budget'], 'PASS' if row['passed'] else 'FAIL'))
+
+    if args.profile:
+        print('')
+        print('{:<20} {:>8} {:>12} {:>12} {:>12}'.format('phase', 'count', 'mean us', 'p95 us', 'total ms'))
+        for row in PROFILER.stats():
+            print('{:<20} {:>8} {:>12.2f} {:>12.2f} {:>12.3f}'.format(
+                row['phase'], row['count'], row['mean_s'] * 1e6, row['p95_s'] * 1e6, row['total_s'] * 1e3))
+        PROFILER.export(args.profile)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'accuracy': accuracy, 'timings': rows}, f, indent=1)
+    return 0 if accuracy['passed'] and all(row['passed'] for row in budgeted) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
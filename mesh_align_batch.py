@@ -0,0 +1,399 @@
+"""Register a batch of scans onto one reference on a process pool.
+
+Every scan goes through the same steps as a best-fit run of the Fusion
+script: a vertex sample is drawn, optionally posed by its principal axes
+(mesh_align_fit.coarse_register), refined by point-to-plane ICP and scored
+against the reference surface. Scans are independent, so they are spread
+over a ProcessPoolExecutor, one scan per task. The reference vertices and
+triangles are put in shared memory once and every worker process indexes
+them once, when it starts; vertex arrays given instead of files (e.g. read
+from Fusion mesh bodies) are shared the same way, so no mesh is pickled.
+Workers read scan files themselves. Each worker process takes one core, so
+its KDTree queries and BLAS calls run on a single thread.
+
+    # four scans in any pose onto a fixture, checked to 0.5 mm, 8 processes
+    python mesh_align_batch.py scans/*.stl --reference fixture.stl --coarse \\
+        --tolerance 0.5 --workers 8 --output-dir aligned --recipes recipes
+
+The matrices are printed (or written as JSON), the aligned files written
+with mesh_align_io, and recipes saved for "Replay Recipes" in Fusion.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from multiprocessing import shared_memory
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if _SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, _SCRIPT_DIR)
+
+import numpy as np
+
+import mesh_align_core
+import mesh_align_fit
+import mesh_align_io
+import mesh_align_quality
+import mesh_align_recipes
+import mesh_align_sampling
+import mesh_align_spatial
+from mesh_align_cli import BEST_FIT_SAMPLE_COUNT, QUALITY_SAMPLE_COUNT
+from mesh_align_trace import _jsonable
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# File types picked up when a folder is given
+MESH_EXTENSIONS = ('.stl', '.obj', '.ply')
+
+# Recipes are in Fusion's internal unit (cm); scan files are usually in mm
+DEFAULT_CM_PER_UNIT = 0.1
+
+# Mode recorded in the recipes written for a batch
+RECIPE_MODE = 'Batch Best Fit'
+
+# The reference of this worker process (see _start_worker)
+_worker_reference = None
+
+# Thread counts of the native libraries NumPy and SciPy may load; worker
+# processes start with each set to 1 (see _single_threaded_workers)
+THREAD_LIMIT_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                          'VECLIB_MAXIMUM_THREADS')
+
+
+class BatchResult(object):
+    """Outcome of registering one scan of a batch
+
+    stages is the list of (name, 4x4 matrix) that moves the scan onto the
+    reference ('coarse' and/or 'best_fit'), info holds the bounds of the
+    scan and the fit statistics, quality the deviation report (when a
+    tolerance was given) and error the reason a scan failed, in which case
+    there are no stages.
+    """
+
+    def __init__(self, name, stages=(), info=None, quality=None, error=None, seconds=0.0):
+        self.name = name
+        self.stages = list(stages)
+        self.info = info or {}
+        self.quality = quality
+        self.error = error
+        self.seconds = seconds
+
+    @property
+    def matrix(self):
+        return mesh_align_core.compose_transforms([m for _, m in self.stages]) if self.stages else None
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'stages': [name for name, _ in self.stages],
+            'matrix': self.matrix,
+            'info': self.info,
+            'quality': self.quality,
+            'error': self.error,
+            'seconds': self.seconds,
+        }
+
+
+def register_scan(source, reference, coarse=False, tolerance=None, name=None, output=None):
+    """Register one scan onto a SurfaceReference and return a BatchResult
+
+    source is a mesh file path or an (N, 3) vertex array. With coarse the
+    fit starts from the principal-axes pose, for scans in any pose; without,
+    the scan should already be roughly in place. With tolerance the aligned
+    vertices are measured against the reference, and with output (file
+    sources only) the aligned scan is written there.
+    """
+    start = time.perf_counter()
+    info = {}
+    if isinstance(source, str):
+        name = name or os.path.splitext(os.path.basename(source))[0]
+        points = mesh_align_io.sample_vertices(source, BEST_FIT_SAMPLE_COUNT)
+    else:
+        vertices = np.asarray(source)
+        points = mesh_align_sampling.downsample(vertices, BEST_FIT_SAMPLE_COUNT)
+    if not len(points):
+        raise ValueError('The scan has no vertices')
+    if isinstance(source, str):
+        info['bounds'] = mesh_align_io.read_bounds(source)
+    else:
+        info['bounds'] = np.concatenate([vertices.min(axis=0), vertices.max(axis=0)]).astype(np.float64)
+
+    stages = []
+    init = None
+    if coarse:
+        init, scores = mesh_align_fit.coarse_register(points, reference.tree.points, reference.tree)
+        info['coarse_score'] = float(scores.min())
+        stages.append(('coarse', init))
+    result = mesh_align_fit.icp_point_to_plane(
+        points, reference.tree.points, reference.normals, init=init, target_tree=reference.tree)
+    # The fit includes the coarse pose; the last stage is only the refinement
+    stages.append(('best_fit', result.matrix if init is None else result.matrix @ np.linalg.inv(init)))
+    info['best_fit'] = {'rms': result.rms, 'iterations': result.iterations,
+                        'converged': result.converged, 'inliers': result.inliers}
+
+    quality = None
+    if tolerance is not None:
+        if isinstance(source, str):
+            sample = mesh_align_io.sample_vertices(source, QUALITY_SAMPLE_COUNT)
+        else:
+            sample = mesh_align_sampling.downsample(vertices, QUALITY_SAMPLE_COUNT)
+        deviations = mesh_align_quality.deviation_to_surface(
+            mesh_align_core.transform_points(result.matrix, sample), reference)
+        quality = mesh_align_quality.deviation_report(deviations, tolerance)
+    if output and isinstance(source, str):
+        info['vertices'] = mesh_align_io.transform_file(source, output, result.matrix)
+        info['output'] = output
+    return BatchResult(name, stages, info, quality, seconds=time.perf_counter() - start)
+
+
+def _share(array, blocks):
+    """Copy an array into a new shared memory block; returns what _attach needs"""
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(block)
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return block.name, array.shape, array.dtype.str
+
+
+def _attach(shared):
+    """(block, array) for an array shared by _share; keep the block while the array is used"""
+    name, shape, dtype = shared
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+
+
+@contextlib.contextmanager
+def _single_threaded_workers():
+    """Give the processes started in the block one thread per native library
+
+    The pool already runs one process per core, so BLAS or OpenMP threads in
+    each would oversubscribe the CPU. Spawned processes read
+    THREAD_LIMIT_VARIABLES when they load those libraries; this process has
+    loaded them already and keeps its threads.
+    """
+    saved = dict((name, os.environ.get(name)) for name in THREAD_LIMIT_VARIABLES)
+    os.environ.update((name, '1') for name in THREAD_LIMIT_VARIABLES)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _start_worker(shared_vertices, shared_triangles):
+    """Pool initializer: index the shared reference once per worker process
+
+    Also keeps the worker on one thread: KDTree queries get one, and so do
+    the native thread pools when threadpoolctl is installed (the
+    environment set by _single_threaded_workers covers them otherwise).
+    """
+    global _worker_reference
+    mesh_align_spatial.QUERY_WORKERS = 1
+    if threadpool_limits is not None:
+        threadpool_limits(1)
+    vertex_block, vertices = _attach(shared_vertices)
+    triangle_block, triangles = _attach(shared_triangles)
+    _worker_reference = mesh_align_quality.SurfaceReference(vertices, triangles)
+    # The reference keeps views of the blocks
+    _worker_reference.blocks = (vertex_block, triangle_block)
+
+
+def _run_task(name, source, coarse, tolerance, output):
+    """Worker side of one scan; source is a path or a shared vertex array"""
+    start = time.perf_counter()
+    block = None
+    try:
+        if not isinstance(source, str):
+            block, source = _attach(source)
+        return register_scan(source, _worker_reference, coarse, tolerance, name, output)
+    except Exception as e:
+        return BatchResult(name, error='{}: {}'.format(type(e).__name__, e), seconds=time.perf_counter() - start)
+    finally:
+        if block is not None:
+            block.close()
+
+
+def _read_reference(reference):
+    """(vertices, triangles) of a reference mesh file or array pair"""
+    if isinstance(reference, str):
+        vertices, triangles = mesh_align_io.read_mesh(reference)
+    else:
+        vertices, triangles = reference
+    if not len(triangles):
+        raise ValueError('The reference has no triangles')
+    return np.asarray(vertices, dtype=np.float64), np.asarray(triangles, dtype=np.int64)
+
+
+def register_batch(sources, reference, coarse=False, tolerance=None, workers=None, output_dir=None,
+                   progress=None):
+    """Register every scan in sources onto reference; returns BatchResults in source order
+
+    sources are mesh file paths or (name, vertices) pairs; reference is a
+    mesh file path or a (vertices, triangles) pair. The scans are spread
+    over workers processes (default: one per CPU, at most one per scan);
+    with workers=1 they run one after another in this process. A scan that
+    fails gets a BatchResult with an error instead of stopping the batch.
+    output_dir receives the aligned scan files (file sources only), and
+    progress(done, total, result) is called as each scan finishes. See
+    register_scan for coarse and tolerance.
+    """
+    tasks = []
+    for source in sources:
+        if isinstance(source, str):
+            name = os.path.splitext(os.path.basename(source))[0]
+            output = os.path.join(output_dir, os.path.basename(source)) if output_dir else None
+            tasks.append((name, source, output))
+        else:
+            tasks.append((source[0], source[1], None))
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    vertices, triangles = _read_reference(reference)
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    results = [None] * len(tasks)
+
+    if workers <= 1:
+        surface = mesh_align_quality.SurfaceReference(vertices, triangles)
+        for index, (name, source, output) in enumerate(tasks):
+            start = time.perf_counter()
+            try:
+                results[index] = register_scan(source, surface, coarse, tolerance, name, output)
+            except Exception as e:
+                results[index] = BatchResult(name, error='{}: {}'.format(type(e).__name__, e),
+                                             seconds=time.perf_counter() - start)
+            if progress:
+                progress(index + 1, len(tasks), results[index])
+        return results
+
+    blocks = []
+    try:
+        shared_reference = (_share(vertices, blocks), _share(triangles, blocks))
+        # spawn: workers start clean on every platform instead of forking this process's threads
+        with _single_threaded_workers(), concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_start_worker, initargs=shared_reference) as pool:
+            futures = {}
+            for index, (name, source, output) in enumerate(tasks):
+                shared = source if isinstance(source, str) else _share(source, blocks)
+                futures[pool.submit(_run_task, name, shared, coarse, tolerance, output)] = index
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    # The worker process died (e.g. out of memory)
+                    results[index] = BatchResult(tasks[index][0], error='{}: {}'.format(type(e).__name__, e))
+                if progress:
+                    progress(done, len(tasks), results[index])
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return results
+
+
+def batch_recipe(result, reference_name, cm_per_unit=DEFAULT_CM_PER_UNIT):
+    """Recipe that replays a batch result onto a Fusion body named after the scan
+
+    Fusion works in cm, so the bounds and translations are scaled by
+    cm_per_unit (the length of one file unit in cm).
+    """
+    scale = np.diag([cm_per_unit] * 3 + [1.0])
+    unscale = np.diag([1.0 / cm_per_unit] * 3 + [1.0])
+    stages = [(name, scale @ matrix @ unscale) for name, matrix in result.stages]
+    bounds = np.asarray(result.info['bounds'], dtype=np.float64) * cm_per_unit
+    key = mesh_align_recipes.geometry_key(RECIPE_MODE, [bounds], name=result.name, reference=reference_name)
+    body = {'name': result.name, 'token': None, 'bounds': bounds.tolist()}
+    return mesh_align_recipes.make_recipe(key, RECIPE_MODE, stages, [body], reference=reference_name,
+                                          method='coarse' if result.stages[0][0] == 'coarse' else 'best_fit')
+
+
+def _expand_sources(paths):
+    """Mesh files among paths, with folders replaced by the mesh files in them"""
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                           if os.path.splitext(name)[1].lower() in MESH_EXTENSIONS)
+        else:
+            sources.append(path)
+    return sources
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scans', nargs='+', help='mesh files to align (.stl, .obj or .ply), or folders of them')
+    parser.add_argument('--reference', required=True, help='mesh file every scan is fitted onto')
+    parser.add_argument('--coarse', action='store_true',
+                        help='start each fit from the principal axes, for scans in any pose')
+    parser.add_argument('--tolerance', type=float,
+                        help='check each scan\'s deviation from the reference; exit status 2 if one fails')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--output-dir', help='write the aligned scans to this folder, under their own names')
+    parser.add_argument('--recipes', help='save a recipe per scan to this folder, for Replay Recipes in Fusion')
+    parser.add_argument('--cm-per-unit', type=float, default=DEFAULT_CM_PER_UNIT,
+                        help='length of one file unit in cm, for recipes (default 0.1: mm files)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    sources = _expand_sources(args.scans)
+    if not sources:
+        parser.error('no mesh files found')
+    if args.output_dir and any(os.path.abspath(os.path.dirname(s)) == os.path.abspath(args.output_dir)
+                               for s in sources):
+        parser.error('--output-dir must not be the folder of a scan')
+
+    def report(done, total, result):
+        if args.json:
+            return
+        if result.error:
+            print('[{}/{}] {}: FAILED {}'.format(done, total, result.name, result.error))
+            return
+        line = '[{}/{}] {}: rms {:.6g} in {:.2f}s'.format(done, total, result.name,
+                                                          result.info['best_fit']['rms'], result.seconds)
+        if result.quality:
+            line += ', deviation p95 {:.6g} {}'.format(result.quality['percentiles']['p95'],
+                                                      'PASSED' if result.quality['passed'] else 'FAILED')
+        print(line)
+        sys.stdout.flush()
+
+    start = time.perf_counter()
+    results = register_batch(sources, args.reference, args.coarse, args.tolerance, args.workers,
+                             args.output_dir, report)
+    seconds = time.perf_counter() - start
+
+    if args.recipes:
+        store = mesh_align_recipes.RecipeStore(args.recipes)
+        reference_name = os.path.basename(args.reference)
+        for result in results:
+            if not result.error:
+                result.info['recipe'] = store.save(batch_recipe(result, reference_name, args.cm_per_unit))
+
+    failed = [r for r in results if r.error]
+    if args.json:
+        print(json.dumps(_jsonable({'results': [r.as_dict() for r in results], 'seconds': seconds}), indent=1))
+    else:
+        for result in results:
+            if not result.error:
+                print('{}:'.format(result.name))
+                for row in result.matrix:
+                    print(' '.join('{:14.9f}'.format(v) for v in row))
+        print('registered {} of {} scans in {:.2f}s'.format(len(results) - len(failed), len(results), seconds))
+    if failed:
+        return 1
+    if any(r.quality and not r.quality['passed'] for r in results):
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""Align mesh files on disk without Fusion 360.
+
+Uses the same plane-to-plane and best-fit math as the Fusion script, and
+streams the transform through the file (see mesh_align_io), so large scans
+are never loaded into memory as a whole.
+
+    # one, two or more plane pairs: origin, normal and uDirection (9 numbers each)
+    python mesh_align_cli.py scan.stl aligned.stl \\
+        --src-plane 0 0 0  0 0 1  1 0 0 --tgt-plane 10 0 0  0 1 0  1 0 0 --flip
+
+    # best fit onto a reference mesh (the scan should already be roughly in place)
+    python mesh_align_cli.py scan.stl aligned.stl --reference fixture.stl
+
+    # the same from any starting pose: principal axes first, then the best fit
+    python mesh_align_cli.py scan.stl aligned.stl --reference fixture.stl --coarse
+
+    # apply a known 4x4 matrix (row by row)
+    python mesh_align_cli.py scan.ply aligned.ply --matrix 1 0 0 5  0 1 0 0  0 0 1 0  0 0 0 1
+
+Plane coordinates are in the file's units. With both planes and a reference,
+the plane alignment is the starting pose for the best fit. Without an output
+file only the matrix is printed.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if _SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, _SCRIPT_DIR)
+
+import numpy as np
+
+import mesh_align_core
+import mesh_align_fit
+import mesh_align_io
+import mesh_align_quality
+from mesh_align_spatial import KDTree
+
+# Number of input vertices fed to the best-fit solver (as in the Fusion script)
+BEST_FIT_SAMPLE_COUNT = 20000
+
+# The Fusion script flips about an axis 10 cm above target plane 1; in mm files
+DEFAULT_HINGE_OFFSET = 100.0
+
+# Input vertices measured by --tolerance (as in the Fusion script), and the
+# band around target planes (in tolerances) within which vertices count as
+# lying on a plane
+QUALITY_SAMPLE_COUNT = 20000
+QUALITY_PLANE_BAND_FACTOR = 5.0
+
+
+def compute_stages(src_planes=(), tgt_planes=(), flip=False, hinge_offset=DEFAULT_HINGE_OFFSET,
+                   matrix=None, reference=None, source_path=None, coarse=False):
+    """Ordered (name, 4x4 matrix) stages for the requested alignment
+
+    With coarse the best fit starts from the principal-axes pose
+    (mesh_align_fit.coarse_register) instead of the earlier stages. Returns
+    (stages, info) where info holds the plane mode and best-fit statistics
+    for reporting.
+    """
+    stages = []
+    info = {}
+    if matrix is not None:
+        stages.append(('matrix', np.asarray(matrix, dtype=np.float64).reshape(4, 4)))
+    if len(src_planes):
+        align, info['mode'] = mesh_align_core.plane_alignment(src_planes, tgt_planes)
+        stages.append(('align', align))
+        if flip:
+            _, _, flip_matrix = mesh_align_core.flip_transforms(src_planes[0], tgt_planes[0], align, hinge_offset)
+            stages.append(('flip', flip_matrix))
+    if reference:
+        ref_vertices, ref_triangles = mesh_align_io.read_mesh(reference)
+        if not len(ref_triangles):
+            raise ValueError('The reference {} has no triangles'.format(reference))
+        source = mesh_align_io.sample_vertices(source_path, BEST_FIT_SAMPLE_COUNT)
+        tree = KDTree(ref_vertices)
+        init = mesh_align_core.compose_transforms([m for _, m in stages]) if stages else None
+        if coarse:
+            init, scores = mesh_align_fit.coarse_register(source, ref_vertices, tree)
+            info['coarse_score'] = float(scores.min())
+        result = mesh_align_fit.icp_point_to_plane(
+            source, ref_vertices, mesh_align_fit.vertex_normals(ref_vertices, ref_triangles),
+            init=init, target_tree=tree)
+        # The fit already includes the earlier stages as its starting pose
+        stages = [('best_fit', result.matrix)]
+        info['best_fit'] = {'rms': result.rms, 'iterations': result.iterations,
+                            'converged': result.converged, 'inliers': result.inliers}
+    return stages, info
+
+
+def check_quality(source_path, matrix, tolerance, reference=None, tgt_planes=()):
+    """Deviation report of the aligned input against the reference mesh or target planes"""
+    points = mesh_align_core.transform_points(
+        matrix, mesh_align_io.sample_vertices(source_path, QUALITY_SAMPLE_COUNT))
+    if reference:
+        surface = mesh_align_quality.SurfaceReference(*mesh_align_io.read_mesh(reference))
+        deviations = mesh_align_quality.deviation_to_surface(points, surface)
+    else:
+        deviations, _ = mesh_align_quality.deviation_to_planes(
+            points, tgt_planes, QUALITY_PLANE_BAND_FACTOR * tolerance)
+    return mesh_align_quality.deviation_report(deviations, tolerance)
+
+
+def _planes_argument(values):
+    return mesh_align_core.make_planes(*np.asarray(values, dtype=np.float64).reshape(-1, 3, 3).transpose(1, 0, 2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('input', help='mesh file to align (.stl, .obj or .ply)')
+    parser.add_argument('output', nargs='?', help='aligned mesh file (same format); may equal input for binary files')
+    parser.add_argument('--src-plane', nargs=9, type=float, action='append', default=[],
+                        metavar='V', help='source plane origin, normal and uDirection; repeat for more pairs')
+    parser.add_argument('--tgt-plane', nargs=9, type=float, action='append', default=[],
+                        metavar='V', help='target plane for the source plane at the same position')
+    parser.add_argument('--flip', action='store_true', help='flip 180 degrees on plane 1 after aligning')
+    parser.add_argument('--hinge-offset', type=float, default=DEFAULT_HINGE_OFFSET,
+                        help='distance of the flip axis from target plane 1, in file units')
+    parser.add_argument('--reference', help='best-fit the input onto this mesh file')
+    parser.add_argument('--coarse', action='store_true',
+                        help='start the best fit from the principal axes, for inputs in any pose')
+    parser.add_argument('--matrix', nargs=16, type=float, metavar='M', help='apply this 4x4 matrix (row by row) first')
+    parser.add_argument('--tolerance', type=float,
+                        help='check the deviation from the reference (or target planes); exit status 2 if it fails')
+    parser.add_argument('--chunk-size', type=int, default=mesh_align_io.CHUNK_SIZE, help='records or lines per chunk')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    if len(args.src_plane) != len(args.tgt_plane):
+        parser.error('give the same number of --src-plane and --tgt-plane values')
+    if not (args.src_plane or args.reference or args.matrix):
+        parser.error('nothing to do: give plane pairs, --reference or --matrix')
+    if args.flip and not args.src_plane:
+        parser.error('--flip needs a plane pair')
+    if args.coarse and not args.reference:
+        parser.error('--coarse needs --reference')
+    if args.coarse and (args.src_plane or args.matrix):
+        parser.error('--coarse replaces plane pairs and --matrix as the starting pose')
+    if args.tolerance is not None and not (args.reference or args.tgt_plane):
+        parser.error('--tolerance needs --reference or target planes to measure against')
+
+    start = time.perf_counter()
+    stages, info = compute_stages(
+        _planes_argument(args.src_plane) if args.src_plane else (),
+        _planes_argument(args.tgt_plane) if args.tgt_plane else (),
+        args.flip, args.hinge_offset, args.matrix, args.reference, args.input, args.coarse)
+    matrix = mesh_align_core.compose_transforms([m for _, m in stages])
+    solve_seconds = time.perf_counter() - start
+
+    # Measure before writing: the output may replace the input
+    if args.tolerance is not None:
+        info['quality'] = check_quality(args.input, matrix, args.tolerance, args.reference,
+                                        _planes_argument(args.tgt_plane) if args.tgt_plane else ())
+
+    vertices = None
+    if args.output:
+        start = time.perf_counter()
+        vertices = mesh_align_io.transform_file(args.input, args.output, matrix, args.chunk_size)
+        info['write_s'] = time.perf_counter() - start
+
+    info.update({'stages': [name for name, _ in stages], 'matrix': matrix.tolist(),
+                 'solve_s': solve_seconds, 'vertices': vertices})
+    if args.json:
+        print(json.dumps(info, indent=1))
+    else:
+        print('stages: {}'.format(', '.join(info['stages'])))
+        if 'best_fit' in info:
+            print('best fit: rms {rms:.6g} after {iterations} iterations ({inliers} inliers)'.format(**info['best_fit']))
+        for row in matrix:
+            print(' '.join('{:14.9f}'.format(v) for v in row))
+        if vertices is not None:
+            print('wrote {} vertices to {} in {:.3f}s'.format(vertices, args.output, info['write_s']))
+        if 'quality' in info and info['quality']['count']:
+            print('deviation: rms {rms:.6g}, max {max_abs:.6g}, p95 {p95:.6g} over {count} vertices'.format(
+                p95=info['quality']['percentiles']['p95'], **info['quality']))
+        if 'quality' in info:
+            print('deviation check: {}'.format('PASSED' if info['quality']['passed'] else 'FAILED'))
+    if 'quality' in info and not info['quality']['passed']:
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
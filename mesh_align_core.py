@@ -0,0 +1,319 @@
+"""Fusion-independent transform kernel for the mesh align plugin.
+
+Planes are passed as arrays of shape (..., 3, 3) whose rows are the plane
+origin, normal and uDirection (the same fields as ``adsk.core.Plane``).
+Transforms come back as stacks of 4x4 matrices laid out like
+``adsk.core.Matrix3D.asArray()``: column vectors, translation in the last
+column. Every function broadcasts over the leading batch dimensions so many
+plane pairs can be solved in one call.
+"""
+import numpy as np
+
+
+# Row indices inside a plane array
+ORIGIN = 0
+NORMAL = 1
+U_DIRECTION = 2
+
+_EPS = 1e-12
+
+
+def as_planes(planes):
+    """Return planes as a float64 array of shape (..., 3, 3)"""
+    planes = np.asarray(planes, dtype=np.float64)
+    if planes.shape[-2:] != (3, 3):
+        raise ValueError('Plane arrays must have shape (..., 3, 3), got {}'.format(planes.shape))
+    return planes
+
+
+def make_planes(origins, normals, u_directions):
+    """Stack origins, normals and uDirections of shape (..., 3) into plane arrays"""
+    return np.stack([
+        np.asarray(origins, dtype=np.float64),
+        np.asarray(normals, dtype=np.float64),
+        np.asarray(u_directions, dtype=np.float64),
+    ], axis=-2)
+
+
+def normalize(vectors):
+    """Normalize vectors along the last axis; zero-length vectors are left as zero"""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    length = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(length > _EPS, length, 1.0)
+
+
+def cross(a, b):
+    """Cross product along the last axis (cheaper than np.cross for small batches)"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return np.stack([
+        a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1],
+        a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2],
+        a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0],
+    ], axis=-1)
+
+
+def identity(batch_shape=()):
+    """Return a stack of 4x4 identity matrices"""
+    return np.broadcast_to(np.eye(4), tuple(batch_shape) + (4, 4)).copy()
+
+
+def align_frames(src_origins, src_axes, tgt_origins, tgt_axes):
+    """Build the matrices mapping source coordinate systems onto target ones
+
+    Axes are (..., 3, 3) arrays whose columns are the orthonormal x, y and z
+    directions of each frame. This is the batched equivalent of
+    ``Matrix3D.setToAlignCoordinateSystems``.
+    """
+    src_axes = np.asarray(src_axes, dtype=np.float64)
+    tgt_axes = np.asarray(tgt_axes, dtype=np.float64)
+    rotation = tgt_axes @ np.swapaxes(src_axes, -1, -2)
+    translation = np.asarray(tgt_origins, dtype=np.float64) - np.einsum(
+        '...ij,...j->...i', rotation, src_origins)
+
+    batch_shape = np.broadcast_shapes(rotation.shape[:-2], translation.shape[:-1])
+    matrices = identity(batch_shape)
+    matrices[..., :3, :3] = rotation
+    matrices[..., :3, 3] = translation
+    return matrices
+
+
+def plane_frames(planes):
+    """Frame of each plane: x = uDirection, y = normal, z = normal x uDirection"""
+    planes = as_planes(planes)
+    x = normalize(planes[..., U_DIRECTION, :])
+    y = normalize(planes[..., NORMAL, :])
+    z = normalize(cross(y, x))
+    return np.stack([x, y, z], axis=-1)
+
+
+def intersection_frames(planes1, planes2):
+    """Frame built on the intersection line of two planes
+
+    x = normal1 x normal2, y = normal1, z = x x y. Also returns a boolean mask
+    of the rows where the normals are (anti)parallel and the frame is undefined.
+    """
+    planes1 = as_planes(planes1)
+    planes2 = as_planes(planes2)
+    axis = cross(planes1[..., NORMAL, :], planes2[..., NORMAL, :])
+    degenerate = np.linalg.norm(axis, axis=-1) <= 1e-9
+    x = normalize(axis)
+    y = normalize(planes1[..., NORMAL, :])
+    z = normalize(cross(x, y))
+    return np.stack([x, y, z], axis=-1), degenerate
+
+
+def single_plane_transforms(src_planes, tgt_planes):
+    """Transforms that put each source plane onto its target plane"""
+    src_planes = as_planes(src_planes)
+    tgt_planes = as_planes(tgt_planes)
+    return align_frames(
+        src_planes[..., ORIGIN, :], plane_frames(src_planes),
+        tgt_planes[..., ORIGIN, :], plane_frames(tgt_planes))
+
+
+def two_plane_transforms(src_planes1, tgt_planes1, src_planes2, tgt_planes2):
+    """Transforms aligning two plane pairs at once
+
+    The intersection line of each plane pair is used as the primary axis and
+    plane 1's origin pins the translation. Rows whose source or target normals
+    are parallel have no intersection line and fall back to the single-plane
+    transform of pair 1.
+    """
+    src_planes1 = as_planes(src_planes1)
+    tgt_planes1 = as_planes(tgt_planes1)
+    src_axes, src_degenerate = intersection_frames(src_planes1, src_planes2)
+    tgt_axes, tgt_degenerate = intersection_frames(tgt_planes1, tgt_planes2)
+
+    matrices = align_frames(
+        src_planes1[..., ORIGIN, :], src_axes,
+        tgt_planes1[..., ORIGIN, :], tgt_axes)
+
+    degenerate = np.broadcast_to(src_degenerate | tgt_degenerate, matrices.shape[:-2])
+    if np.any(degenerate):
+        fallback = np.broadcast_to(
+            single_plane_transforms(src_planes1, tgt_planes1), matrices.shape)
+        matrices[degenerate] = fallback[degenerate]
+    return matrices
+
+
+def transform_points(matrices, points):
+    """Apply 4x4 matrices to points of shape (..., 3)"""
+    matrices = np.asarray(matrices, dtype=np.float64)
+    return np.einsum('...ij,...j->...i', matrices[..., :3, :3], points) + matrices[..., :3, 3]
+
+
+def transform_vectors(matrices, vectors):
+    """Apply only the rotational part of 4x4 matrices to vectors of shape (..., 3)"""
+    matrices = np.asarray(matrices, dtype=np.float64)
+    return np.einsum('...ij,...j->...i', matrices[..., :3, :3], vectors)
+
+
+def rotation_about_axis(angles, axes, centers):
+    """Rotations by angles (radians) about axes through centers
+
+    Batched equivalent of ``Matrix3D.setToRotation(angle, axis, origin)``.
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    axes = normalize(axes)
+    centers = np.asarray(centers, dtype=np.float64)
+
+    cos = np.cos(angles)[..., None, None]
+    sin = np.sin(angles)[..., None, None]
+    x, y, z = axes[..., 0], axes[..., 1], axes[..., 2]
+    zero = np.zeros_like(x)
+    cross = np.stack([
+        np.stack([zero, -z, y], axis=-1),
+        np.stack([z, zero, -x], axis=-1),
+        np.stack([-y, x, zero], axis=-1),
+    ], axis=-2)
+    outer = axes[..., :, None] * axes[..., None, :]
+    rotation = cos * np.eye(3) + sin * cross + (1.0 - cos) * outer
+
+    translation = centers - np.einsum('...ij,...j->...i', rotation, centers)
+    batch_shape = np.broadcast_shapes(rotation.shape[:-2], translation.shape[:-1])
+    matrices = identity(batch_shape)
+    matrices[..., :3, :3] = rotation
+    matrices[..., :3, 3] = translation
+    return matrices
+
+
+def compose_transforms(matrices):
+    """Fold transforms applied first-to-last into a single matrix
+
+    ``compose_transforms([align, flip])`` equals ``flip @ align``, i.e. moving
+    by align and then by flip. Each item may itself be a batch of matrices.
+    """
+    result = None
+    for matrix in matrices:
+        matrix = np.asarray(matrix, dtype=np.float64)
+        result = matrix.copy() if result is None else matrix @ result
+    if result is None:
+        return identity()
+    return result
+
+
+def solve_plane_pairs(src_planes, tgt_planes, weights=None):
+    """Best-fit rigid transform for any number of source/target plane pairs
+
+    src_planes and tgt_planes have shape (..., K, 3, 3) with K >= 2 pairs.
+    The rotation comes from an SVD (Kabsch) of the weighted normal
+    correlation, so it needs at least two non-parallel normals. The
+    translation is the least-squares solution of
+    ``n_t . (R o_s + t) = n_t . o_t`` over all pairs. Directions that the
+    planes do not constrain (e.g. along the intersection line of only two
+    planes) keep plane 1's origin pinned to target 1's origin, as in
+    two_plane_transforms.
+
+    Returns (matrices, residuals) with residuals from plane_pair_residuals.
+    """
+    src_planes = as_planes(src_planes)
+    tgt_planes = as_planes(tgt_planes)
+    if src_planes.shape[-3] < 2:
+        raise ValueError('solve_plane_pairs needs at least two plane pairs')
+    src_normals = normalize(src_planes[..., NORMAL, :])
+    tgt_normals = normalize(tgt_planes[..., NORMAL, :])
+    if weights is None:
+        weights = np.ones(src_planes.shape[:-2])
+    weights = np.asarray(weights, dtype=np.float64)
+
+    # Rotation: maximise sum w_i (R n_s,i) . n_t,i
+    correlation = np.einsum('...k,...ki,...kj->...ij', weights, src_normals, tgt_normals)
+    u, _, vt = np.linalg.svd(correlation)
+    v = np.swapaxes(vt, -1, -2)
+    ut = np.swapaxes(u, -1, -2)
+    sign = np.sign(np.linalg.det(v @ ut))
+    sign = np.where(sign == 0, 1.0, sign)
+    correction = np.broadcast_to(np.eye(3), sign.shape + (3, 3)).copy()
+    correction[..., 2, 2] = sign
+    rotation = v @ correction @ ut
+
+    # Translation: weighted least squares over the plane offsets, minimum-norm
+    # deviation from pinning plane 1's origin
+    moved_origins = np.einsum('...ij,...kj->...ki', rotation, src_planes[..., ORIGIN, :])
+    pinned = tgt_planes[..., 0, ORIGIN, :] - moved_origins[..., 0, :]
+    sqrt_w = np.sqrt(weights)[..., None]
+    a = tgt_normals * sqrt_w
+    b = (np.einsum('...ki,...ki->...k', tgt_normals, tgt_planes[..., ORIGIN, :] - moved_origins)
+         - np.einsum('...ki,...i->...k', tgt_normals, pinned)) * sqrt_w[..., 0]
+    delta = np.einsum('...ik,...k->...i', np.linalg.pinv(a, rcond=1e-9), b)
+    translation = pinned + delta
+
+    matrices = identity(rotation.shape[:-2])
+    matrices[..., :3, :3] = rotation
+    matrices[..., :3, 3] = translation
+    return matrices, plane_pair_residuals(matrices, src_planes, tgt_planes)
+
+
+def plane_pair_residuals(matrices, src_planes, tgt_planes):
+    """Per-pair misfit of transformed source planes against target planes
+
+    Returns a dict with 'angle' (radians between the moved source normal and
+    the target normal) and 'distance' (signed offset of the moved source
+    origin from the target plane), each of shape (..., K).
+    """
+    matrices = np.asarray(matrices, dtype=np.float64)
+    src_planes = as_planes(src_planes)
+    tgt_planes = as_planes(tgt_planes)
+    tgt_normals = normalize(tgt_planes[..., NORMAL, :])
+    moved_normals = normalize(np.einsum('...ij,...kj->...ki', matrices[..., :3, :3], src_planes[..., NORMAL, :]))
+    moved_origins = (np.einsum('...ij,...kj->...ki', matrices[..., :3, :3], src_planes[..., ORIGIN, :])
+                     + matrices[..., None, :3, 3])
+    angle = np.arccos(np.clip(np.einsum('...ki,...ki->...k', moved_normals, tgt_normals), -1.0, 1.0))
+    distance = np.einsum('...ki,...ki->...k', tgt_normals, moved_origins - tgt_planes[..., ORIGIN, :])
+    return {'angle': angle, 'distance': distance}
+
+
+def plane_alignment(src_planes, tgt_planes):
+    """Align a list of K >= 1 source planes onto their target planes
+
+    One pair uses single_plane_transforms, two pairs two_plane_transforms and
+    three or more the least-squares solve_plane_pairs. Returns
+    (matrix, mode) with mode 'single-plane', 'two-plane' or 'least-squares'.
+    """
+    src_planes = as_planes(src_planes).reshape(-1, 3, 3)
+    tgt_planes = as_planes(tgt_planes).reshape(-1, 3, 3)
+    if len(src_planes) >= 3:
+        return solve_plane_pairs(src_planes, tgt_planes)[0], 'least-squares'
+    if len(src_planes) == 2:
+        return two_plane_transforms(src_planes[0], tgt_planes[0], src_planes[1], tgt_planes[1]), 'two-plane'
+    return single_plane_transforms(src_planes[0], tgt_planes[0]), 'single-plane'
+
+
+def flip_transforms(src_planes, tgt_planes, align_matrices, hinge_offset=10.0):
+    """180 degree flips applied after aligning src_planes onto tgt_planes
+
+    The flip axis is the target uDirection, which lies in the target plane.
+    Rotating about an axis through the aligned origin would keep the origin
+    in place, so the axis is moved hinge_offset units along the target normal
+    to create a "hinge" effect. Returns (axes, centers, matrices).
+    """
+    src_planes = as_planes(src_planes)
+    tgt_planes = as_planes(tgt_planes)
+    aligned_origins = transform_points(align_matrices, src_planes[..., ORIGIN, :])
+    axes = normalize(tgt_planes[..., U_DIRECTION, :])
+    centers = aligned_origins + normalize(tgt_planes[..., NORMAL, :]) * hinge_offset
+    return axes, centers, rotation_about_axis(np.pi, axes, centers)
+
+
+# Candidate turns on target plane 1 scored by auto-orient, in order of preference
+ORIENTATIONS = ('none', 'spin', 'flip_u', 'flip_v')
+
+
+def orientation_turns(src_plane, tgt_plane, align_matrix):
+    """The symmetric alternatives to aligning src_plane onto tgt_plane
+
+    Returns turns of shape (4, 4, 4) matching ORIENTATIONS: no turn, 180
+    degrees about the target normal ('spin') and 180 degrees about the
+    target uDirection or vDirection ('flip_u', 'flip_v'). Every turn is about
+    an axis through the aligned plane origin, so the source plane stays on
+    the target plane; apply a turn after align_matrix.
+    """
+    src_plane = as_planes(src_plane)
+    tgt_plane = as_planes(tgt_plane)
+    center = transform_points(align_matrix, src_plane[ORIGIN])
+    normal = normalize(tgt_plane[NORMAL])
+    u_direction = normalize(tgt_plane[U_DIRECTION])
+    v_direction = normalize(cross(normal, u_direction))
+    axes = np.stack([normal, normal, u_direction, v_direction])
+    return rotation_about_axis(np.array([0.0, np.pi, np.pi, np.pi]), axes, center)
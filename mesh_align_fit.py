@@ -0,0 +1,247 @@
+"""Fusion-independent fitting routines for the mesh align plugin.
+
+Everything here works on plain NumPy arrays: vertices are (N, 3) arrays,
+triangles are (M, 3) integer index arrays and transforms are 4x4 matrices in
+the mesh_align_core convention.
+"""
+import itertools
+
+import numpy as np
+
+import mesh_align_core
+from mesh_align_spatial import KDTree
+
+
+class FitResult(object):
+    """Outcome of an iterative fit"""
+
+    def __init__(self, matrix, rms, iterations, converged, inliers):
+        self.matrix = matrix
+        self.rms = rms
+        self.iterations = iterations
+        self.converged = converged
+        self.inliers = inliers
+
+    def as_dict(self):
+        return {
+            'matrix': self.matrix,
+            'rms': self.rms,
+            'iterations': self.iterations,
+            'converged': self.converged,
+            'inliers': self.inliers,
+        }
+
+
+def vertex_normals(vertices, triangles):
+    """Area-weighted unit vertex normals of a triangle mesh"""
+    vertices = np.asarray(vertices, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.intp)
+    corners = vertices[triangles]
+    face_normals = mesh_align_core.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    # bincount sums the face normals per vertex much faster than np.add.at
+    normals = np.empty_like(vertices)
+    for axis in range(3):
+        normals[:, axis] = np.bincount(triangles.ravel(), weights=np.repeat(face_normals[:, axis], 3),
+                                       minlength=len(vertices))
+    return mesh_align_core.normalize(normals)
+
+
+def small_rotation(omega):
+    """Rotation matrix for the rotation vector omega (Rodrigues' formula)"""
+    angle = float(np.linalg.norm(omega))
+    if angle < 1e-15:
+        return np.eye(3)
+    return mesh_align_core.rotation_about_axis(angle, omega / angle, np.zeros(3))[:3, :3]
+
+
+def icp_point_to_plane(source, target, target_normals, init=None, max_iterations=50,
+                       tolerance=1e-7, max_correspondence=None, target_tree=None, callback=None):
+    """Register source points onto a target surface with point-to-plane ICP
+
+    Each iteration pairs every transformed source point with its nearest
+    target vertex, rejects pairs further than max_correspondence (default:
+    three times the median pair distance) and solves the linearised 6x6
+    point-to-plane system in one vectorised step. Stops when the update is
+    smaller than tolerance. callback(iteration, max_iterations, rms) is
+    called after every iteration, e.g. to report progress; an exception it
+    raises stops the fit. Returns a FitResult whose matrix maps the original
+    source points onto the target.
+    """
+    source = np.asarray(source, dtype=np.float64)
+    target_normals = np.asarray(target_normals, dtype=np.float64)
+    tree = target_tree if target_tree is not None else KDTree(target)
+    target = tree.points
+
+    matrix = np.eye(4) if init is None else np.array(init, dtype=np.float64)
+    rms = np.inf
+    inliers = 0
+    converged = False
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        moved = mesh_align_core.transform_points(matrix, source)
+        distances, indices = tree.query(moved)
+        limit = max_correspondence
+        if limit is None:
+            limit = 3.0 * np.median(distances) + 1e-12
+        keep = distances <= limit
+        inliers = int(np.count_nonzero(keep))
+        if inliers < 6:
+            break
+
+        p = moved[keep]
+        q = target[indices[keep]]
+        n = target_normals[indices[keep]]
+
+        # Linearise about the centroid for a well-conditioned system
+        center = p.mean(axis=0)
+        pc = p - center
+        a = np.hstack([np.cross(pc, n), n])
+        b = -np.einsum('ij,ij->i', p - q, n)
+        x, _, _, _ = np.linalg.lstsq(a, b, rcond=None)
+        rms = float(np.sqrt(np.mean(b * b)))
+
+        step = np.eye(4)
+        step[:3, :3] = small_rotation(x[:3])
+        step[:3, 3] = center - step[:3, :3] @ center + x[3:]
+        matrix = step @ matrix
+        if callback is not None:
+            callback(iteration, max_iterations, rms)
+
+        if np.linalg.norm(x) < tolerance:
+            converged = True
+            break
+
+    return FitResult(matrix, rms, iteration, converged, inliers)
+
+
+def principal_axes(points):
+    """Centroid and principal axes of a point set
+
+    Returns (centroid, axes, variances) where the columns of axes are unit
+    directions sorted by decreasing variance.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    centroid = points.mean(axis=0)
+    centered = points - centroid
+    covariance = centered.T @ centered / max(len(points), 1)
+    variances, axes = np.linalg.eigh(covariance)
+    order = np.argsort(variances)[::-1]
+    return centroid, axes[:, order], variances[order]
+
+
+def principal_frame(points):
+    """Centroid and right-handed principal axes with their signs fixed
+
+    The first two axes are flipped so that the third central moment (skew)
+    of the points along them is positive; the third axis completes a
+    right-handed frame. Returns (centroid, axes) with the axes as columns.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    centroid, axes, _ = principal_axes(points)
+    skew = np.sum(((points - centroid) @ axes[:, :2]) ** 3, axis=0)
+    axes[:, :2] *= np.where(skew < 0, -1.0, 1.0)
+    axes[:, 2] = np.cross(axes[:, 0], axes[:, 1])
+    return centroid, axes
+
+
+def _axis_turns():
+    """The 24 rotations that map the coordinate axes onto signed axes, identity first"""
+    turns = []
+    for order in itertools.permutations(range(3)):
+        for signs in itertools.product((1.0, -1.0), repeat=3):
+            turn = np.zeros((3, 3))
+            turn[list(order), range(3)] = signs
+            if np.linalg.det(turn) > 0:
+                turns.append(turn)
+    return np.array(turns)
+
+
+# Axis permutations and sign flips tried by coarse_register; a symmetric or
+# nearly round part has no reliable skew or axis order, so all are scored
+AXIS_TURNS = _axis_turns()
+
+
+def coarse_register(source, target, target_tree=None, sample_count=2000, seed=0):
+    """Coarse pose of source on target from their principal frames
+
+    Maps the source principal frame onto the target one (see
+    principal_frame) under each of the AXIS_TURNS and scores every candidate
+    by the median distance of a source sample to the target, all in one
+    batched nearest-neighbour query. The moment-based pose comes first and
+    wins ties. Returns (matrix, scores), scores being one per candidate,
+    lower is better. The pose is a starting point for icp_point_to_plane.
+    """
+    source = np.asarray(source, dtype=np.float64)
+    tree = target_tree if target_tree is not None else KDTree(target)
+    src_centroid, src_axes = principal_frame(source)
+    tgt_centroid, tgt_axes = principal_frame(tree.points)
+
+    matrices = np.tile(np.eye(4), (len(AXIS_TURNS), 1, 1))
+    matrices[:, :3, :3] = tgt_axes @ AXIS_TURNS @ src_axes.T
+    matrices[:, :3, 3] = tgt_centroid - matrices[:, :3, :3] @ src_centroid
+
+    if len(source) > sample_count:
+        source = source[np.random.default_rng(seed).choice(len(source), sample_count, replace=False)]
+    moved = mesh_align_core.transform_points(matrices[:, None], source[None])
+    distances, _ = tree.query(moved.reshape(-1, 3))
+    scores = np.median(distances.reshape(len(matrices), -1), axis=1)
+    return matrices[int(np.argmin(scores))], scores
+
+
+def fit_plane(points, threshold=None, iterations=256, outward_from=None, seed=0):
+    """Fit a plane to noisy points with RANSAC followed by a PCA refinement
+
+    All RANSAC hypotheses are scored in one vectorised pass. threshold is the
+    inlier distance; by default it is derived from the spread of the points
+    around their least-squares plane. The normal is oriented away from
+    outward_from (e.g. the body centroid) when given, and the uDirection is
+    the main in-plane principal axis.
+
+    Returns (plane, inliers): a 3x3 plane array (origin, normal, uDirection)
+    and a boolean inlier mask.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 3:
+        raise ValueError('At least 3 points are needed to fit a plane')
+
+    if threshold is None:
+        centroid, axes, _ = principal_axes(points)
+        residual = np.abs((points - centroid) @ axes[:, 2])
+        # 1.4826 * MAD estimates the noise sigma; keep a small floor for perfectly flat input
+        sigma = 1.4826 * np.median(np.abs(residual - np.median(residual)))
+        threshold = max(2.5 * sigma, 1e-9 * (1.0 + np.ptp(points, axis=0).max()))
+
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, len(points), size=(iterations, 3))
+    a, b, c = points[samples[:, 0]], points[samples[:, 1]], points[samples[:, 2]]
+    normals = np.cross(b - a, c - a)
+    valid = np.linalg.norm(normals, axis=1) > 1e-12
+    best = None
+    if np.any(valid):
+        normals = mesh_align_core.normalize(normals[valid])
+        offsets = np.einsum('ij,ij->i', normals, a[valid])
+        # Score hypotheses in blocks so memory stays bounded for large regions
+        block = max(1, (1 << 22) // len(points))
+        counts = np.concatenate([
+            np.count_nonzero(np.abs(points @ normals[i:i + block].T - offsets[i:i + block]) <= threshold, axis=0)
+            for i in range(0, len(normals), block)
+        ])
+        best = int(np.argmax(counts))
+
+    if best is None:
+        inliers = np.ones(len(points), dtype=bool)
+    else:
+        inliers = np.abs(points @ normals[best] - offsets[best]) <= threshold
+        if np.count_nonzero(inliers) < 3:
+            inliers = np.ones(len(points), dtype=bool)
+
+    # PCA refinement over the inliers
+    origin, axes, _ = principal_axes(points[inliers])
+    normal = axes[:, 2]
+    u_direction = axes[:, 0]
+    if outward_from is not None and np.dot(normal, origin - np.asarray(outward_from, dtype=np.float64)) < 0:
+        normal = -normal
+    # Make the in-plane direction deterministic: largest component positive
+    if u_direction[np.argmax(np.abs(u_direction))] < 0:
+        u_direction = -u_direction
+    return mesh_align_core.make_planes(origin, normal, u_direction), inliers
@@ -0,0 +1,424 @@
+"""Mesh file I/O for aligning scans outside Fusion 360.
+
+Supports STL (binary and ASCII), OBJ and PLY (ASCII and binary). Rigid
+transforms are streamed from the input file to the output file so large
+scans never have to fit in memory:
+
+- binary STL and binary PLY vertex data are mapped with numpy.memmap and
+  transformed in chunks of CHUNK_SIZE records;
+- ASCII STL, OBJ and ASCII PLY are rewritten in batches of CHUNK_SIZE lines,
+  transforming the coordinates of each batch in one vectorised step.
+
+Positions are transformed as points and normals (STL facet normals, OBJ vn,
+PLY nx/ny/nz) as directions. Everything else is copied unchanged. Matrices
+use the mesh_align_core convention.
+"""
+import os
+import shutil
+import struct
+
+import numpy as np
+
+import mesh_align_core
+
+
+# Records (binary) or lines (ASCII) processed per chunk
+CHUNK_SIZE = 1 << 18
+
+STL_HEADER_SIZE = 84
+STL_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attributes', '<u2')])
+
+_PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+
+def mesh_format(path):
+    """'stl', 'stl-ascii', 'obj' or 'ply' for a mesh file path"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.stl':
+        return 'stl' if _is_binary_stl(path) else 'stl-ascii'
+    if extension in ('.obj', '.ply'):
+        return extension[1:]
+    raise ValueError('Unsupported mesh file type: {}'.format(path))
+
+
+def transform_file(src_path, dst_path, matrix, chunk_size=CHUNK_SIZE):
+    """Write src_path transformed by matrix to dst_path, streaming in chunks
+
+    dst_path may be the same as src_path to transform a file in place
+    (binary formats only). Returns the number of transformed vertices.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    file_format = mesh_format(src_path)
+    in_place = os.path.exists(dst_path) and os.path.samefile(src_path, dst_path)
+    if file_format == 'stl':
+        return _transform_binary_stl(src_path, dst_path, matrix, chunk_size, in_place)
+    if file_format == 'ply':
+        header = _read_ply_header(src_path)
+        if header['format'] != 'ascii':
+            return _transform_binary_ply(src_path, dst_path, matrix, header, chunk_size, in_place)
+    if in_place:
+        raise ValueError('ASCII mesh files cannot be transformed in place')
+    if file_format == 'stl-ascii':
+        return _transform_text(src_path, dst_path, matrix, _stl_fields, chunk_size)
+    if file_format == 'obj':
+        return _transform_text(src_path, dst_path, matrix, _obj_fields, chunk_size)
+    return _transform_text(src_path, dst_path, matrix, _ply_fields(header), chunk_size, header['size'])
+
+
+def read_mesh(path):
+    """Load (vertices, triangles) from a mesh file
+
+    STL corners are merged into shared vertices so vertex normals are
+    meaningful. Polygons are fan-triangulated. Meant for reference meshes;
+    the streaming functions above never load a whole file.
+    """
+    file_format = mesh_format(path)
+    if file_format == 'stl':
+        corners = _map_binary_stl(path)['vertices'].reshape(-1, 3)
+        return _merge_corners(np.asarray(corners, dtype=np.float64))
+    if file_format == 'stl-ascii':
+        with open(path) as f:
+            corners = [line.split()[1:4] for line in f if line.lstrip().startswith('vertex')]
+        return _merge_corners(np.array(corners, dtype=np.float64).reshape(-1, 3))
+    if file_format == 'obj':
+        return _read_obj(path)
+    return _read_ply(path)
+
+
+def sample_vertices(path, count, seed=0):
+    """Up to count vertices drawn from a mesh file without loading it all
+
+    Binary STL samples straight from the memory map; other formats read the
+    vertex coordinates only.
+    """
+    rng = np.random.default_rng(seed)
+    if mesh_format(path) == 'stl':
+        records = _map_binary_stl(path)
+        total = len(records) * 3
+        picks = np.sort(rng.choice(total, min(count, total), replace=False))
+        return np.asarray(records['vertices'][picks // 3, picks % 3], dtype=np.float64)
+    vertices = read_mesh(path)[0]
+    if len(vertices) <= count:
+        return vertices
+    return vertices[np.sort(rng.choice(len(vertices), count, replace=False))]
+
+
+def read_bounds(path, chunk_size=CHUNK_SIZE):
+    """Min xyz + max xyz of the vertices of a mesh file
+
+    Binary STL is scanned through the memory map in chunks; other formats
+    read the vertex coordinates only.
+    """
+    if mesh_format(path) == 'stl':
+        records = _map_binary_stl(path)
+        low, high = np.full(3, np.inf), np.full(3, -np.inf)
+        for start in range(0, len(records), chunk_size):
+            corners = records['vertices'][start:start + chunk_size].reshape(-1, 3)
+            low = np.minimum(low, corners.min(axis=0))
+            high = np.maximum(high, corners.max(axis=0))
+        return np.concatenate([low, high])
+    vertices = read_mesh(path)[0]
+    return np.concatenate([vertices.min(axis=0), vertices.max(axis=0)])
+
+
+def _is_binary_stl(path):
+    size = os.path.getsize(path)
+    if size < STL_HEADER_SIZE:
+        return False
+    with open(path, 'rb') as f:
+        f.seek(80)
+        count = struct.unpack('<I', f.read(4))[0]
+    # ASCII files may also start with "solid", so trust the size check
+    return size == STL_HEADER_SIZE + count * STL_DTYPE.itemsize
+
+
+def _map_binary_stl(path, mode='r'):
+    count = (os.path.getsize(path) - STL_HEADER_SIZE) // STL_DTYPE.itemsize
+    return np.memmap(path, dtype=STL_DTYPE, mode=mode, offset=STL_HEADER_SIZE, shape=(count,))
+
+
+def _transform_binary_stl(src_path, dst_path, matrix, chunk_size, in_place):
+    src = _map_binary_stl(src_path, 'r+' if in_place else 'r')
+    if in_place:
+        dst = src
+    else:
+        with open(src_path, 'rb') as f:
+            header = f.read(STL_HEADER_SIZE)
+        with open(dst_path, 'wb') as f:
+            f.write(header)
+            f.truncate(STL_HEADER_SIZE + len(src) * STL_DTYPE.itemsize)
+        dst = _map_binary_stl(dst_path, 'r+')
+    for start in range(0, len(src), chunk_size):
+        block = src[start:start + chunk_size]
+        out = dst[start:start + chunk_size]
+        out['vertices'] = mesh_align_core.transform_points(matrix, block['vertices'])
+        out['normal'] = mesh_align_core.transform_vectors(matrix, block['normal'])
+        if not in_place:
+            out['attributes'] = block['attributes']
+    dst.flush()
+    return len(src) * 3
+
+
+def _read_ply_header(path):
+    """Parse a PLY header into format, header byte size and element list"""
+    elements = []
+    file_format = None
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError('{} is not a PLY file'.format(path))
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError('{} has no end_header line'.format(path))
+            tokens = line.decode('ascii', 'replace').split()
+            if not tokens or tokens[0] in ('comment', 'obj_info'):
+                continue
+            if tokens[0] == 'end_header':
+                break
+            if tokens[0] == 'format':
+                file_format = tokens[1]
+            elif tokens[0] == 'element':
+                elements.append({'name': tokens[1], 'count': int(tokens[2]), 'properties': []})
+            elif tokens[0] == 'property':
+                if tokens[1] == 'list':
+                    elements[-1]['properties'].append((tokens[4], 'list', tokens[2], tokens[3]))
+                else:
+                    elements[-1]['properties'].append((tokens[2], tokens[1]))
+        size = f.tell()
+    return {'format': file_format, 'size': size, 'elements': elements}
+
+
+def _ply_vertex_dtype(element, endian):
+    """Structured dtype of a fixed-size PLY element, or None if it has list properties"""
+    if any(len(p) != 2 for p in element['properties']):
+        return None
+    return np.dtype([(name, endian + _PLY_TYPES[kind]) for name, kind in element['properties']])
+
+
+def _map_binary_ply_vertices(path, header, mode='r'):
+    """Memory map of the binary PLY vertex element"""
+    endian = '<' if header['format'] == 'binary_little_endian' else '>'
+    offset = header['size']
+    for element in header['elements']:
+        dtype = _ply_vertex_dtype(element, endian)
+        if element['name'] == 'vertex':
+            if dtype is None:
+                raise ValueError('PLY vertex element with list properties is not supported')
+            return np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(element['count'],))
+        if dtype is None:
+            raise ValueError('PLY elements with list properties before the vertices are not supported')
+        offset += dtype.itemsize * element['count']
+    raise ValueError('{} has no vertex element'.format(path))
+
+
+def _transform_binary_ply(src_path, dst_path, matrix, header, chunk_size, in_place):
+    # Copy the file as-is (streamed), then rewrite only the vertex block in place
+    if not in_place:
+        shutil.copyfile(src_path, dst_path)
+    src = _map_binary_ply_vertices(src_path, header, 'r')
+    dst = _map_binary_ply_vertices(dst_path, header, 'r+')
+    names = dst.dtype.names
+    groups = [(axes, points) for axes, points in ((('x', 'y', 'z'), True), (('nx', 'ny', 'nz'), False))
+              if all(a in names for a in axes)]
+    for start in range(0, len(src), chunk_size):
+        block = src[start:start + chunk_size]
+        out = dst[start:start + chunk_size]
+        for axes, points in groups:
+            values = np.stack([block[a] for a in axes], axis=-1).astype(np.float64)
+            if points:
+                values = mesh_align_core.transform_points(matrix, values)
+            else:
+                values = mesh_align_core.transform_vectors(matrix, values)
+            for k, a in enumerate(axes):
+                out[a] = values[:, k]
+    dst.flush()
+    return len(src)
+
+
+def _stl_fields(index, tokens):
+    """Coordinate fields of an ASCII STL line as (is_point, token indices)"""
+    if tokens[:1] == ['vertex']:
+        return [(True, (1, 2, 3))]
+    if tokens[:2] == ['facet', 'normal']:
+        return [(False, (2, 3, 4))]
+    return ()
+
+
+def _obj_fields(index, tokens):
+    if tokens[:1] == ['v']:
+        return [(True, (1, 2, 3))]
+    if tokens[:1] == ['vn']:
+        return [(False, (1, 2, 3))]
+    return ()
+
+
+def _ply_fields(header):
+    """Field function for ASCII PLY body lines: vertex lines follow the earlier elements"""
+    first = 0
+    vertex = None
+    for element in header['elements']:
+        if element['name'] == 'vertex':
+            vertex = element
+            break
+        first += element['count']
+    if vertex is None:
+        raise ValueError('PLY file has no vertex element')
+    names = [p[0] for p in vertex['properties']]
+    fields = []
+    for axes, points in ((('x', 'y', 'z'), True), (('nx', 'ny', 'nz'), False)):
+        if all(a in names for a in axes):
+            fields.append((points, tuple(names.index(a) for a in axes)))
+    last = first + vertex['count']
+
+    def ply_fields(index, tokens):
+        return fields if first <= index < last else ()
+    return ply_fields
+
+
+def _transform_text(src_path, dst_path, matrix, fields, chunk_size, header_size=0):
+    """Rewrite a text mesh file, transforming the fields picked by fields(line_index, tokens)"""
+    count = 0
+    # newline='' keeps the file's own line endings
+    with open(src_path, newline='') as src, open(dst_path, 'w', newline='') as dst:
+        if header_size:
+            dst.write(src.read(header_size))
+        index = 0
+        while True:
+            lines = src.readlines(chunk_size * 64)
+            if not lines:
+                break
+            count += _transform_lines(lines, index, matrix, fields)
+            index += len(lines)
+            dst.writelines(lines)
+    return count
+
+
+def _transform_lines(lines, first_index, matrix, fields):
+    """Transform the coordinate fields of a batch of lines in place; returns the point count"""
+    edits = []
+    values = {True: [], False: []}
+    for offset, line in enumerate(lines):
+        tokens = line.split()
+        picked = fields(first_index + offset, tokens)
+        if picked:
+            edits.append((offset, tokens, picked))
+            for points, indices in picked:
+                values[points].append([float(tokens[i]) for i in indices])
+    if not edits:
+        return 0
+    moved = {
+        True: mesh_align_core.transform_points(matrix, np.array(values[True]).reshape(-1, 3)),
+        False: mesh_align_core.transform_vectors(matrix, np.array(values[False]).reshape(-1, 3)),
+    }
+    cursor = {True: 0, False: 0}
+    for offset, tokens, picked in edits:
+        for points, indices in picked:
+            row = moved[points][cursor[points]]
+            cursor[points] += 1
+            for k, i in enumerate(indices):
+                tokens[i] = '%.9g' % row[k]
+        line = lines[offset]
+        indent = line[:len(line) - len(line.lstrip())]
+        ending = line[len(line.rstrip('\r\n')):]
+        lines[offset] = indent + ' '.join(tokens) + ending
+    return cursor[True]
+
+
+def _merge_corners(corners):
+    """Shared vertices and triangles from an (3N, 3) array of triangle corners"""
+    vertices, inverse = np.unique(corners, axis=0, return_inverse=True)
+    return vertices, inverse.reshape(-1, 3).astype(np.intp)
+
+
+def _fan(polygons):
+    """Fan-triangulate a list of vertex index lists"""
+    triangles = [(p[0], p[k], p[k + 1]) for p in polygons for k in range(1, len(p) - 1)]
+    return np.array(triangles, dtype=np.intp).reshape(-1, 3)
+
+
+def _read_obj(path):
+    vertices = []
+    polygons = []
+    with open(path) as f:
+        for line in f:
+            tokens = line.split()
+            if not tokens:
+                continue
+            if tokens[0] == 'v':
+                vertices.append(tokens[1:4])
+            elif tokens[0] == 'f':
+                # OBJ indices are 1-based; negative indices count back from the last vertex
+                polygon = [int(t.split('/')[0]) for t in tokens[1:]]
+                polygons.append([i - 1 if i > 0 else len(vertices) + i for i in polygon])
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3), _fan(polygons)
+
+
+def _read_ply(path):
+    header = _read_ply_header(path)
+    names = [e['name'] for e in header['elements']]
+    if header['format'] != 'ascii':
+        mapped = _map_binary_ply_vertices(path, header)
+        vertices = np.stack([mapped[a] for a in ('x', 'y', 'z')], axis=-1).astype(np.float64)
+        polygons = _read_binary_ply_faces(path, header) if 'face' in names else []
+        return vertices, _fan(polygons)
+
+    vertices = []
+    polygons = []
+    with open(path, 'rb') as f:
+        f.seek(header['size'])
+        for element in header['elements']:
+            if element['name'] == 'vertex':
+                columns = [p[0] for p in element['properties']]
+                xyz = [columns.index(a) for a in ('x', 'y', 'z')]
+                for _ in range(element['count']):
+                    tokens = f.readline().split()
+                    vertices.append([float(tokens[i]) for i in xyz])
+            elif element['name'] == 'face':
+                for _ in range(element['count']):
+                    tokens = f.readline().split()
+                    polygons.append([int(t) for t in tokens[1:1 + int(tokens[0])]])
+            else:
+                for _ in range(element['count']):
+                    f.readline()
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3), _fan(polygons)
+
+
+def _read_binary_ply_faces(path, header):
+    """Vertex index lists of the binary PLY face element (vertex_indices list)"""
+    endian = '<' if header['format'] == 'binary_little_endian' else '>'
+    offset = header['size']
+    for element in header['elements']:
+        if element['name'] == 'face':
+            break
+        dtype = _ply_vertex_dtype(element, endian)
+        if dtype is None:
+            raise ValueError('PLY elements with list properties before the faces are not supported')
+        offset += dtype.itemsize * element['count']
+    properties = element['properties']
+    if len(properties) != 1 or properties[0][1] != 'list':
+        raise ValueError('Only PLY faces with a single vertex index list are supported')
+    count_type = np.dtype(endian + _PLY_TYPES[properties[0][2]])
+    index_type = np.dtype(endian + _PLY_TYPES[properties[0][3]])
+
+    # Fast path: all triangles, which makes every face record the same size
+    data = np.memmap(path, dtype=np.uint8, mode='r', offset=offset)
+    triangle = np.dtype([('n', count_type), ('i', index_type, (3,))])
+    if len(data) >= triangle.itemsize * element['count']:
+        faces = np.frombuffer(data[:triangle.itemsize * element['count']].tobytes(), dtype=triangle)
+        if np.all(faces['n'] == 3):
+            return faces['i'].astype(np.intp).tolist()
+
+    polygons = []
+    position = 0
+    for _ in range(element['count']):
+        n = int(np.frombuffer(data[position:position + count_type.itemsize].tobytes(), dtype=count_type)[0])
+        position += count_type.itemsize
+        end = position + n * index_type.itemsize
+        polygons.append(np.frombuffer(data[position:end].tobytes(), dtype=index_type).tolist())
+        position = end
+    return polygons
@@ -0,0 +1,141 @@
+"""Background jobs for the mesh align plugin.
+
+Fusion's API may only be used from the main thread. The plugin therefore
+reads the geometry there and hands the pure NumPy work (fitting, scoring) to
+a worker thread. When the job reports back, the result is applied on the
+main thread. The job reports through a notify callable (in Fusion, a custom
+event), so this module does not depend on Fusion.
+
+Jobs run on threads rather than processes. NumPy and SciPy release the GIL
+in the heavy loops, and Fusion's embedded interpreter cannot reliably spawn
+worker processes.
+"""
+import concurrent.futures
+import itertools
+import threading
+import time
+import traceback
+
+
+# Progress is reported at most this often (seconds) so a fast loop does not
+# flood the main thread with events
+PROGRESS_INTERVAL = 0.1
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# Job ids are unique per process, so a late event from a runner that was shut
+# down never matches a job of the next one
+_job_ids = itertools.count(1)
+
+
+class Cancelled(Exception):
+    """Raised inside a job's work when the job was cancelled"""
+
+
+class Job(object):
+    """One unit of background work, with progress and cancellation
+
+    The work calls checkpoint() between steps. That records the progress
+    and raises Cancelled once cancel() was called. A Job that is never
+    submitted (the synchronous path) works the same way, with no notify.
+    """
+
+    def __init__(self, label='', job_id=0, notify=None):
+        self.id = job_id
+        self.label = label
+        self.state = QUEUED
+        self.progress = 0.0
+        self.message = ''
+        self.result = None
+        self.error = None
+        self._notify = notify
+        self._cancel = threading.Event()
+        self._last_report = 0.0
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED, CANCELLED)
+
+    def checkpoint(self, progress=None, message=None):
+        """Record progress (0..1) and stop the work if the job was cancelled"""
+        if self._cancel.is_set():
+            raise Cancelled()
+        if progress is not None:
+            self.progress = float(progress)
+        if message is not None:
+            self.message = message
+        now = time.perf_counter()
+        if self._notify and now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self._notify(self, 'progress')
+
+    def run(self, work, *args):
+        """Run work(job, *args), recording its result, error or cancellation"""
+        self.state = RUNNING
+        try:
+            self.result = work(self, *args)
+            self.state = CANCELLED if self._cancel.is_set() else DONE
+        except Cancelled:
+            self.state = CANCELLED
+        except Exception:
+            self.error = traceback.format_exc()
+            self.state = FAILED
+        if self._notify:
+            self._notify(self, 'finished')
+        return self
+
+
+class JobRunner(object):
+    """Runs jobs on a pool of worker threads
+
+    notify(job, event) is called from the worker thread with event 'progress'
+    or 'finished'; it should only hand the job id to the main thread. There
+    the job is looked up (and, once finished, removed) with pop().
+    """
+
+    def __init__(self, notify, max_workers=1):
+        self._notify = notify
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='mesh_align')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, label, work, *args):
+        """Queue work(job, *args) and return its Job"""
+        job = Job(label, next(_job_ids), self._notify)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(job.run, work, *args)
+        return job
+
+    def pop(self, job_id):
+        """The job with job_id, removed from the runner if it has finished"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.finished:
+                del self._jobs[job_id]
+            return job
+
+    def active(self):
+        """Jobs that are queued or running"""
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.finished]
+
+    def cancel_all(self):
+        for job in self.active():
+            job.cancel()
+
+    def shutdown(self, wait=False):
+        self.cancel_all()
+        self._executor.shutdown(wait=wait)
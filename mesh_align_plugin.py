@@ -1,4 +1,106 @@
 ﻿import adsk.core, adsk.fusion, traceback
+import collections, json, os, sys, threading
+
+# Make the sibling pure-Python modules importable from inside Fusion
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if _SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, _SCRIPT_DIR)
+
+import numpy as np
+import mesh_align_core
+import mesh_align_fit
+import mesh_align_jobs
+import mesh_align_posegraph
+import mesh_align_quality
+import mesh_align_recipes
+import mesh_align_sampling
+import mesh_align_symmetry
+import mesh_align_trace
+from mesh_align_profile import PROFILER
+from mesh_align_spatial import TriangleBVH
+
+# Debug trace (JSON Lines, appended per run) written next to the script
+TRACE_FILE_NAME = 'mesh_align_trace.jsonl'
+
+# Per-phase timing statistics written next to the script when profiling is on
+PROFILE_FILE_NAMES = ('mesh_align_profile.csv', 'mesh_align_profile.json')
+
+# Alignment modes offered in the dialog
+MODE_PLANES = 'Planes'
+MODE_BEST_FIT = 'Best Fit (ICP)'
+MODE_COARSE = 'Coarse + Best Fit'
+MODE_CHAIN = 'Chain (Pose Graph)'
+MODE_REPLAY = 'Replay Recipes'
+
+# How the computed transform is applied to the meshes
+APPLY_MOVE_FEATURE = 'Move Feature'
+APPLY_OCCURRENCE = 'Occurrence Transform'
+
+# Number of mesh vertices fed to the best-fit solver
+BEST_FIT_SAMPLE_COUNT = 20000
+
+# Default radius of the mesh region used to fit a picked source plane, and
+# the number of region vertices the plane is fitted to
+DEFAULT_FIT_RADIUS = '5 mm'
+PLANE_FIT_SAMPLE_COUNT = 20000
+
+# How vertex samples for fitting, scoring and preview are drawn:
+# mesh_align_sampling.VOXEL (even coverage) or RANDOM (follows scan density)
+SAMPLING_METHOD = mesh_align_sampling.VOXEL
+
+# Vertices of a reference body indexed for best fit and auto orient; the
+# deviation check and region picking use a TriangleBVH of the full mesh
+REFERENCE_SAMPLE_COUNT = 200000
+
+# Number of bodies whose full float32 vertex buffers are kept in memory
+MESH_CACHE_SIZE = 4
+
+# Preview proxy: triangle budget per mesh and RGBA color
+PREVIEW_TRIANGLE_BUDGET = 20000
+PREVIEW_COLOR = (0, 160, 255, 128)
+
+# Number of computed transforms/fitted planes kept in memory, keyed on the selection set
+ALIGNMENT_CACHE_SIZE = 64
+
+# Deviation check: default tolerance, vertices sampled per run and, when
+# checking against target planes, the band (as a multiple of the tolerance)
+# within which vertices count as lying on a plane. A closest-point query
+# costs some 20 us, so the sample keeps the check to a fraction of a
+# second; it is plenty for the 95th percentile the check is judged on
+DEFAULT_QUALITY_TOLERANCE = '0.5 mm'
+QUALITY_SAMPLE_COUNT = 20000
+QUALITY_PLANE_BAND_FACTOR = 5.0
+
+# Chain mode links two bodies by a best fit when at least CHAIN_MIN_OVERLAP of
+# the fitted vertex sample ends up within CHAIN_CONTACT_DISTANCE (cm) of the
+# other body's vertices; keep the distance above the scan's vertex spacing.
+# Fragments only partly overlap, so the fit pairs vertices no further apart
+# than CHAIN_SEARCH_DISTANCE at first (about how far a fragment may start
+# from its place) and halves that down to the contact distance.
+CHAIN_CONTACT_DISTANCE = 0.1
+CHAIN_SEARCH_DISTANCE = 1.0
+CHAIN_MIN_OVERLAP = 0.05
+
+# Vertices sampled to score the candidate orientations in auto-orient mode
+ORIENT_SAMPLE_COUNT = 5000
+
+# Vertices sampled to detect a mesh's symmetry plane, and the name of the
+# construction plane created on it
+SYMMETRY_SAMPLE_COUNT = 5000
+SYMMETRY_PLANE_NAME = 'Symmetry Plane'
+
+# Recorded alignments (one JSON file per input geometry) kept next to the script
+RECIPE_FOLDER_NAME = 'recipes'
+
+# How far (internal units, cm) a body's bounding box may be from the recorded
+# one for a recipe to be replayed onto it
+RECIPE_MATCH_TOLERANCE = 0.2
+
+# Custom event through which background jobs report to the main thread, and
+# the toolbar button (in the Scripts and Add-Ins panel) that cancels them
+JOB_EVENT_ID = 'MeshAlignJobEvent'
+CANCEL_COMMAND_ID = 'MeshAlignCancel'
+CANCEL_PANEL_ID = 'SolidScriptsAddinsPanel'
 
 def run(context):
     ui = None
@@ -31,6 +133,26 @@ def run(context):
         cmdDef.commandCreated.add(onCommandCreated)
         handlers.append(onCommandCreated)
         
+        # Background jobs report back through a custom event, handled on the main thread
+        app.unregisterCustomEvent(JOB_EVENT_ID)
+        jobEvent = app.registerCustomEvent(JOB_EVENT_ID)
+        onJobEvent = MeshAlignJobEventHandler()
+        jobEvent.add(onJobEvent)
+        handlers.append(onJobEvent)
+        
+        # Command behind the cancel button shown while background jobs run
+        cancelDef = cmdDefs.itemById(CANCEL_COMMAND_ID)
+        if cancelDef:
+            cancelDef.deleteMe()
+        cancelDef = cmdDefs.addButtonDefinition(
+            CANCEL_COMMAND_ID,
+            'Cancel Mesh Alignment',
+            'Stop the mesh alignments running in the background. Nothing is changed.'
+        )
+        onCancelCreated = MeshAlignCancelCommandCreatedHandler()
+        cancelDef.commandCreated.add(onCancelCreated)
+        handlers.append(onCancelCreated)
+        
         # Execute the command
         cmdDef.execute()
         
@@ -45,16 +167,32 @@ def run(context):
 # Global list to keep handlers referenced for the duration of the command
 handlers = []
 
+# Memoized transforms, fitted planes and preview proxies shared by preview and execute
+_alignment_cache = {}
+_preview_proxy_cache = {}
+_mesh_cache = collections.OrderedDict()
+_preview_group = None
+_cache_lock = threading.Lock()
+_recipe_store = mesh_align_recipes.RecipeStore(os.path.join(_SCRIPT_DIR, RECIPE_FOLDER_NAME))
+
+# Background jobs and, per job id, the (finish, ui) to run when it reports back.
+# The script stays loaded while the dialog is open or a job is pending.
+_job_runner = None
+_job_finishers = {}
+_dialog_open = False
+
 
 class MeshAlignCommandCreatedHandler(adsk.core.CommandCreatedEventHandler):
     def __init__(self):
         super().__init__()
         
     def notify(self, args):
+        global _dialog_open
         ui = None
         try:
             app = adsk.core.Application.get()
             ui = app.userInterface
+            _dialog_open = True
             
             eventArgs = adsk.core.CommandCreatedEventArgs.cast(args)
             cmd = eventArgs.command
@@ -64,6 +202,11 @@ class MeshAlignCommandCreatedHandler(adsk.core.CommandCreatedEventHandler):
             cmd.execute.add(onExecute)
             handlers.append(onExecute)
             
+            # Connect to the preview event (draws custom graphics, never features)
+            onExecutePreview = MeshAlignCommandExecutePreviewHandler()
+            cmd.executePreview.add(onExecutePreview)
+            handlers.append(onExecutePreview)
+            
             # Connect to the destroy event
             onDestroy = MeshAlignCommandDestroyHandler()
             cmd.destroy.add(onDestroy)
@@ -77,24 +220,53 @@ class MeshAlignCommandCreatedHandler(adsk.core.CommandCreatedEventHandler):
             # Get the command inputs
             inputs = cmd.commandInputs
             
-            # Add mesh body selection
-            meshSel = inputs.addSelectionInput('meshSelection', 'Mesh Body', 'Select the mesh body to align')
+            # Add mesh body selection (any number of bodies sharing the same planes)
+            meshSel = inputs.addSelectionInput('meshSelection', 'Mesh Bodies', 'Select the mesh bodies to align')
             meshSel.addSelectionFilter('MeshBodies')
-            meshSel.setSelectionLimits(1, 1)
+            meshSel.setSelectionLimits(1, 0)
+            
+            # Add alignment mode: construction planes or best fit onto a reference body,
+            # optionally from a coarse principal-axes pose for meshes in any pose,
+            # or a chain of fragments solved together onto a fixed reference body
+            modeInput = inputs.addDropDownCommandInput('alignMode', 'Alignment Mode', adsk.core.DropDownStyles.TextListDropDownStyle)
+            modeInput.listItems.add(MODE_PLANES, True)
+            modeInput.listItems.add(MODE_BEST_FIT, False)
+            modeInput.listItems.add(MODE_COARSE, False)
+            modeInput.listItems.add(MODE_CHAIN, False)
+            modeInput.listItems.add(MODE_REPLAY, False)
+            
+            # Add reference body selection (best-fit and chain modes only)
+            refSel = inputs.addSelectionInput('referenceBody', 'Reference Body', 'Select the mesh or solid body to fit onto; in chain mode, the body that stays fixed')
+            refSel.addSelectionFilter('MeshBodies')
+            refSel.addSelectionFilter('SolidBodies')
+            refSel.setSelectionLimits(0, 1)
+            refSel.isVisible = False
+            
+            # Add recipe file or folder (replay mode only)
+            recipeInput = inputs.addStringValueInput('recipePath', 'Recipe File or Folder', _recipe_store.folder)
+            recipeInput.isVisible = False
             
             # Add source plane 1 selection
-            src1 = inputs.addSelectionInput('srcPlane1', 'Source Plane 1', 'Select first construction plane on mesh')
+            # Source planes may also be picked directly on the mesh: a plane is
+            # then fitted to the mesh region around the picked point
+            src1 = inputs.addSelectionInput('srcPlane1', 'Source Plane 1', 'Select first construction plane on mesh, or pick a point on a flat mesh region')
             src1.addSelectionFilter('ConstructionPlanes')
-            src1.setSelectionLimits(1, 1)
+            src1.addSelectionFilter('MeshBodies')
+            src1.setSelectionLimits(0, 1)
+            
+            # Add symmetry option: source plane 1 is the detected mirror plane of the
+            # first mesh, created as a construction plane on execute
+            inputs.addBoolValueInput('symmetryPlane', 'Symmetry Plane as Source 1', True, '', False)
             
             # Add target plane 1 selection
             tgt1 = inputs.addSelectionInput('tgtPlane1', 'Target Plane 1', 'Select first target origin plane')
             tgt1.addSelectionFilter('ConstructionPlanes')
-            tgt1.setSelectionLimits(1, 1)
+            tgt1.setSelectionLimits(0, 1)
             
             # Add source plane 2 selection (optional)
-            src2 = inputs.addSelectionInput('srcPlane2', 'Source Plane 2 (Optional)', 'Select second construction plane on mesh')
+            src2 = inputs.addSelectionInput('srcPlane2', 'Source Plane 2 (Optional)', 'Select second construction plane on mesh, or pick a point on a flat mesh region')
             src2.addSelectionFilter('ConstructionPlanes')
+            src2.addSelectionFilter('MeshBodies')
             src2.setSelectionLimits(0, 1)
             
             # Add target plane 2 selection (optional)
@@ -102,17 +274,62 @@ class MeshAlignCommandCreatedHandler(adsk.core.CommandCreatedEventHandler):
             tgt2.addSelectionFilter('ConstructionPlanes')
             tgt2.setSelectionLimits(0, 1)
             
-            # Add preview checkbox
-            # NOTE: preview UI is currently disabled (commented out).
-            # If you want to re-enable Preview Mode later, uncomment the line below.
-            # inputs.addBoolValueInput('previewMode', 'Preview Mode', True, '', False)
+            # Add any number of further plane pairs, paired by selection order.
+            # Three or more pairs are solved together in a least-squares fit.
+            # In chain mode these are the links between fragments, so targets
+            # may also be picked on a mesh.
+            srcExtra = inputs.addSelectionInput('srcPlanesExtra', 'Additional Source Planes', 'Select further source planes, in the same order as their targets')
+            srcExtra.addSelectionFilter('ConstructionPlanes')
+            srcExtra.addSelectionFilter('MeshBodies')
+            srcExtra.setSelectionLimits(0, 0)
+            
+            tgtExtra = inputs.addSelectionInput('tgtPlanesExtra', 'Additional Target Planes', 'Select the matching target planes, or pick on a flat mesh region, in the same order')
+            tgtExtra.addSelectionFilter('ConstructionPlanes')
+            tgtExtra.addSelectionFilter('MeshBodies')
+            tgtExtra.setSelectionLimits(0, 0)
+            
+            # Add chain mode option: link overlapping fragments by best fit as well as by plane pairs
+            chainFit = inputs.addBoolValueInput('chainBestFit', 'Best Fit Overlapping Fragments', True, '', True)
+            chainFit.isVisible = False
+            
+            # Add radius of the mesh region used when a source plane is picked on the mesh
+            inputs.addValueInput('fitRadius', 'Plane Fit Radius', 'mm', adsk.core.ValueInput.createByString(DEFAULT_FIT_RADIUS))
+            
+            # Add preview checkbox (draws a proxy of the aligned mesh, creates no features)
+            inputs.addBoolValueInput('previewMode', 'Preview Mode', True, '', False)
+            
+            # Add deviation check: measures the aligned meshes against a reference
+            # body (default: the best-fit reference) or the target planes.
+            # The reference body is also what auto orient scores against.
+            inputs.addBoolValueInput('checkQuality', 'Check Deviation', True, '', False)
+            qualityRef = inputs.addSelectionInput('qualityReference', 'Compare Body', 'Select the body to measure against or orient onto (optional)')
+            qualityRef.addSelectionFilter('MeshBodies')
+            qualityRef.addSelectionFilter('SolidBodies')
+            qualityRef.setSelectionLimits(0, 1)
+            qualityRef.isVisible = False
+            qualityTol = inputs.addValueInput('qualityTolerance', 'Deviation Tolerance', 'mm', adsk.core.ValueInput.createByString(DEFAULT_QUALITY_TOLERANCE))
+            qualityTol.isVisible = False
+            
+            # Add recipe checkbox (records each applied alignment for later replay)
+            inputs.addBoolValueInput('recordRecipe', 'Save Recipe', True, '', False)
             
             # Add debug output checkbox
             inputs.addBoolValueInput('debugMode', 'Show Debug Info', True, '', False)
             
+            # Add profiling checkbox (also enabled by the MESH_ALIGN_PROFILE environment variable)
+            inputs.addBoolValueInput('profileMode', 'Profile Timings', True, '', PROFILER.enabled)
+            
             # Add flip direction checkbox
             inputs.addBoolValueInput('flipDirection', 'Flip 180° on Plane 1', True, '', False)
             
+            # Add auto orient checkbox (tries the flipped and spun poses on plane 1 and keeps the best)
+            inputs.addBoolValueInput('autoOrient', 'Auto Orient', True, '', False)
+            
+            # Add apply mode: a mesh MoveFeature, or the transform of the body's occurrence
+            applyInput = inputs.addDropDownCommandInput('applyMode', 'Apply As', adsk.core.DropDownStyles.TextListDropDownStyle)
+            applyInput.listItems.add(APPLY_MOVE_FEATURE, True)
+            applyInput.listItems.add(APPLY_OCCURRENCE, False)
+            
             # Show a brief usage message before the user selects planes — only on first run
             try:
                 import os
@@ -123,7 +340,7 @@ class MeshAlignCommandCreatedHandler(adsk.core.CommandCreatedEventHandler):
                         'How to use this tool:\n\n'
                         '- Direct Edit Mesh\n'
                         "- Create Plane Through 3 Points (Create more if needed)\n\n"
-                        'Select the mesh and then the source/target planes as prompted.',
+                        'Select one or more meshes and then the source/target planes as prompted.',
                         'Mesh Align - Usage'
                     )
                     try:
@@ -151,13 +368,13 @@ class MeshAlignInputChangedHandler(adsk.core.InputChangedEventHandler):
             changedInput = eventArgs.input
             inputs = eventArgs.inputs
             
-            # Auto-advance to next selection when current one is filled
-            if changedInput.id == 'meshSelection':
-                meshSel = inputs.itemById('meshSelection')
-                if meshSel.selectionCount > 0:
-                    src1 = inputs.itemById('srcPlane1')
-                    src1.hasFocus = True
-                    
+            # Show only the inputs used by the selected alignment mode and options
+            if changedInput.id in ('alignMode', 'checkQuality', 'autoOrient', 'symmetryPlane'):
+                _update_input_visibility(inputs)
+            
+            # Auto-advance to next selection when current one is filled.
+            # meshSelection accepts several bodies, so focus stays there until
+            # the user moves on to the planes.
             elif changedInput.id == 'srcPlane1':
                 src1 = inputs.itemById('srcPlane1')
                 if src1.selectionCount > 0:
@@ -176,6 +393,11 @@ class MeshAlignInputChangedHandler(adsk.core.InputChangedEventHandler):
                     tgt2 = inputs.itemById('tgtPlane2')
                     tgt2.hasFocus = True
                     
+            elif changedInput.id == 'tgtPlane2':
+                tgt2 = inputs.itemById('tgtPlane2')
+                if tgt2.selectionCount > 0:
+                    inputs.itemById('srcPlanesExtra').hasFocus = True
+                    
         except:
             pass
 
@@ -190,330 +412,1725 @@ class MeshAlignCommandExecuteHandler(adsk.core.CommandEventHandler):
             app = adsk.core.Application.get()
             ui = app.userInterface
             
+            # The preview proxy is never part of the result
+            _clear_preview()
+            
             eventArgs = adsk.core.CommandEventArgs.cast(args)
             inputs = eventArgs.command.commandInputs
             
-            # Get the mesh selection
-            meshSel = inputs.itemById('meshSelection')
-            if meshSel.selectionCount == 0:
-                ui.messageBox('Please select a mesh body.')
-                return
-            mesh = adsk.fusion.MeshBody.cast(meshSel.selection(0).entity)
+            PROFILER.enabled = inputs.itemById('profileMode').value
+            with PROFILER.span('execute'):
+                options, error = _read_alignment_inputs(inputs)
+                if error:
+                    ui.messageBox(error)
+                    return
+                
+                # Perform the alignment. The math runs in the background and the
+                # result is applied when it is done, so the UI stays responsive.
+                if options['mode'] == MODE_REPLAY:
+                    replay_recipes(options['recipe_path'], ui, options['meshes'], options['debug_mode'])
+                elif options['mode'] in (MODE_BEST_FIT, MODE_COARSE):
+                    perform_best_fit_alignment(options['meshes'], options['reference'], ui, options['debug_mode'],
+                                               apply_mode=options['apply_mode'],
+                                               record_recipe=options['record_recipe'],
+                                               quality=options['quality'], background=True,
+                                               coarse=options['mode'] == MODE_COARSE)
+                elif options['mode'] == MODE_CHAIN:
+                    perform_chain_alignment(options['meshes'], options['reference'], ui,
+                                            options['plane_constraints'], options['chain_best_fit'],
+                                            options['debug_mode'], apply_mode=options['apply_mode'],
+                                            record_recipe=options['record_recipe'], background=True)
+                else:
+                    # Keep a detected symmetry plane in the design; it is the source plane from now on
+                    perform_alignment(options['meshes'], options['src_plane1'], options['tgt_plane1'],
+                                      options['src_plane2'], options['tgt_plane2'], ui,
+                                      False, options['debug_mode'], options['flip_direction'],
+                                      options['apply_mode'], options['extra_plane_pairs'],
+                                      options['record_recipe'], options['quality'],
+                                      options['auto_orient'], options['orient_reference'], background=True,
+                                      source_plane_name=SYMMETRY_PLANE_NAME if options['symmetry'] else None)
+            _export_profile(ui)
             
-            # Get the first pair of planes
-            src1Sel = inputs.itemById('srcPlane1')
-            tgt1Sel = inputs.itemById('tgtPlane1')
+        except:
+            if ui:
+                ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
+class MeshAlignCommandExecutePreviewHandler(adsk.core.CommandEventHandler):
+    def __init__(self):
+        super().__init__()
+        
+    def notify(self, args):
+        try:
+            eventArgs = adsk.core.CommandEventArgs.cast(args)
+            inputs = eventArgs.command.commandInputs
+            _clear_preview()
             
-            if src1Sel.selectionCount == 0 or tgt1Sel.selectionCount == 0:
-                ui.messageBox('Please select both source and target planes for the first alignment.')
+            previewInput = inputs.itemById('previewMode')
+            if not previewInput or not previewInput.value:
                 return
             
-            src_plane1 = adsk.fusion.ConstructionPlane.cast(src1Sel.selection(0).entity)
-            tgt_plane1 = adsk.fusion.ConstructionPlane.cast(tgt1Sel.selection(0).entity)
-            
-            # Get the optional second pair of planes
-            src2Sel = inputs.itemById('srcPlane2')
-            tgt2Sel = inputs.itemById('tgtPlane2')
-            
-            src_plane2 = None
-            tgt_plane2 = None
-            
-            if src2Sel.selectionCount > 0 and tgt2Sel.selectionCount > 0:
-                src_plane2 = adsk.fusion.ConstructionPlane.cast(src2Sel.selection(0).entity)
-                tgt_plane2 = adsk.fusion.ConstructionPlane.cast(tgt2Sel.selection(0).entity)
-            
-            # Preview mode input removed from UI; default to False.
-            # If you re-enable the UI input above, restore these two lines:
-            # previewInput = inputs.itemById('previewMode')
-            # preview_mode = previewInput.value
-            preview_mode = False
+            # Incomplete selections simply show no preview
+            options, error = _read_alignment_inputs(inputs)
+            if error or options['mode'] == MODE_REPLAY:
+                return
             
-            # Get debug mode checkbox
-            debugInput = inputs.itemById('debugMode')
-            debug_mode = debugInput.value
+            if options['mode'] in (MODE_BEST_FIT, MODE_COARSE):
+                perform_best_fit_alignment(options['meshes'], options['reference'], None, preview_mode=True,
+                                           coarse=options['mode'] == MODE_COARSE)
+            elif options['mode'] == MODE_CHAIN:
+                perform_chain_alignment(options['meshes'], options['reference'], None,
+                                        options['plane_constraints'], options['chain_best_fit'], preview_mode=True)
+            else:
+                perform_alignment(options['meshes'], options['src_plane1'], options['tgt_plane1'],
+                                  options['src_plane2'], options['tgt_plane2'], None,
+                                  True, False, options['flip_direction'],
+                                  extra_plane_pairs=options['extra_plane_pairs'],
+                                  auto_orient=options['auto_orient'],
+                                  orient_reference=options['orient_reference'])
             
-            # Get flip direction checkbox
-            flipInput = inputs.itemById('flipDirection')
-            flip_direction = flipInput.value
+            # The custom graphics are only a preview; let execute build the real result
+            eventArgs.isValidResult = False
             
-            # Perform the alignment
-            perform_alignment(mesh, src_plane1, tgt_plane1, src_plane2, tgt_plane2, ui, preview_mode, debug_mode, flip_direction)
+        except:
+            # Preview is best effort; execute reports real errors
+            _clear_preview()
+
+
+class MeshAlignCommandDestroyHandler(adsk.core.CommandEventHandler):
+    def __init__(self):
+        super().__init__()
+        
+    def notify(self, args):
+        global _dialog_open
+        _clear_preview()
+        _preview_proxy_cache.clear()
+        _mesh_cache.clear()
+        _dialog_open = False
+        _terminate_when_idle()
+
+
+class MeshAlignJobEventHandler(adsk.core.CustomEventHandler):
+    def __init__(self):
+        super().__init__()
+        
+    def notify(self, args):
+        ui = None
+        try:
+            ui = adsk.core.Application.get().userInterface
+            info = json.loads(args.additionalInfo)
+            job = _job_runner.pop(info['job']) if _job_runner else None
+            _show_job_progress(ui)
+            # Progress events may still arrive after the job was handled
+            if job is None or not job.finished or job.id not in _job_finishers:
+                return
             
+            # Apply the result on the main thread, the only place the API may be used
+            finish, job_ui = _job_finishers.pop(job.id)
+            if job.state == mesh_align_jobs.DONE:
+                finish(job.result)
+                _export_profile(job_ui)
+            elif job.state == mesh_align_jobs.FAILED:
+                _message(job_ui, 'Failed:\n{}'.format(job.error))
+            else:
+                _message(job_ui, '{} was cancelled. Nothing was changed.'.format(job.label))
+        
         except:
             if ui:
                 ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+        _terminate_when_idle()
 
 
-class MeshAlignCommandDestroyHandler(adsk.core.CommandEventHandler):
+class MeshAlignCancelCommandCreatedHandler(adsk.core.CommandCreatedEventHandler):
     def __init__(self):
         super().__init__()
         
     def notify(self, args):
-        adsk.autoTerminate(True)
+        # Cancel right away; the command has no dialog of its own
+        eventArgs = adsk.core.CommandCreatedEventArgs.cast(args)
+        eventArgs.command.isAutoExecute = True
+        if _job_runner:
+            _job_runner.cancel_all()
+
+
+def _update_input_visibility(inputs):
+    """Show only the dialog inputs used by the selected mode and options"""
+    mode = inputs.itemById('alignMode').selectedItem.name
+    auto_orient = mode == MODE_PLANES and inputs.itemById('autoOrient').value
+    check_quality = mode not in (MODE_REPLAY, MODE_CHAIN) and inputs.itemById('checkQuality').value
+    inputs.itemById('referenceBody').isVisible = mode in (MODE_BEST_FIT, MODE_COARSE, MODE_CHAIN)
+    inputs.itemById('recipePath').isVisible = mode == MODE_REPLAY
+    for input_id in ('tgtPlane1', 'srcPlane2', 'tgtPlane2', 'autoOrient', 'symmetryPlane'):
+        inputs.itemById(input_id).isVisible = mode == MODE_PLANES
+    # A detected symmetry plane replaces source plane 1
+    inputs.itemById('srcPlane1').isVisible = mode == MODE_PLANES and not inputs.itemById('symmetryPlane').value
+    # Chain mode links its fragments with the additional plane pairs
+    for input_id in ('srcPlanesExtra', 'tgtPlanesExtra', 'fitRadius'):
+        inputs.itemById(input_id).isVisible = mode in (MODE_PLANES, MODE_CHAIN)
+    inputs.itemById('chainBestFit').isVisible = mode == MODE_CHAIN
+    for input_id in ('previewMode', 'recordRecipe', 'applyMode'):
+        inputs.itemById(input_id).isVisible = mode != MODE_REPLAY
+    inputs.itemById('checkQuality').isVisible = mode not in (MODE_REPLAY, MODE_CHAIN)
+    # Auto orient chooses the flip itself
+    inputs.itemById('flipDirection').isVisible = mode == MODE_PLANES and not auto_orient
+    inputs.itemById('qualityReference').isVisible = check_quality or auto_orient
+    inputs.itemById('qualityTolerance').isVisible = check_quality
+    # Replay matches bodies across the whole design when none are selected
+    inputs.itemById('meshSelection').setSelectionLimits(0 if mode == MODE_REPLAY else 1, 0)
+
+
+def _read_alignment_inputs(inputs):
+    """Read the dialog inputs shared by execute and preview
+
+    Returns (options, error_message); options is None when the selections are
+    incomplete or invalid. Planes picked on a mesh and the symmetry plane
+    come back as PendingPlanes, fitted later by the alignment job.
+    """
+    # Get the mesh selection
+    meshSel = inputs.itemById('meshSelection')
+    compareSel = inputs.itemById('qualityReference')
+    compare_body = compareSel.selection(0).entity if compareSel.selectionCount else None
+    # Auto orient replaces the manual flip
+    auto_orient = inputs.itemById('autoOrient').value
+    options = {
+        'meshes': [adsk.fusion.MeshBody.cast(meshSel.selection(i).entity)
+                   for i in range(meshSel.selectionCount)],
+        'debug_mode': inputs.itemById('debugMode').value,
+        'flip_direction': inputs.itemById('flipDirection').value and not auto_orient,
+        'auto_orient': auto_orient,
+        'orient_reference': compare_body,
+        'record_recipe': inputs.itemById('recordRecipe').value,
+        'mode': MODE_PLANES,
+        'apply_mode': APPLY_MOVE_FEATURE,
+        'quality': None,
+        'symmetry': False,
+    }
+    
+    modeInput = inputs.itemById('alignMode')
+    mode = modeInput.selectedItem.name if modeInput.selectedItem else MODE_PLANES
+    
+    if inputs.itemById('checkQuality').value and mode != MODE_CHAIN:
+        options['quality'] = {
+            'reference': compare_body,
+            'tolerance': inputs.itemById('qualityTolerance').value,
+        }
+    
+    # Replay mode applies saved recipes; the mesh selection only narrows the candidates
+    if mode == MODE_REPLAY:
+        options['mode'] = MODE_REPLAY
+        options['recipe_path'] = inputs.itemById('recipePath').value.strip()
+        if not options['recipe_path']:
+            return None, 'Please enter a recipe file or folder.'
+        return options, None
+    
+    if not options['meshes']:
+        return None, 'Please select a mesh body.'
+    
+    applyInput = inputs.itemById('applyMode')
+    if applyInput.selectedItem:
+        options['apply_mode'] = applyInput.selectedItem.name
+    
+    # Best-fit modes register the meshes onto a reference body instead of using planes
+    if mode in (MODE_BEST_FIT, MODE_COARSE):
+        refSel = inputs.itemById('referenceBody')
+        if refSel.selectionCount == 0:
+            return None, 'Please select a reference body for best-fit alignment.'
+        options['mode'] = mode
+        options['reference'] = refSel.selection(0).entity
+        return options, None
+    
+    # Source planes picked on the mesh are fitted to the region around the pick point
+    fit_radius = inputs.itemById('fitRadius').value
+    
+    # Chain mode: the additional plane pairs link fragments to each other or to
+    # the fixed reference body; a construction plane target counts as fixed
+    if mode == MODE_CHAIN:
+        refSel = inputs.itemById('referenceBody')
+        if refSel.selectionCount == 0:
+            return None, 'Please select the reference body the chain of fragments is aligned to.'
+        options['mode'] = MODE_CHAIN
+        options['reference'] = refSel.selection(0).entity
+        options['chain_best_fit'] = inputs.itemById('chainBestFit').value
+        srcExtraSel = inputs.itemById('srcPlanesExtra')
+        tgtExtraSel = inputs.itemById('tgtPlanesExtra')
+        if srcExtraSel.selectionCount != tgtExtraSel.selectionCount:
+            return None, 'Select the same number of additional source and target planes.'
+        options['plane_constraints'] = []
+        for i in range(srcExtraSel.selectionCount):
+            src_body = adsk.fusion.MeshBody.cast(srcExtraSel.selection(i).entity)
+            if not src_body:
+                return None, 'In chain mode, pick each additional source plane on the fragment it belongs to.'
+            failure = 'Could not fit a plane to picked mesh region {}. Pick a flatter area or increase the fit radius.'.format(i + 1)
+            src_plane = _plane_from_selection(srcExtraSel.selection(i), fit_radius, failure)
+            tgt_plane = _plane_from_selection(tgtExtraSel.selection(i), fit_radius, failure)
+            if not src_plane or not tgt_plane:
+                return None, failure
+            options['plane_constraints'].append(
+                (src_body, src_plane, adsk.fusion.MeshBody.cast(tgtExtraSel.selection(i).entity), tgt_plane))
+        if not options['plane_constraints'] and not options['chain_best_fit']:
+            return None, 'Link the fragments with additional plane pairs or turn on Best Fit Overlapping Fragments.'
+        return options, None
+    
+    # Get the first pair of planes
+    src1Sel = inputs.itemById('srcPlane1')
+    tgt1Sel = inputs.itemById('tgtPlane1')
+    
+    # Or detect the first mesh's symmetry plane instead of a source plane 1 selection
+    if inputs.itemById('symmetryPlane').value:
+        if tgt1Sel.selectionCount == 0:
+            return None, 'Please select the target plane for the symmetry plane.'
+        options['symmetry'] = True
+        options['src_plane1'] = _symmetry_plane(
+            options['meshes'][0], 'No symmetry plane found on the first mesh. Select source plane 1 instead.')
+    else:
+        if src1Sel.selectionCount == 0 or tgt1Sel.selectionCount == 0:
+            return None, 'Please select both source and target planes for the first alignment.'
+        failure = 'Could not fit a plane to the picked mesh region. Pick a flatter area or increase the fit radius.'
+        options['src_plane1'] = _plane_from_selection(src1Sel.selection(0), fit_radius, failure)
+        if not options['src_plane1']:
+            return None, failure
+    options['tgt_plane1'] = adsk.fusion.ConstructionPlane.cast(tgt1Sel.selection(0).entity)
+    
+    # Get the optional second pair of planes
+    src2Sel = inputs.itemById('srcPlane2')
+    tgt2Sel = inputs.itemById('tgtPlane2')
+    
+    options['src_plane2'] = None
+    options['tgt_plane2'] = None
+    
+    if src2Sel.selectionCount > 0 and tgt2Sel.selectionCount > 0:
+        failure = 'Could not fit a plane to the second picked mesh region. Pick a flatter area or increase the fit radius.'
+        options['src_plane2'] = _plane_from_selection(src2Sel.selection(0), fit_radius, failure)
+        options['tgt_plane2'] = adsk.fusion.ConstructionPlane.cast(tgt2Sel.selection(0).entity)
+        if not options['src_plane2']:
+            return None, failure
+    
+    # Get any additional plane pairs, matched by selection order
+    srcExtraSel = inputs.itemById('srcPlanesExtra')
+    tgtExtraSel = inputs.itemById('tgtPlanesExtra')
+    if srcExtraSel.selectionCount != tgtExtraSel.selectionCount:
+        return None, 'Select the same number of additional source and target planes.'
+    
+    options['extra_plane_pairs'] = []
+    for i in range(srcExtraSel.selectionCount):
+        failure = 'Could not fit a plane to additional picked mesh region {}. Pick a flatter area or increase the fit radius.'.format(i + 1)
+        src_plane = _plane_from_selection(srcExtraSel.selection(i), fit_radius, failure)
+        tgt_plane = _plane_from_selection(tgtExtraSel.selection(i), fit_radius, failure)
+        if not src_plane or not tgt_plane:
+            return None, failure
+        options['extra_plane_pairs'].append((src_plane, tgt_plane))
+    
+    return options, None
+
 
+def perform_alignment(meshes, src_plane1, tgt_plane1, src_plane2, tgt_plane2, ui, preview_mode=False, debug_mode=False, flip_direction=False,
+                      apply_mode=APPLY_MOVE_FEATURE, extra_plane_pairs=(), record_recipe=False, quality=None,
+                      auto_orient=False, orient_reference=None, background=False, source_plane_name=None):
+    """Perform the mesh alignment based on selected planes
 
-def perform_alignment(mesh, src_plane1, tgt_plane1, src_plane2, tgt_plane2, ui, preview_mode=False, debug_mode=False, flip_direction=False):
-    """Perform the mesh alignment based on selected planes"""
-    move_feature = None
+    meshes may be a single MeshBody or a list of them; all bodies share the
+    same planes and are moved together. extra_plane_pairs is a list of further
+    (source, target) planes; with three or more pairs in total the transform
+    is a least-squares fit over all of them. A recipe saved earlier for the
+    same plane geometry is reused instead of recomputing, and record_recipe
+    saves one after the alignment is applied. quality ({'reference',
+    'tolerance'}) runs a deviation check against the reference body, or the
+    target planes when it has none (see measure_quality). auto_orient
+    replaces flip_direction: the flipped and spun poses on plane 1 are scored
+    against orient_reference, or the target planes, and the best one is kept
+    (see choose_orientation). With preview_mode the result is only
+    drawn as custom graphics and no feature is created. apply_mode selects a
+    MoveFeature or the occurrence transform (see _commit_alignment). With
+    background the math runs on the worker thread and the result is applied
+    when it finishes (see _run_job). Source planes may be PendingPlanes,
+    which are fitted with the math; with source_plane_name the first one is
+    kept in the design as a construction plane of that name.
+    """
     try:
-        if not mesh or not src_plane1 or not tgt_plane1:
-            ui.messageBox('Invalid selections.')
+        meshes = _as_mesh_list(meshes)
+
+        if not meshes or not src_plane1 or not tgt_plane1:
+            _message(ui, 'Invalid selections.')
             return
         
-        src_geom1 = src_plane1.geometry
-        tgt_geom1 = tgt_plane1.geometry
-        
-        if not src_geom1 or not tgt_geom1:
-            ui.messageBox('Could not read geometry from planes.')
+        # Read the plane geometry once; everything after works on arrays
+        with PROFILER.span('plane_read'):
+            plane_arrays = _read_plane_arrays(src_plane1, tgt_plane1, src_plane2, tgt_plane2, extra_plane_pairs)
+        if plane_arrays is None:
+            _message(ui, 'Could not read geometry from planes.')
             return
+        src_plane_arrays, tgt_plane_arrays = plane_arrays
         
-        # Build debug output
-        debug_info = 'DEBUG INFO\n' + '='*50 + '\n\n'
-        
-        debug_info += 'SOURCE PLANE 1 (Before):\n'
-        debug_info += '  Origin: ({:.2f}, {:.2f}, {:.2f})\n'.format(
-            src_geom1.origin.x, src_geom1.origin.y, src_geom1.origin.z)
-        debug_info += '  Normal: ({:.3f}, {:.3f}, {:.3f})\n'.format(
-            src_geom1.normal.x, src_geom1.normal.y, src_geom1.normal.z)
-        debug_info += '  uDirection: ({:.3f}, {:.3f}, {:.3f})\n'.format(
-            src_geom1.uDirection.x, src_geom1.uDirection.y, src_geom1.uDirection.z)
-        
-        # Compute and log vDirection (perpendicular to both normal and uDirection)
-        src_vDir = src_geom1.uDirection.crossProduct(src_geom1.normal)
-        src_vDir.normalize()
-        debug_info += '  vDirection: ({:.3f}, {:.3f}, {:.3f})\n\n'.format(
-            src_vDir.x, src_vDir.y, src_vDir.z)
-        
-        debug_info += 'TARGET PLANE 1:\n'
-        debug_info += '  Origin: ({:.2f}, {:.2f}, {:.2f})\n'.format(
-            tgt_geom1.origin.x, tgt_geom1.origin.y, tgt_geom1.origin.z)
-        debug_info += '  Normal: ({:.3f}, {:.3f}, {:.3f})\n'.format(
-            tgt_geom1.normal.x, tgt_geom1.normal.y, tgt_geom1.normal.z)
-        debug_info += '  uDirection: ({:.3f}, {:.3f}, {:.3f})\n'.format(
-            tgt_geom1.uDirection.x, tgt_geom1.uDirection.y, tgt_geom1.uDirection.z)
-        
-        tgt_vDir = tgt_geom1.uDirection.crossProduct(tgt_geom1.normal)
-        tgt_vDir.normalize()
-        debug_info += '  vDirection: ({:.3f}, {:.3f}, {:.3f})\n\n'.format(
-            tgt_vDir.x, tgt_vDir.y, tgt_vDir.z)
-        
-        # If we have two plane pairs, use them to compute a more constrained alignment
-        if src_plane2 and tgt_plane2:
-            src_geom2 = src_plane2.geometry
-            tgt_geom2 = tgt_plane2.geometry
-            
-            if src_geom2 and tgt_geom2:
-                debug_info += 'SOURCE PLANE 2 (Before):\n'
-                debug_info += '  Origin: ({:.2f}, {:.2f}, {:.2f})\n'.format(
-                    src_geom2.origin.x, src_geom2.origin.y, src_geom2.origin.z)
-                debug_info += '  Normal: ({:.3f}, {:.3f}, {:.3f})\n'.format(
-                    src_geom2.normal.x, src_geom2.normal.y, src_geom2.normal.z)
-                debug_info += '  uDirection: ({:.3f}, {:.3f}, {:.3f})\n\n'.format(
-                    src_geom2.uDirection.x, src_geom2.uDirection.y, src_geom2.uDirection.z)
-                
-                debug_info += 'TARGET PLANE 2:\n'
-                debug_info += '  Origin: ({:.2f}, {:.2f}, {:.2f})\n'.format(
-                    tgt_geom2.origin.x, tgt_geom2.origin.y, tgt_geom2.origin.z)
-                debug_info += '  Normal: ({:.3f}, {:.3f}, {:.3f})\n\n'.format(
-                    tgt_geom2.normal.x, tgt_geom2.normal.y, tgt_geom2.normal.z)
-                
-                # Log intersection axes
-                src_intersection = src_geom1.normal.crossProduct(src_geom2.normal)
-                src_intersection.normalize()
-                tgt_intersection = tgt_geom1.normal.crossProduct(tgt_geom2.normal)
-                tgt_intersection.normalize()
-                
-                debug_info += 'Source planes intersection axis: ({:.3f}, {:.3f}, {:.3f})\n'.format(
-                    src_intersection.x, src_intersection.y, src_intersection.z)
-                debug_info += 'Target planes intersection axis: ({:.3f}, {:.3f}, {:.3f})\n\n'.format(
-                    tgt_intersection.x, tgt_intersection.y, tgt_intersection.z)
+        # Structured trace; does nothing (and evaluates nothing) when debug is off
+        trace = mesh_align_trace.TraceRecorder(
+            os.path.join(_SCRIPT_DIR, TRACE_FILE_NAME), debug_mode,
+            meshes=len(meshes), flip=bool(flip_direction), auto_orient=bool(auto_orient))
+        if src_plane2 and tgt_plane2 and len(src_plane_arrays) < 2:
+            trace.record('warning', {'message': 'plane 2 geometry missing'})
+
+        # Memoized on the selection set so repeated previews/executes reuse the
+        # math; a recipe on disk for the same planes skips the math entirely
+        key_params = {'flip': bool(flip_direction)}
+        if auto_orient:
+            key_params['auto_orient'] = True
+        cache_key = ('planes', _entity_keys(meshes), _plane_keys(src_plane_arrays),
+                     _plane_keys(tgt_plane_arrays), bool(flip_direction), bool(auto_orient))
+        orient_key = cache_key + ('orient', _entity_keys([orient_reference]) if orient_reference else ())
+
+        # Everything the math needs from the Fusion API is read here, on the main thread
+        orient_sampler = orient_surface = None
+        orient = _cache_lookup(orient_key) if auto_orient else None
+        if auto_orient and orient is None:
+            orient_sampler = _vertex_sampler(meshes, ORIENT_SAMPLE_COUNT)
+            orient_surface = _surface_loader(orient_reference) if orient_reference else None
+        bodies = _recipe_bodies(meshes) if record_recipe and not preview_mode else None
+        check = _prepare_quality(meshes, quality) if quality and not preview_mode else None
+
+        def work(job):
+            job.checkpoint(0.0, 'Fitting planes')
+            failure = _fit_pending_planes(src_plane_arrays) or _fit_pending_planes(tgt_plane_arrays)
+            if failure:
+                return None, failure
+            recipe_key = mesh_align_recipes.geometry_key(
+                MODE_PLANES, src_plane_arrays + tgt_plane_arrays, **key_params)
+            job.checkpoint(0.1, 'Solving planes')
+            stages, mode = _cached(cache_key, lambda: _recipe_stages(recipe_key) or compute_plane_alignment(
+                src_plane_arrays, tgt_plane_arrays, flip_direction))
+            # A recipe already holds the orientation that was chosen when it was recorded
+            orientation = None
+            if auto_orient and mode != 'recipe':
+                job.checkpoint(0.2, 'Scoring orientations')
+                stages, orientation = orient or _cached(orient_key, lambda: choose_orientation(
+                    orient_sampler(), stages, src_plane_arrays[0], tgt_plane_arrays,
+                    orient_surface() if orient_surface else None))
+            report = None
+            if check:
+                job.checkpoint(0.6, 'Measuring deviation')
+                sampler, surface, _ = check
+                report = measure_quality(
+                    mesh_align_core.transform_points(mesh_align_core.compose_transforms([m for _, m in stages]), sampler()),
+                    quality['tolerance'], surface() if surface else None, tgt_plane_arrays)
+            return (stages, mode, orientation, report, recipe_key), None
+
+        def finish(outcome):
+            result, failure = outcome
+            if failure:
+                _flush_trace(trace, ui)
+                _message(ui, failure)
+                return None
+            stages, mode, orientation, report, recipe_key = result
+            for index, (src_array, tgt_array) in enumerate(zip(src_plane_arrays, tgt_plane_arrays)):
+                trace.record('plane', lambda: _plane_trace_fields('source', index + 1, src_array))
+                trace.record('plane', lambda: _plane_trace_fields('target', index + 1, tgt_array))
+            trace.record('mode', {'mode': mode, 'recipe': recipe_key})
+            if orientation:
+                trace.record('orientation', dict(
+                    orientation, reference=orient_reference.name if orient_reference else 'target planes'))
+            if len(src_plane_arrays) >= 2:
+                trace.record('residuals', lambda: mesh_align_core.plane_pair_residuals(
+                    stages[0][1], src_plane_arrays, tgt_plane_arrays))
+            if len(src_plane_arrays) == 2:
+                trace.record('intersection_axes', lambda: {
+                    'source': mesh_align_core.normalize(np.cross(
+                        src_plane_arrays[0][mesh_align_core.NORMAL], src_plane_arrays[1][mesh_align_core.NORMAL])),
+                    'target': mesh_align_core.normalize(np.cross(
+                        tgt_plane_arrays[0][mesh_align_core.NORMAL], tgt_plane_arrays[1][mesh_align_core.NORMAL])),
+                })
+
+            combined = mesh_align_core.compose_transforms([m for _, m in stages])
+
+            # Report where the source planes end up after each stage
+            trace.record('prediction', lambda: {'stages': _stage_predictions(stages, src_plane_arrays)})
+            trace.record('transform', lambda: {
+                'matrix': combined,
+                'translation_distance': float(np.linalg.norm(
+                    mesh_align_core.transform_points(combined, src_plane_arrays[0][mesh_align_core.ORIGIN]) -
+                    src_plane_arrays[0][mesh_align_core.ORIGIN])),
+            })
+
+            if preview_mode:
+                _draw_preview(meshes, combined)
+                return None
+
+            if source_plane_name:
+                _add_construction_plane(meshes[0].parentComponent, src_plane_arrays[0], source_plane_name)
+            result = _commit_alignment(meshes, stages, trace, ui,
+                                       'Source plane already aligned to target plane. No action taken.',
+                                       apply_mode)
+            if result and record_recipe:
+                _save_recipe(ui, recipe_key, MODE_PLANES, stages, bodies, apply_mode=apply_mode,
+                             method=mode, flip=bool(flip_direction), auto_orient=bool(auto_orient),
+                             src_planes=src_plane_arrays, tgt_planes=tgt_plane_arrays)
+            if result and report:
+                _report_quality(report, check[2], quality['tolerance'], trace, ui)
+            return result
+
+        return _run_job('Aligning to planes', work, finish, ui, background)
+            
+    except:
+        # The preview handler cleans up and stays silent on errors
+        if preview_mode:
+            raise
+        if ui:
+            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
+def _read_plane_arrays(src_plane1, tgt_plane1, src_plane2, tgt_plane2, extra_plane_pairs=()):
+    """Read plane geometry into lists of source and target plane arrays
+
+    Plane pair 2 and the extra pairs are included only when both of their
+    planes have geometry. Returns None if plane pair 1 has no geometry. A
+    PendingPlane stays in the lists as it is (see _fit_pending_planes).
+    """
+    src_plane_arrays = []
+    tgt_plane_arrays = []
+    for src_plane, tgt_plane in [(src_plane1, tgt_plane1), (src_plane2, tgt_plane2)] + list(extra_plane_pairs or ()):
+        src_array = _read_plane(src_plane)
+        tgt_array = _read_plane(tgt_plane)
+        if src_array is not None and tgt_array is not None:
+            src_plane_arrays.append(src_array)
+            tgt_plane_arrays.append(tgt_array)
+        elif not src_plane_arrays:
+            return None
+    return src_plane_arrays, tgt_plane_arrays
+
+
+def _read_plane(plane):
+    """The plane array of a plane's geometry, a PendingPlane as it is, or None without geometry"""
+    if isinstance(plane, PendingPlane):
+        return plane
+    geom = plane.geometry if plane else None
+    return _plane_to_array(geom) if geom else None
+
+
+def _fit_pending_planes(plane_arrays):
+    """Replace each PendingPlane in plane_arrays by the array of its fitted plane
+
+    Uses no Fusion API. Returns the failure message of the first plane that
+    could not be fitted, or None.
+    """
+    for index, plane in enumerate(plane_arrays):
+        if isinstance(plane, PendingPlane):
+            fitted = plane.fit()
+            if fitted is None:
+                return plane.failure
+            plane_arrays[index] = fitted.plane_array
+    return None
+
+
+def compute_plane_alignment(src_plane_arrays, tgt_plane_arrays, flip_direction=False):
+    """Compute the ordered transform stages for one or more plane pairs
+
+    Three or more pairs are solved together with a least-squares (SVD) fit,
+    which averages out noise in the individual planes.
+
+    Returns (stages, mode) where stages is a list of (name, 4x4 matrix)
+    applied first-to-last. Every stage (align, flip, ...) is later folded into
+    one matrix so the whole run is applied as a single MoveFeature.
+    """
+    with PROFILER.span('transform_math'):
+        move_matrix, mode = mesh_align_core.plane_alignment(src_plane_arrays, tgt_plane_arrays)
+    stages = [('align', move_matrix)]
+
+    # Apply 180-degree flip if requested (only for plane 1)
+    if flip_direction:
+        with PROFILER.span('flip_math'):
+            _, _, flip_matrix = compute_flip_transform(src_plane_arrays[0], tgt_plane_arrays[0], move_matrix)
+        stages.append(('flip', flip_matrix))
+    return stages, mode
+
+
+def choose_orientation(points, stages, src_plane, tgt_plane_arrays, surface=None):
+    """Pick the best of the symmetric poses of the aligned points on target plane 1
+
+    Every candidate (see mesh_align_core.ORIENTATIONS) is scored in one batch
+    on the vertex sample points: by overlap with the SurfaceReference surface
+    when there is one, else by the share of vertices on the positive side of
+    the target planes, where a part placed against them sits. Ties keep the
+    plain alignment.
+
+    Returns (stages, trace fields); the winning turn is appended to stages as
+    an 'orient' stage unless it is the plain alignment.
+    """
+    align = mesh_align_core.compose_transforms([m for _, m in stages])
+    with PROFILER.span('orient'):
+        turns = mesh_align_core.orientation_turns(src_plane, tgt_plane_arrays[0], align)
+        candidates = np.matmul(turns, align)
+        if surface is not None:
+            scores = mesh_align_quality.overlap_scores(points, candidates, surface)
+            best = int(np.argmin(scores))
+        else:
+            scores = mesh_align_quality.side_scores(points, candidates, tgt_plane_arrays)
+            best = int(np.argmax(scores))
+    if best:
+        stages = stages + [('orient', turns[best])]
+    return stages, {
+        'chosen': mesh_align_core.ORIENTATIONS[best],
+        'metric': 'overlap' if surface is not None else 'side',
+        'scores': dict(zip(mesh_align_core.ORIENTATIONS, scores.tolist())),
+    }
+
+
+def perform_best_fit_alignment(meshes, reference, ui, debug_mode=False, preview_mode=False,
+                               apply_mode=APPLY_MOVE_FEATURE, record_recipe=False, quality=None,
+                               background=False, coarse=False):
+    """Register the mesh bodies onto a reference body with point-to-plane ICP
+
+    All selected meshes are treated as one rigid set: their vertices are
+    sampled together and the resulting transform goes through the same
+    MoveFeature path as perform_alignment. With coarse the fit starts from
+    the principal-axes pose (see compute_best_fit_alignment), so the meshes
+    may start anywhere; otherwise they should already be roughly in place.
+    With background the fit runs on the worker thread (see _run_job).
+    """
+    try:
+        meshes = _as_mesh_list(meshes)
+
+        if not meshes or not reference:
+            _message(ui, 'Invalid selections.')
+            return
+
+        trace = mesh_align_trace.TraceRecorder(
+            os.path.join(_SCRIPT_DIR, TRACE_FILE_NAME), debug_mode,
+            meshes=len(meshes), mode='best-fit', coarse=bool(coarse))
+
+        # Everything the fit needs from the Fusion API is read here, on the main thread
+        cache_key = ('best_fit', _entity_keys(meshes), _entity_keys([reference]), bool(coarse))
+        source = surface = None
+        cached = _cache_lookup(cache_key)
+        if cached is None:
+            source = _vertex_sampler(meshes, BEST_FIT_SAMPLE_COUNT)
+            surface = _surface_loader(reference)
+        bodies = _recipe_bodies(meshes) if record_recipe and not preview_mode else None
+        check = _prepare_quality(meshes, quality, reference) if quality and not preview_mode else None
+
+        def work(job):
+            stages, result = cached or _cached(
+                cache_key, lambda: compute_best_fit_alignment(source(), surface(), job, coarse))
+            report = None
+            if check and result is not None and result.inliers >= 6:
+                job.checkpoint(0.9, 'Measuring deviation')
+                sampler, quality_surface, _ = check
+                report = measure_quality(mesh_align_core.transform_points(result.matrix, sampler()), quality['tolerance'],
+                                         quality_surface() if quality_surface else None)
+            return stages, result, report
+
+        def finish(outcome):
+            stages, result, report = outcome
+            if result is None:
+                _message(ui, 'Could not read triangles from the reference body.')
+                return None
+            trace.record('best_fit', result.as_dict)
+            if result.inliers < 6:
+                _flush_trace(trace, ui)
+                _message(ui, 'Best fit failed: the mesh does not overlap the reference body.')
+                return None
+
+            if preview_mode:
+                _draw_preview(meshes, mesh_align_core.compose_transforms([m for _, m in stages]))
+                return None
+
+            applied = _commit_alignment(meshes, stages, trace, ui,
+                                        'Mesh already fits the reference body. No action taken.',
+                                        apply_mode)
+            if applied and record_recipe:
+                mode = MODE_COARSE if coarse else MODE_BEST_FIT
+                recipe_key = mesh_align_recipes.geometry_key(
+                    mode, [b['bounds'] for b in bodies + _recipe_bodies([reference])])
+                _save_recipe(ui, recipe_key, mode, stages, bodies, apply_mode=apply_mode,
+                             rms=result.rms, reference=reference.name)
+            if applied and report:
+                _report_quality(report, check[2], quality['tolerance'], trace, ui)
+            return applied
+
+        return _run_job('Best fit', work, finish, ui, background)
+
+    except:
+        # The preview handler cleans up and stays silent on errors
+        if preview_mode:
+            raise
+        if ui:
+            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
+def compute_best_fit_alignment(source, surface, job=None, coarse=False):
+    """Run ICP of the source vertex sample onto a SurfaceReference
+
+    With coarse the ICP starts from mesh_align_fit.coarse_register, which
+    matches the principal axes of the sample and the reference, and the
+    stages are ('coarse', pose) then ('best_fit', refinement). Uses no
+    Fusion API, so it can run on the worker thread; job (see
+    mesh_align_jobs.Job) gets the progress of every iteration and can
+    cancel the fit. Returns (stages, FitResult), or (None, None) without a
+    surface (the reference has no triangles).
+    """
+    if surface is None:
+        return None, None
+
+    def progress(iteration, max_iterations, rms):
+        job.checkpoint(float(iteration) / max_iterations, 'ICP iteration {} (rms {:.4g})'.format(iteration, rms))
+
+    stages = []
+    init = None
+    if coarse:
+        if job:
+            job.checkpoint(0.0, 'Matching principal axes')
+        with PROFILER.span('coarse_math'):
+            init, _ = mesh_align_fit.coarse_register(source, surface.tree.points, surface.tree)
+        stages.append(('coarse', init))
+    with PROFILER.span('best_fit_math'):
+        result = mesh_align_fit.icp_point_to_plane(
+            source, surface.tree.points, surface.normals, init=init, target_tree=surface.tree,
+            callback=progress if job else None)
+    # The fit includes the coarse pose; the last stage is only the refinement
+    refinement = result.matrix if init is None else result.matrix @ np.linalg.inv(init)
+    return stages + [('best_fit', refinement)], result
+
+
+def perform_chain_alignment(meshes, root, ui, plane_constraints=(), best_fit=True, debug_mode=False,
+                            preview_mode=False, apply_mode=APPLY_MOVE_FEATURE, record_recipe=False,
+                            background=False):
+    """Align a chain of mesh fragments onto a fixed root body in one solve
+
+    The root is node 0 of a pose graph and the fragments follow in selection
+    order. plane_constraints is a list of (source body, source plane, target
+    body or None, target plane); a None target body stands for a
+    construction plane, which stays fixed like the root. With best_fit
+    fragments are also fitted onto the root and onto earlier fragments their
+    bounding box touches (see compute_chain_alignment). All poses are solved
+    together, so extra links spread the error instead of adding it up along
+    the chain, and each fragment is then moved by its own pose.
+    """
+    try:
+        meshes = _as_mesh_list(meshes)
+
+        if not meshes or not root:
+            _message(ui, 'Invalid selections.')
+            return
+        bodies = [root] + meshes
+        nodes = {}
+        for node, body in enumerate(bodies):
+            nodes.setdefault(body.entityToken, node)
+        if len(nodes) < len(bodies):
+            _message(ui, 'Select each fragment once, and not the reference body.')
+            return
+        names = [body.name for body in bodies]
+
+        trace = mesh_align_trace.TraceRecorder(
+            os.path.join(_SCRIPT_DIR, TRACE_FILE_NAME), debug_mode,
+            meshes=len(meshes), mode='chain', best_fit=bool(best_fit))
+
+        # Plane pairs between the same two bodies form one link
+        plane_links = collections.OrderedDict()
+        with PROFILER.span('plane_read'):
+            for src_body, src_plane, tgt_body, tgt_plane in plane_constraints:
+                i = nodes.get(src_body.entityToken)
+                j = nodes.get(tgt_body.entityToken) if tgt_body else 0
+                if i is None or j is None or i == j:
+                    _message(ui, 'Each plane pair must link a selected fragment to another fragment, '
+                                 'the reference body or a construction plane.')
+                    return
+                src_array = _read_plane(src_plane)
+                tgt_array = _read_plane(tgt_plane)
+                if src_array is None or tgt_array is None:
+                    _message(ui, 'Could not read geometry from planes.')
+                    return
+                src_planes, tgt_planes = plane_links.setdefault((i, j), ([], []))
+                src_planes.append(src_array)
+                tgt_planes.append(tgt_array)
+
+        # Best-fit candidates: pairs whose bounding boxes touch
+        records = _recipe_bodies(bodies)
+        bounds = np.array([record['bounds'] for record in records])
+        fit_pairs = []
+        if best_fit:
+            for i in range(1, len(bodies)):
+                for j in range(i):
+                    if (np.all(bounds[i, :3] <= bounds[j, 3:] + CHAIN_CONTACT_DISTANCE) and
+                            np.all(bounds[j, :3] <= bounds[i, 3:] + CHAIN_CONTACT_DISTANCE)):
+                        fit_pairs.append((i, j))
+        # A rotation error of one radian moves a fragment by about its radius
+        rotation_weight = max(0.5 * float(np.mean(np.linalg.norm(bounds[1:, 3:] - bounds[1:, :3], axis=1))), 1e-6)
+
+        # Everything the solve needs from the Fusion API is read here, on the main thread
+        keys = _entity_keys(bodies)
+        cache_key = ('chain', keys, tuple((link, _plane_keys(src), _plane_keys(tgt))
+                                          for link, (src, tgt) in plane_links.items()), tuple(fit_pairs))
+        samplers, surfaces = {}, {}
+        cached = _cache_lookup(cache_key)
+        if cached is None:
+            samplers = dict((i, _vertex_sampler([bodies[i]], BEST_FIT_SAMPLE_COUNT)) for i, _ in fit_pairs)
+            surfaces = dict((j, _surface_loader(bodies[j])) for _, j in fit_pairs)
+
+        def work(job):
+            for src_planes, tgt_planes in plane_links.values():
+                failure = _fit_pending_planes(src_planes) or _fit_pending_planes(tgt_planes)
+                if failure:
+                    return None, failure
+            return cached or _cached(cache_key, lambda: compute_chain_alignment(
+                len(bodies), plane_links, fit_pairs, samplers, surfaces, keys, rotation_weight, job)), None
+
+        def finish(outcome):
+            outcome, failure = outcome
+            if failure:
+                _flush_trace(trace, ui)
+                _message(ui, failure)
+                return None
+            result, links, missing = outcome
+            trace.record('chain_links', lambda: {'links': [
+                dict(link, source=names[link['source']], target=names[link['target']]) for link in links]})
+            if missing:
+                _flush_trace(trace, ui)
+                _message(ui, 'These fragments are not linked to {}: {}.\n\nAdd plane pairs for them, or turn on '
+                             'Best Fit Overlapping Fragments and place them near a neighbour.'.format(
+                                 names[0], ', '.join(names[node] for node in missing)))
+                return None
+            trace.record('pose_graph', result.as_dict)
+
+            if preview_mode:
+                _draw_preview(meshes, result.poses[1:])
+                return None
+
+            moved = _commit_poses(meshes, result.poses[1:], trace, ui, apply_mode)
+            if moved is None:
+                return None
+            if not moved:
+                _message(ui, 'The fragments are already in place. No action taken.')
+                return moved
+            if record_recipe:
+                # One recipe per fragment, so replay moves each by its own pose
+                arrays = [record['bounds'] for record in records]
+                for index in moved:
+                    _save_recipe(ui, mesh_align_recipes.geometry_key(MODE_CHAIN, arrays, fragment=index),
+                                 MODE_CHAIN, [('pose_graph', result.poses[index + 1])], [records[index + 1]],
+                                 apply_mode=apply_mode, reference=names[0])
+            worst = int(np.argmax(result.residuals['translation'])) if links else None
+            _message(ui, 'Aligned {} of {} fragments onto {} in one solve over {} links '
+                         '({} plane, {} best fit).{}'.format(
+                             len(moved), len(meshes), names[0], len(links),
+                             sum(1 for link in links if link['kind'] == 'planes'),
+                             sum(1 for link in links if link['kind'] == 'best_fit'),
+                             '' if worst is None else '\nLargest link misfit: {} and {:.3f}° ({} to {}).'.format(
+                                 _format_mm(result.residuals['translation'][worst]),
+                                 np.degrees(result.residuals['angle'][worst]),
+                                 names[links[worst]['source']], names[links[worst]['target']])))
+            return moved
+
+        return _run_job('Aligning fragments', work, finish, ui, background)
+
+    except:
+        # The preview handler cleans up and stays silent on errors
+        if preview_mode:
+            raise
+        if ui:
+            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
+def compute_chain_alignment(count, plane_links, fit_pairs, samplers, surfaces, keys, rotation_weight, job=None):
+    """Build the links of a chain of fragments and solve their poses together
+
+    plane_links maps (i, j) node pairs to their (source planes, target
+    planes). Each becomes a link that only constrains the directions its
+    planes pin (see mesh_align_posegraph.plane_information). Each
+    (i, j) of fit_pairs is fitted with fit_fragment_pair from samplers[i]
+    onto surfaces[j] and becomes a link when enough of it overlaps,
+    weighted by the overlap. Uses no Fusion API, so it can run on the worker
+    thread; job (see mesh_align_jobs.Job) gets the progress and can cancel.
+
+    Returns (PoseGraphResult, links, missing) where links holds the source,
+    target, kind and weight of every link and missing lists the nodes that
+    no link connects to the root; the result is None when any are missing.
+    """
+    edges = []
+    links = []
+    information = []
+    for (i, j), (src_planes, tgt_planes) in plane_links.items():
+        with PROFILER.span('transform_math'):
+            # Every pair's offset must hold, so two pairs are solved by least
+            # squares instead of pinning plane 1's origin onto target 1's
+            if len(src_planes) >= 2:
+                matrix, _ = mesh_align_core.solve_plane_pairs(src_planes, tgt_planes)
+            else:
+                matrix, _ = mesh_align_core.plane_alignment(src_planes, tgt_planes)
+        edges.append((i, j, matrix))
+        links.append({'source': i, 'target': j, 'kind': 'planes', 'weight': 1.0})
+        # Fewer than three pairs leave the link free to slide and turn in the planes
+        information.append(mesh_align_posegraph.plane_information(src_planes))
+    for index, (i, j) in enumerate(fit_pairs):
+        if job:
+            job.checkpoint(0.9 * index / len(fit_pairs), 'Fitting link {} of {}'.format(index + 1, len(fit_pairs)))
+        matrix, overlap = _cached(('chain_fit', keys[i], keys[j]),
+                                  lambda: fit_fragment_pair(samplers[i](), surfaces[j]()))
+        if overlap >= CHAIN_MIN_OVERLAP:
+            edges.append((i, j, matrix))
+            links.append({'source': i, 'target': j, 'kind': 'best_fit', 'weight': overlap})
+            information.append(np.eye(6))
+
+    missing = mesh_align_posegraph.unconnected_nodes(count, edges)
+    if missing:
+        return None, links, missing
+    if job:
+        job.checkpoint(0.9, 'Solving the pose graph')
+    with PROFILER.span('pose_graph'):
+        result = mesh_align_posegraph.solve_pose_graph(
+            count, edges, [link['weight'] for link in links], rotation_weight, information=information)
+    for link, translation, angle in zip(links, result.residuals['translation'], result.residuals['angle']):
+        link.update(translation=float(translation), angle=float(angle))
+    return result, links, missing
+
+
+def fit_fragment_pair(source, surface):
+    """Best fit of a fragment's vertex sample onto another body's SurfaceReference
+
+    Vertices outside the overlap would pull the fit off, so pairs further
+    apart than a cutoff are ignored, and the cutoff shrinks from
+    CHAIN_SEARCH_DISTANCE to CHAIN_CONTACT_DISTANCE. Returns (matrix,
+    overlap), overlap being the share of the fitted sample within
+    CHAIN_CONTACT_DISTANCE of the other body's vertices; 0 without a surface.
+    """
+    if surface is None or not len(source):
+        return np.eye(4), 0.0
+    matrix = None
+    cutoff = CHAIN_SEARCH_DISTANCE
+    with PROFILER.span('best_fit_math'):
+        while True:
+            cutoff = max(cutoff, CHAIN_CONTACT_DISTANCE)
+            matrix = mesh_align_fit.icp_point_to_plane(
+                source, surface.tree.points, surface.normals, init=matrix, max_correspondence=cutoff,
+                target_tree=surface.tree).matrix
+            if cutoff <= CHAIN_CONTACT_DISTANCE:
+                break
+            cutoff *= 0.5
+        distances, _ = surface.tree.query(mesh_align_core.transform_points(matrix, source))
+    return matrix, float(np.mean(distances <= CHAIN_CONTACT_DISTANCE))
+
+
+def replay_recipes(path, ui, meshes=None, debug_mode=False):
+    """Apply saved recipes to the bodies they were recorded on
+
+    path is a recipe file or a folder of them. Candidate bodies are the given
+    meshes, or every mesh body in the design when none are given. A recipe
+    is applied to candidates with the recorded name (or entity token) that
+    are still in the recorded starting pose, so replaying twice does not move
+    a body twice. No alignment math is run.
+    """
+    skipped = []
+    try:
+        recipes = mesh_align_recipes.load_recipes(path, skipped)
+    except (IOError, OSError, ValueError) as e:
+        _message(ui, 'Could not load recipes from {}:\n{}'.format(path, e))
+        return None
+
+    candidates = _as_mesh_list(meshes) or _design_mesh_bodies()
+    records = _recipe_bodies(candidates)
+
+    # Match everything first: applying a recipe changes the bounding boxes
+    claimed = set()
+    plan = []
+    for recipe in recipes:
+        indices = [i for i in mesh_align_recipes.match_bodies(recipe, records, RECIPE_MATCH_TOLERANCE)
+                   if i not in claimed]
+        claimed.update(indices)
+        plan.append((recipe, [candidates[i] for i in indices]))
+
+    applied = 0
+    moved = 0
+    for recipe, bodies in plan:
+        if not bodies:
+            continue
+        trace = mesh_align_trace.TraceRecorder(
+            os.path.join(_SCRIPT_DIR, TRACE_FILE_NAME), debug_mode,
+            meshes=len(bodies), mode='replay', recipe=recipe['key'])
+        if _commit_alignment(bodies, mesh_align_recipes.recipe_stages(recipe), trace, ui,
+                             'Recipe {} is an identity transform. No action taken.'.format(recipe['key']),
+                             recipe.get('apply_mode', APPLY_MOVE_FEATURE)):
+            applied += 1
+            moved += len(bodies)
+
+    message = 'Replayed {} of {} recipes onto {} bodies.'.format(applied, len(recipes), moved)
+    if skipped:
+        message += '\nSkipped {} files that are not readable recipes:\n{}'.format(
+            len(skipped), '\n'.join('{}: {}'.format(os.path.basename(p), reason) for p, reason in skipped))
+    _message(ui, message)
+    return applied
+
+
+def _recipe_stages(key):
+    """(stages, mode) from the recipe saved under key, or None"""
+    recipe = _recipe_store.get(key)
+    if recipe is None:
+        return None
+    return mesh_align_recipes.recipe_stages(recipe), 'recipe'
+
+
+def _recipe_bodies(bodies):
+    """Name, entity token and bounding box of each body, as stored in recipes"""
+    records = []
+    for body in bodies:
+        box = body.boundingBox
+        records.append({
+            'name': body.name,
+            'token': body.entityToken,
+            'bounds': np.concatenate([_point_to_array(box.minPoint), _point_to_array(box.maxPoint)]).tolist(),
+        })
+    return records
+
+
+def _save_recipe(ui, key, mode, stages, bodies, **fields):
+    """Store a recipe for an applied alignment; failures are reported but not fatal"""
+    recipe = mesh_align_recipes.make_recipe(key, mode, stages, bodies, **fields)
+    try:
+        return _recipe_store.save(recipe)
+    except (IOError, OSError):
+        _message(ui, 'The alignment was applied, but its recipe could not be saved to {}.'.format(_recipe_store.folder))
+        return None
+
+
+def _design_mesh_bodies():
+    """Every mesh body in the active design"""
+    design = adsk.fusion.Design.cast(adsk.core.Application.get().activeProduct)
+    if not design:
+        return []
+    return [body for component in design.allComponents for body in component.meshBodies]
+
+
+def _message(ui, text):
+    """Show a message box when a UI is available (it is not during preview)"""
+    if ui:
+        ui.messageBox(text)
+
+
+def _entity_keys(bodies):
+    """Cache key for a list of bodies: entity token plus current bounding box
+
+    Including the bounding box means a body that was moved or edited since the
+    result was cached gets a fresh computation.
+    """
+    keys = []
+    for body in bodies:
+        box = body.boundingBox
+        keys.append((body.entityToken,) + tuple(np.round(
+            np.concatenate([_point_to_array(box.minPoint), _point_to_array(box.maxPoint)]), 9)))
+    return tuple(keys)
+
+
+def _plane_keys(plane_arrays):
+    """Cache key for plane arrays; rounding absorbs floating point noise
+
+    A PendingPlane stands in with its own key, so the key is known before
+    the plane is fitted.
+    """
+    return tuple(p.key if isinstance(p, PendingPlane) else tuple(np.round(np.asarray(p).ravel(), 9))
+                 for p in plane_arrays)
+
+
+def _cached(key, compute):
+    """Return the memoized result for key, computing and storing it on a miss
+
+    Safe to call from the worker thread; compute runs outside the lock.
+    """
+    with _cache_lock:
+        if key in _alignment_cache:
+            return _alignment_cache[key]
+    result = compute()
+    with _cache_lock:
+        if len(_alignment_cache) >= ALIGNMENT_CACHE_SIZE:
+            _alignment_cache.pop(next(iter(_alignment_cache)))
+        _alignment_cache[key] = result
+    return result
+
+
+def _cache_lookup(key):
+    """The memoized result for key, or None
+
+    A job that reads its inputs from Fusion only on a cache miss looks the
+    result up here, on the main thread, and hands it to its work: the entry
+    may be evicted before the worker thread gets to it.
+    """
+    with _cache_lock:
+        return _alignment_cache.get(key)
+
+
+def _run_job(label, work, finish, ui, background=False):
+    """Run work(job) and then finish(result)
+
+    work gets a mesh_align_jobs.Job for progress and cancellation and must
+    not use the Fusion API. With background it runs on the worker thread and
+    finish runs on the main thread when the job reports back (see
+    MeshAlignJobEventHandler). Otherwise both run right away and the result
+    of finish is returned.
+    """
+    if not background:
+        return finish(work(mesh_align_jobs.Job(label)))
+    job = _get_job_runner().submit(label, work)
+    _job_finishers[job.id] = (finish, ui)
+    _show_job_progress(ui)
+    return None
+
+
+def _get_job_runner():
+    """The shared JobRunner; its jobs report through the JOB_EVENT_ID custom event"""
+    global _job_runner
+    if _job_runner is None:
+        app = adsk.core.Application.get()
+        # fireCustomEvent is the one API call that is safe from another thread
+        _job_runner = mesh_align_jobs.JobRunner(
+            lambda job, event: app.fireCustomEvent(JOB_EVENT_ID, json.dumps({'job': job.id, 'event': event})))
+    return _job_runner
+
+
+def _show_job_progress(ui):
+    """Show the running job in Fusion's progress bar, with the cancel button while any job is left"""
+    jobs = _job_runner.active() if _job_runner else []
+    progressBar = ui.progressBar
+    if jobs:
+        job = jobs[0]
+        text = job.label + (': ' + job.message if job.message else '')
+        if len(jobs) > 1:
+            text += ' ({} more queued)'.format(len(jobs) - 1)
+        progressBar.show(text, 0, 100, False)
+        progressBar.progressValue = int(100 * job.progress)
+    else:
+        progressBar.hide()
+
+    panel = ui.allToolbarPanels.itemById(CANCEL_PANEL_ID)
+    control = panel.controls.itemById(CANCEL_COMMAND_ID) if panel else None
+    if jobs and panel and not control:
+        cancelDef = ui.commandDefinitions.itemById(CANCEL_COMMAND_ID)
+        if cancelDef:
+            panel.controls.addCommand(cancelDef).isPromoted = True
+    elif not jobs and control:
+        control.deleteMe()
+
+
+def _terminate_when_idle():
+    """Let the script end once the dialog is closed and every job has reported back"""
+    global _job_runner
+    if _dialog_open or _job_finishers:
+        return
+    app = adsk.core.Application.get()
+    if _job_runner:
+        _job_runner.shutdown()
+        _job_runner = None
+        _show_job_progress(app.userInterface)
+    app.unregisterCustomEvent(JOB_EVENT_ID)
+    adsk.autoTerminate(True)
+
+
+def _draw_preview(meshes, matrix):
+    """Draw a transformed low-LOD proxy of the meshes with custom graphics
+
+    matrix is one 4x4 transform for all meshes, or a stack with one per mesh.
+    """
+    global _preview_group
+    _clear_preview()
+    app = adsk.core.Application.get()
+    design = adsk.fusion.Design.cast(app.activeProduct)
+    if not design:
+        return
+    _preview_group = design.rootComponent.customGraphicsGroups.add()
+    matrices = np.broadcast_to(matrix, (len(meshes), 4, 4))
+    color = adsk.fusion.CustomGraphicsSolidColorEffect.create(adsk.core.Color.create(*PREVIEW_COLOR))
+    for mesh, matrix in zip(meshes, matrices):
+        vertices, triangles = _preview_proxy(mesh)
+        if not len(triangles):
+            continue
+        coords = adsk.fusion.CustomGraphicsCoordinates.create(vertices.ravel().tolist())
+        proxy = _preview_group.addMesh(coords, triangles.ravel().tolist(), [], [])
+        proxy.color = color
+        proxy.transform = _array_to_matrix(matrix)
+    app.activeViewport.refresh()
+
+
+def _preview_proxy(mesh):
+    """Decimated copy of a mesh for preview, cached per body"""
+    key = _entity_keys([mesh])
+    proxy = _preview_proxy_cache.get(key)
+    if proxy is None:
+        vertices, triangles = _body_mesh_arrays(mesh)
+        proxy = mesh_align_sampling.cluster_mesh(vertices, triangles, PREVIEW_TRIANGLE_BUDGET)
+        _preview_proxy_cache[key] = proxy
+    return proxy
+
+
+def _clear_preview():
+    """Remove the preview custom graphics, if any"""
+    global _preview_group
+    if _preview_group is not None:
+        try:
+            _preview_group.deleteMe()
+        except:
+            pass
+        _preview_group = None
+
+
+def _as_mesh_list(meshes):
+    """Accept a single MeshBody or a list of them and return a list without empty entries"""
+    if isinstance(meshes, (list, tuple)):
+        return [m for m in meshes if m]
+    return [meshes] if meshes else []
+
+
+def _commit_alignment(meshes, stages, trace, ui, unchanged_message, apply_mode=APPLY_MOVE_FEATURE):
+    """Compose the stages and apply them to the meshes in one step
+
+    With APPLY_MOVE_FEATURE the meshes get one MoveFeature per component. With
+    APPLY_OCCURRENCE the transform is written to the occurrence holding each
+    body instead, which creates no mesh feature at all.
+    """
+    combined = mesh_align_core.compose_transforms([m for _, m in stages])
+    combined_transform = _array_to_matrix(combined)
+
+    # Skip if transform is effectively identity
+    identity = adsk.core.Matrix3D.create()
+    if _is_matrix_equal(combined_transform, identity):
+        trace.record('skipped', {'reason': 'identity transform'})
+        _flush_trace(trace, ui)
+        ui.messageBox(unchanged_message)
+        return None
+
+    if apply_mode == APPLY_OCCURRENCE:
+        try:
+            with PROFILER.span('occurrence_apply'):
+                occurrences = _apply_to_occurrences(meshes, combined)
+            trace.record('applied', lambda: {
+                'stages': [name for name, _ in stages],
+                'apply_mode': apply_mode,
+                'occurrences': [occ.fullPathName for occ in occurrences],
+            })
+            _flush_trace(trace, ui)
+            return occurrences
+        except Exception:
+            ui.messageBox('Failed to apply the occurrence transform:\n{}'.format(traceback.format_exc()))
+            return None
+
+    mesh_groups = _group_by_parent_component(meshes)
+    if mesh_groups is None:
+        ui.messageBox('Could not determine parent component of the selected mesh.')
+        return None
+
+    # Create move feature input with the transform
+    try:
+        move_features = _add_move_features(mesh_groups, combined_transform)
+        trace.record('applied', lambda: {
+            'stages': [name for name, _ in stages],
+            'apply_mode': apply_mode,
+            'components': len(mesh_groups),
+            'move_features': len(move_features),
+        })
+
+        # Preview-related user prompts removed. If debug is enabled, append the trace silently.
+        _flush_trace(trace, ui)
+        return move_features
                 
-                # Use two-plane alignment for better control
-                move_transform = compute_two_plane_transform(src_geom1, tgt_geom1, src_geom2, tgt_geom2)
-                debug_info += 'Using TWO-PLANE alignment\n\n'
+    except Exception:
+        ui.messageBox('Failed to create and apply move feature:\n{}'.format(traceback.format_exc()))
+        return None
+
+
+def _commit_poses(meshes, poses, trace, ui, apply_mode=APPLY_MOVE_FEATURE):
+    """Move each mesh by its own pose (see _commit_alignment)
+
+    Meshes whose pose is the identity are left alone. Returns the indices
+    of the moved meshes, or None if applying failed.
+    """
+    identity = adsk.core.Matrix3D.create()
+    moved = []
+    try:
+        for index, (mesh, pose) in enumerate(zip(meshes, poses)):
+            transform = _array_to_matrix(pose)
+            if _is_matrix_equal(transform, identity):
+                continue
+            if apply_mode == APPLY_OCCURRENCE:
+                with PROFILER.span('occurrence_apply'):
+                    _apply_to_occurrences([mesh], pose)
             else:
-                # Fall back to single plane alignment
-                move_transform = compute_single_plane_transform(src_geom1, tgt_geom1)
-                debug_info += 'Using SINGLE-PLANE alignment (plane 2 geometry missing)\n\n'
+                _add_move_features(_group_by_parent_component([mesh]), transform)
+            moved.append(index)
+    except Exception:
+        ui.messageBox('Failed to move the fragments ({} of {} moved):\n{}'.format(
+            len(moved), len(meshes), traceback.format_exc()))
+        return None
+    trace.record('applied', {'stages': ['pose_graph'], 'apply_mode': apply_mode, 'moved': len(moved)})
+    _flush_trace(trace, ui)
+    return moved
+
+
+def _apply_to_occurrences(meshes, matrix):
+    """Move the meshes by writing matrix into their occurrences' transforms
+
+    Bodies are grouped by the occurrence that holds them. If that occurrence
+    also holds anything that was not selected (or the body lives directly in
+    the root component), the selected bodies are first moved into a new child
+    occurrence so nothing else moves with them. Proxy occurrences are used
+    throughout, so transform2 is in assembly (world) space at any nesting
+    depth. The root component is activated while editing and the previously
+    active component is restored afterwards.
+    """
+    app = adsk.core.Application.get()
+    design = adsk.fusion.Design.cast(app.activeProduct)
+    previous_active = design.activeOccurrence
+    if previous_active:
+        design.activateRootComponent()
+    try:
+        occurrences = []
+        for occurrence, bodies in _group_by_occurrence(meshes):
+            if occurrence is None or _has_unselected_contents(occurrence.component, bodies):
+                occurrence = _wrap_in_occurrence(bodies, occurrence)
+            new_transform = matrix @ _matrix_to_array(occurrence.transform2)
+            occurrence.transform2 = _array_to_matrix(new_transform)
+            occurrences.append(occurrence)
+
+        # Parametric designs need the new occurrence positions captured,
+        # otherwise the next recompute puts them back
+        if design.designType == adsk.fusion.DesignTypes.ParametricDesignType:
+            if design.snapshots.hasPendingSnapshot:
+                design.snapshots.add()
+        return occurrences
+    finally:
+        if previous_active:
+            previous_active.activate()
+
+
+def _group_by_occurrence(meshes):
+    """Group bodies by their assembly context (None for bodies in the root component)"""
+    groups = []
+    by_path = {}
+    for mesh in meshes:
+        occurrence = mesh.assemblyContext
+        key = occurrence.fullPathName if occurrence else None
+        group = by_path.get(key)
+        if group is None:
+            group = (occurrence, [])
+            by_path[key] = group
+            groups.append(group)
+        group[1].append(mesh)
+    return groups
+
+
+def _has_unselected_contents(component, bodies):
+    """True if component holds anything besides the given bodies (which would move along)
+
+    Child occurrences, sketches and construction geometry move with the
+    occurrence just like other bodies do.
+    """
+    others = (component.occurrences.count + component.sketches.count + component.constructionPlanes.count +
+              component.constructionAxes.count + component.constructionPoints.count)
+    return others > 0 or component.bRepBodies.count + component.meshBodies.count > len(bodies)
+
+
+def _wrap_in_occurrence(bodies, parent_occurrence):
+    """Move bodies into a new child occurrence of their component and return it (as a proxy)"""
+    parent_comp = bodies[0].parentComponent
+    occurrence = parent_comp.occurrences.addNewComponent(adsk.core.Matrix3D.create())
+    occurrence.component.name = '{} (aligned)'.format(bodies[0].name)
+    if parent_occurrence:
+        occurrence = occurrence.createForAssemblyContext(parent_occurrence)
+    for body in bodies:
+        body.moveToComponent(occurrence)
+    return occurrence
+
+
+def _body_mesh_arrays(body):
+    """Vertices (N, 3) float32 and triangle indices (M, 3) int32 of a mesh or solid body
+
+    The API hands the mesh over as Python lists, which are converted straight
+    into compact contiguous arrays and dropped. The arrays of the last
+    MESH_CACHE_SIZE bodies are kept until the body changes (see
+    _entity_keys), so a body is read only once per edit.
+    """
+    key = _entity_keys([body])
+    arrays = _mesh_cache.get(key)
+    if arrays is not None:
+        _mesh_cache.move_to_end(key)
+        return arrays
+    mesh_body = adsk.fusion.MeshBody.cast(body)
+    if mesh_body:
+        tri_mesh = mesh_body.displayMesh
+    else:
+        calculator = adsk.fusion.BRepBody.cast(body).meshManager.createMeshCalculator()
+        calculator.setQuality(adsk.fusion.TriangleMeshQualityOptions.NormalQualityTriangleMesh)
+        tri_mesh = calculator.calculate()
+    vertices = np.array(tri_mesh.nodeCoordinatesAsFloat, dtype=np.float32).reshape(-1, 3)
+    triangles = np.array(tri_mesh.nodeIndices, dtype=np.int32).reshape(-1, 3)
+    if len(_mesh_cache) >= MESH_CACHE_SIZE:
+        _mesh_cache.popitem(last=False)
+    _mesh_cache[key] = (vertices, triangles)
+    return vertices, triangles
+
+
+class FittedPlane(object):
+    """Plane fitted to a region of a mesh
+
+    Exposes a ``geometry`` Plane like a ConstructionPlane does, so it can be
+    passed to perform_alignment in place of a construction plane.
+    """
+    def __init__(self, plane_array, inlier_count):
+        self.plane_array = plane_array
+        self.inlier_count = inlier_count
+
+    @property
+    def geometry(self):
+        return _array_to_plane(self.plane_array)
+
+
+class PendingPlane(object):
+    """Plane still to be fitted or detected on a mesh
+
+    Made on the main thread once the mesh is read; fit() runs the memoized
+    fit without the Fusion API, so the alignment job does it on the worker
+    thread. It returns a FittedPlane, or None, for which failure is the
+    message to show. key names the result in the caches.
+    """
+    def __init__(self, key, compute, failure):
+        self.key = key
+        self.failure = failure
+        self._compute = compute
+
+    def fit(self):
+        return _cached(self.key, self._compute)
+
+
+def _plane_from_selection(selection, fit_radius, failure):
+    """Return the selected ConstructionPlane, or a PendingPlane around a point picked on a mesh"""
+    entity = selection.entity
+    plane = adsk.fusion.ConstructionPlane.cast(entity)
+    if plane:
+        return plane
+    mesh_body = adsk.fusion.MeshBody.cast(entity)
+    if not mesh_body:
+        return None
+    seed_point = _point_to_array(selection.point)
+    cache_key = ('fitted_plane', _entity_keys([mesh_body]), tuple(np.round(seed_point, 9)), fit_radius)
+    fitted = _cache_lookup(cache_key)
+    if fitted is not None:
+        return PendingPlane(cache_key, lambda: fitted, failure)
+    index = _index_loader(mesh_body)
+    return PendingPlane(cache_key, lambda: fit_plane_at_point(index(), seed_point, fit_radius), failure)
+
+
+def _cached_mesh_index(body_key, vertices, triangles):
+    """TriangleBVH of a body's mesh arrays, memoized under its _entity_keys key
+
+    Region picking and the deviation check share it. Uses no Fusion API.
+    """
+    def build():
+        with PROFILER.span('mesh_index'):
+            return TriangleBVH(vertices, triangles)
+    return _cached(('mesh_index',) + body_key, build)
+
+
+def _index_loader(body):
+    """Read a body on the main thread for its TriangleBVH
+
+    Returns a function that gives the memoized index, or None when the body
+    has no triangles, without touching the Fusion API. A memoized index is
+    not read again.
+    """
+    body_key = _entity_keys([body])
+    index = _cache_lookup(('mesh_index',) + body_key)
+    if index is not None:
+        return lambda: index
+    with PROFILER.span('mesh_read'):
+        vertices, triangles = _body_mesh_arrays(body)
+    if not len(vertices) or not len(triangles):
+        return lambda: None
+    return lambda: _cached_mesh_index(body_key, vertices, triangles)
+
+
+def fit_plane_at_point(index, seed_point, radius):
+    """Fit a plane (RANSAC + PCA) to the mesh vertices within radius of seed_point
+
+    index is the TriangleBVH of the mesh, or None for a mesh without
+    triangles. The seed point is snapped onto the surface first, and the
+    region is gathered from the triangles the index finds within radius of
+    it. Uses no Fusion API.
+    """
+    if index is None:
+        return None
+    with PROFILER.span('plane_fit'):
+        _, _, snapped = index.closest_points(seed_point)
+        _, triangles = index.within_radius(snapped, radius)
+        region = index.vertices[np.unique(index.triangles[triangles])]
+        offsets = region - snapped
+        region = region[np.einsum('ij,ij->i', offsets, offsets) <= radius * radius]
+        if len(region) < 3:
+            return None
+        region = _sample_points(region, PLANE_FIT_SAMPLE_COUNT)
+        plane_array, inliers = mesh_align_fit.fit_plane(
+            region, outward_from=index.vertices.mean(axis=0, dtype=np.float64))
+    return FittedPlane(plane_array, int(np.count_nonzero(inliers)))
+
+
+def _symmetry_plane(mesh_body, failure):
+    """Read a mesh body for a PendingPlane on its detect_symmetry_plane result"""
+    cache_key = ('symmetry_plane', _entity_keys([mesh_body]), SYMMETRY_SAMPLE_COUNT)
+    fitted = _cache_lookup(cache_key)
+    if fitted is not None:
+        return PendingPlane(cache_key, lambda: fitted, failure)
+    with PROFILER.span('mesh_read'):
+        vertices, triangles = _body_mesh_arrays(mesh_body)
+    return PendingPlane(cache_key, lambda: detect_symmetry_plane(vertices, triangles), failure)
+
+
+def detect_symmetry_plane(vertices, triangles):
+    """FittedPlane on the dominant reflective symmetry plane of a mesh, or None
+
+    Votes and refines on SYMMETRY_SAMPLE_COUNT vertices and their vertex
+    normals (see mesh_align_symmetry.detect_symmetry_planes); the inliers are
+    the vertices whose mirror image lies on the mesh. Uses no Fusion API.
+    """
+    if not len(triangles):
+        return None
+    with PROFILER.span('symmetry'):
+        keep = mesh_align_sampling.downsample_indices(vertices, SYMMETRY_SAMPLE_COUNT, SAMPLING_METHOD)
+        normals = mesh_align_fit.vertex_normals(vertices, triangles)[keep]
+        found = mesh_align_symmetry.detect_symmetry_planes(vertices[keep], normals)
+    if not found:
+        return None
+    return FittedPlane(found[0].plane, int(round(found[0].score * len(keep))))
+
+
+def _sample_points(points, count, seed=0):
+    """Deterministic sample of at most count points, drawn with SAMPLING_METHOD"""
+    with PROFILER.span('downsample'):
+        return mesh_align_sampling.downsample(points, count, SAMPLING_METHOD, seed)
+
+
+def _vertex_sampler(meshes, count):
+    """Read the meshes on the main thread for a sample of at most count of their vertices
+
+    Returns a function that draws the sample without touching the Fusion
+    API, so it can be called on the worker thread. Each body's sample is
+    memoized until the body changes, and a memoized one is not read again.
+    The vertices are taken before any move.
+    """
+    parts = []
+    for key, mesh in zip(_entity_keys(meshes), meshes):
+        key = ('sample', key, count, SAMPLING_METHOD)
+        sample = _cache_lookup(key)
+        if sample is None:
+            with PROFILER.span('mesh_read'):
+                parts.append((key, None, _body_mesh_arrays(mesh)[0]))
         else:
-            # Single plane alignment
-            move_transform = compute_single_plane_transform(src_geom1, tgt_geom1)
-            debug_info += 'Using SINGLE-PLANE alignment\n\n'
-        
-        # Apply 180-degree flip if requested (only for plane 1)
-        flip_transform = None
-        if flip_direction:
-            # Compute where the source origin will be after the base transform
-            src_origin_after_align = src_geom1.origin.copy()
-            src_origin_after_align.transformBy(move_transform)
-
-            # To flip 180°, rotate around an axis that lies IN the target plane (the uDirection)
-            # CRITICAL: The rotation center must be OFFSET from the mesh origin, otherwise
-            # rotating around an axis through the origin keeps the origin stationary
-            # We'll offset along the plane's normal by a small amount to create a "hinge" effect
-            flip_axis = tgt_geom1.uDirection.copy()
-            try:
-                flip_axis.normalize()
-            except:
-                pass
-            
-            # Create rotation center offset from the aligned origin
-            # Move 10 units along the target plane normal to create a hinge point
-            rotation_center = src_origin_after_align.copy()
-            offset_vector = tgt_geom1.normal.copy()
-            offset_vector.normalize()
-            offset_vector.scaleBy(10.0)  # 10mm offset
-            rotation_center.translateBy(offset_vector)
-            
-            flip_transform = adsk.core.Matrix3D.create()
-            flip_transform.setToRotation(
-                3.14159265359,  # 180 degrees in radians (pi)
-                flip_axis,  # Rotation axis IN the plane (uDirection)
-                rotation_center  # Rotation center OFFSET from mesh origin
-            )
-
-            # Do not combine here; apply flip as a separate move feature after the main move
-            debug_info += 'Computed 180° FLIP transform around uDirection axis\n'
-            debug_info += '  Flip axis: ({:.3f}, {:.3f}, {:.3f})\n'.format(
-                flip_axis.x, flip_axis.y, flip_axis.z)
-            debug_info += '  Rotation center (offset): ({:.2f}, {:.2f}, {:.2f})\n\n'.format(
-                rotation_center.x, rotation_center.y, rotation_center.z)
-        
-        # Calculate where source plane 1 will move to
-        src1_origin_transformed = src_geom1.origin.copy()
-        src1_origin_transformed.transformBy(move_transform)
-        
-        src1_normal_transformed = src_geom1.normal.copy()
-        src1_normal_transformed.transformBy(move_transform)
-        
-        debug_info += 'PREDICTED SOURCE PLANE 1 (After transform):\n'
-        debug_info += '  Origin: ({:.2f}, {:.2f}, {:.2f})\n'.format(
-            src1_origin_transformed.x, src1_origin_transformed.y, src1_origin_transformed.z)
-        debug_info += '  Normal: ({:.3f}, {:.3f}, {:.3f})\n\n'.format(
-            src1_normal_transformed.x, src1_normal_transformed.y, src1_normal_transformed.z)
-
-        # If a flip was requested, compute and log predicted positions after the flip (without applying it)
-        if flip_direction and flip_transform is not None:
-            try:
-                # Compute flip center (offset from source origin after alignment)
-                flip_center = src_geom1.origin.copy()
-                flip_center.transformBy(move_transform)
-                offset_vector = tgt_geom1.normal.copy()
-                offset_vector.normalize()
-                offset_vector.scaleBy(10.0)
-                flip_center.translateBy(offset_vector)
-
-                debug_info += 'FLIP (planned) center (offset): ({:.2f}, {:.2f}, {:.2f})\n'.format(
-                    flip_center.x, flip_center.y, flip_center.z)
-
-                # Predict source plane 1 after flip by applying flip_transform to the already-transformed points
-                src1_origin_postflip = src1_origin_transformed.copy()
-                src1_origin_postflip.transformBy(flip_transform)
-                src1_normal_postflip = src1_normal_transformed.copy()
-                src1_normal_postflip.transformBy(flip_transform)
-
-                debug_info += 'PREDICTED SOURCE PLANE 1 (After flip):\n'
-                debug_info += '  Origin: ({:.2f}, {:.2f}, {:.2f})\n'.format(
-                    src1_origin_postflip.x, src1_origin_postflip.y, src1_origin_postflip.z)
-                debug_info += '  Normal: ({:.3f}, {:.3f}, {:.3f})\n\n'.format(
-                    src1_normal_postflip.x, src1_normal_postflip.y, src1_normal_postflip.z)
-            except Exception:
-                debug_info += 'Failed to compute predicted post-flip positions: {}\n\n'.format(traceback.format_exc())
-        
-        if src_plane2 and tgt_plane2 and src_geom2:
-            src2_origin_transformed = src_geom2.origin.copy()
-            src2_origin_transformed.transformBy(move_transform)
-            
-            src2_normal_transformed = src_geom2.normal.copy()
-            src2_normal_transformed.transformBy(move_transform)
-            
-            debug_info += 'PREDICTED SOURCE PLANE 2 (After transform):\n'
-            debug_info += '  Origin: ({:.2f}, {:.2f}, {:.2f})\n'.format(
-                src2_origin_transformed.x, src2_origin_transformed.y, src2_origin_transformed.z)
-            debug_info += '  Normal: ({:.3f}, {:.3f}, {:.3f})\n\n'.format(
-                src2_normal_transformed.x, src2_normal_transformed.y, src2_normal_transformed.z)
-        
-        # Calculate translation distance
-        distance = src_geom1.origin.distanceTo(src1_origin_transformed)
-        debug_info += 'Translation distance: {:.2f} mm\n\n'.format(distance)
-        
-        debug_info += '='*50 + '\n'
+            parts.append((key, sample, None))
+
+    def draw():
+        points = np.concatenate([
+            sample if sample is not None else _cached(key, lambda: _sample_points(vertices, count))
+            for key, sample, vertices in parts])
+        return _sample_points(points, count)
+    return draw
+
+
+def _surface_loader(reference):
+    """Read a body on the main thread for a SurfaceReference
+
+    Returns a function that builds the (memoized) SurfaceReference without
+    touching the Fusion API, so it can be called on the worker thread. It
+    gives None when the body has no triangles. A memoized surface is not
+    read again.
+    """
+    body_key = _entity_keys([reference])
+    key = ('surface',) + body_key
+    surface = _cache_lookup(key)
+    if surface is not None:
+        return lambda: surface
+    with PROFILER.span('mesh_read'):
+        vertices, triangles = _body_mesh_arrays(reference)
+    if not len(vertices) or not len(triangles):
+        return lambda: None
+    # The mesh index is only built if the surface is used for a deviation check
+    index = lambda: _cached_mesh_index(body_key, vertices, triangles)
+    return lambda: _cached(key, lambda: mesh_align_quality.SurfaceReference(
+        vertices, triangles, REFERENCE_SAMPLE_COUNT, SAMPLING_METHOD, index))
+
+
+def _prepare_quality(meshes, quality, default_reference=None):
+    """Main-thread part of the deviation check
+
+    The reference is the body chosen in the dialog, else default_reference
+    (the best-fit reference), else the target planes. The vertices are
+    sampled before the move, so the check does not depend on how they are
+    moved. Returns (vertex sampler, surface loader or None, what is measured
+    against); see _vertex_sampler and _surface_loader.
+    """
+    reference = quality.get('reference') or default_reference
+    sampler = _vertex_sampler(meshes, QUALITY_SAMPLE_COUNT)
+    if reference:
+        return sampler, _surface_loader(reference), reference.name
+    return sampler, None, 'target planes'
+
+
+def measure_quality(points, tolerance, surface=None, target_planes=None):
+    """Deviation report of aligned points against a SurfaceReference, else the target planes
+
+    Against planes only vertices within QUALITY_PLANE_BAND_FACTOR tolerances
+    of a plane are measured. Uses no Fusion API.
+    """
+    with PROFILER.span('quality'):
+        if surface is not None:
+            deviations = mesh_align_quality.deviation_to_surface(points, surface)
+        else:
+            deviations, _ = mesh_align_quality.deviation_to_planes(
+                points, target_planes, QUALITY_PLANE_BAND_FACTOR * tolerance)
+        return mesh_align_quality.deviation_report(deviations, tolerance)
+
+
+def _report_quality(report, against, tolerance, trace, ui):
+    """Trace a deviation report and show it; the message flags runs that exceed the tolerance"""
+    trace.record('quality', dict(report, reference=against))
+    _flush_trace(trace, ui)
+
+    if not report['count']:
+        _message(ui, 'Deviation check: no vertices lie within {} of the {}; nothing was measured.'.format(
+            _format_mm(QUALITY_PLANE_BAND_FACTOR * tolerance), against))
+        return report
+    _message(ui, 'Deviation check {} against {}\n\n'
+                 'RMS: {}\nMax: {}\n95th percentile: {} (tolerance {})\n'
+                 'Within tolerance: {:.1f}% of {} sampled vertices'.format(
+                     'PASSED' if report['passed'] else 'FAILED', against,
+                     _format_mm(report['rms']), _format_mm(report['max_abs']),
+                     _format_mm(report['percentiles']['p95']), _format_mm(tolerance),
+                     100.0 * report['within_tolerance'], report['count']))
+    return report
 
-        # Skip if transform is effectively identity
-        identity = adsk.core.Matrix3D.create()
-        if _is_matrix_equal(move_transform, identity):
-            ui.messageBox('Source plane already aligned to target plane. No action taken.')
-            return
 
+def _format_mm(value):
+    """Format a length in internal units (cm) as millimetres"""
+    return '{:.3f} mm'.format(value * 10.0)
+
+
+def _plane_trace_fields(role, index, plane):
+    """Trace fields for a plane array, including its computed vDirection"""
+    return {
+        'role': role,
+        'index': index,
+        'origin': plane[mesh_align_core.ORIGIN],
+        'normal': plane[mesh_align_core.NORMAL],
+        'u_direction': plane[mesh_align_core.U_DIRECTION],
+        'v_direction': mesh_align_core.normalize(np.cross(
+            plane[mesh_align_core.U_DIRECTION], plane[mesh_align_core.NORMAL])),
+    }
+
+
+def _stage_predictions(stages, src_plane_arrays):
+    """Predicted source plane origins/normals after each cumulative stage"""
+    predictions = []
+    cumulative = np.eye(4)
+    for stage_name, stage_matrix in stages:
+        cumulative = stage_matrix @ cumulative
+        for index, plane_array in enumerate(src_plane_arrays):
+            predictions.append({
+                'stage': stage_name,
+                'plane': index + 1,
+                'origin': mesh_align_core.transform_points(cumulative, plane_array[mesh_align_core.ORIGIN]),
+                'normal': mesh_align_core.transform_vectors(cumulative, plane_array[mesh_align_core.NORMAL]),
+            })
+    return predictions
+
+
+def _flush_trace(trace, ui):
+    """Append the trace to disk; show it in a message box if the write fails"""
+    if not trace:
+        return
+    with PROFILER.span('trace_write'):
+        written = trace.flush()
+    if not written:
+        ui.messageBox(trace.lines())
+
+
+def _export_profile(ui):
+    """Write the cumulative phase timings next to the script when profiling is on"""
+    if not PROFILER.enabled:
+        return
+    try:
+        for file_name in PROFILE_FILE_NAMES:
+            PROFILER.export(os.path.join(_SCRIPT_DIR, file_name))
+    except (IOError, OSError):
+        ui.messageBox('Could not write the profile files:\n{}'.format(traceback.format_exc()))
+
+
+def compute_flip_transform(src_plane, tgt_plane, align_matrix, hinge_offset=10.0):
+    """Compute the 180° flip applied after alignment
+
+    To flip 180°, rotate around an axis that lies IN the target plane (the
+    uDirection), offset hinge_offset cm along the target normal (see
+    mesh_align_core.flip_transforms). Returns (axis, center, matrix) as arrays.
+    """
+    return mesh_align_core.flip_transforms(src_plane, tgt_plane, align_matrix, hinge_offset)
+
+
+def _group_by_parent_component(meshes):
+    """Group mesh bodies by parent component so each group can share one MoveFeature
+
+    Returns a list of (component, [bodies]) in selection order, or None if any
+    body has no parent component.
+    """
+    groups = []
+    by_id = {}
+    for mesh in meshes:
         parent_comp = mesh.parentComponent
         if not parent_comp:
-            ui.messageBox('Could not determine parent component of the selected mesh.')
-            return
+            return None
+        group = by_id.get(parent_comp.id)
+        if group is None:
+            group = (parent_comp, [])
+            by_id[parent_comp.id] = group
+            groups.append(group)
+        group[1].append(mesh)
+    return groups
 
-        move_feats = parent_comp.features.moveFeatures
+
+def _add_move_features(mesh_groups, transform):
+    """Apply one transform to every body with a single MoveFeature per component"""
+    features = []
+    for parent_comp, bodies in mesh_groups:
         ents = adsk.core.ObjectCollection.create()
-        ents.add(mesh)
+        for body in bodies:
+            ents.add(body)
+        move_feats = parent_comp.features.moveFeatures
+        with PROFILER.span('move_create_input'):
+            input_move = move_feats.createInput(ents, transform)
+        with PROFILER.span('move_add'):
+            features.append(move_feats.add(input_move))
+    return features
+
+
+def _add_construction_plane(component, plane_array, name):
+    """Create a construction plane on a plane array in component
 
-        # Create move feature input with the transform
+    A parametric design only takes a plane given by geometry inside a base
+    feature, so there it goes into a new one that holds just the plane.
+    """
+    planes = component.constructionPlanes
+    plane_input = planes.createInput()
+    plane_input.setByPlane(_array_to_plane(plane_array))
+    if _is_parametric_design():
+        feature = component.features.baseFeatures.add()
+        feature.startEdit()
         try:
-            input_move = move_feats.createInput(ents, move_transform)
-            move_feature = move_feats.add(input_move)
-            flip_feature = None
-
-            # If a flip transform was computed, add it as a second move feature (applies after the first)
-            if flip_transform is not None:
-                try:
-                    input_flip = move_feats.createInput(ents, flip_transform)
-                    flip_feature = move_feats.add(input_flip)
-                    debug_info += 'Applied flip transform as second move feature\n\n'
-                except Exception:
-                    debug_info += 'Failed to add flip move feature: {}\n\n'.format(traceback.format_exc())
-                    flip_feature = None
-
-            # Preview-related user prompts removed. If debug is enabled, save debug info to file silently.
-            if debug_mode:
-                try:
-                    import os
-                    script_dir = os.path.dirname(os.path.abspath(__file__))
-                    debug_file = os.path.join(script_dir, 'mesh_align_debug.txt')
-                    with open(debug_file, 'w') as f:
-                        f.write(debug_info)
-                except:
-                    # As a fallback, show debug info in a message box if file write fails
-                    ui.messageBox(debug_info)
-                # No success message when not in debug mode
-                    
-        except Exception:
-            ui.messageBox('Failed to create and apply move feature:\n{}'.format(traceback.format_exc()))
-            return
-            
-    except:
-        if ui:
-            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+            plane_input.targetBaseFeature = feature
+            plane = planes.add(plane_input)
+        finally:
+            feature.finishEdit()
+    else:
+        plane = planes.add(plane_input)
+    plane.name = name
+    return plane
+
+
+def _is_parametric_design():
+    """True if the active design records a timeline (base features need one)"""
+    design = adsk.fusion.Design.cast(adsk.core.Application.get().activeProduct)
+    return bool(design) and design.designType == adsk.fusion.DesignTypes.ParametricDesignType
 
 
 def compute_single_plane_transform(src_geom, tgt_geom):
     """Compute transform to align one plane to another"""
-    # Compute Z axes for both planes (perpendicular to the plane surface)
-    src_z = src_geom.normal.crossProduct(src_geom.uDirection)
-    src_z.normalize()
-    
-    tgt_z = tgt_geom.normal.crossProduct(tgt_geom.uDirection)
-    tgt_z.normalize()
-    
-    # Create transform that aligns source plane coordinate system to target plane coordinate system
-    move_transform = adsk.core.Matrix3D.create()
-    move_transform.setToAlignCoordinateSystems(
-        src_geom.origin,
-        src_geom.uDirection,
-        src_geom.normal,
-        src_z,
-        tgt_geom.origin,
-        tgt_geom.uDirection,
-        tgt_geom.normal,
-        tgt_z
-    )
-    return move_transform
+    matrix = mesh_align_core.single_plane_transforms(
+        _plane_to_array(src_geom), _plane_to_array(tgt_geom))
+    return _array_to_matrix(matrix)
 
 
 def compute_two_plane_transform(src_geom1, tgt_geom1, src_geom2, tgt_geom2):
@@ -524,47 +2141,48 @@ def compute_two_plane_transform(src_geom1, tgt_geom1, src_geom2, tgt_geom2):
     - The mesh is positioned so both planes pass through their target origins
     
     Strategy: Use the intersection line of the two planes as the primary alignment axis.
+    The math lives in mesh_align_core.two_plane_transforms.
     """
-    
-    # Step 1: Compute the intersection line direction for both source and target plane pairs
-    # The cross product of two plane normals gives the direction of their intersection line
-    src_axis = src_geom1.normal.crossProduct(src_geom2.normal)
-    src_axis.normalize()
-    
-    tgt_axis = tgt_geom1.normal.crossProduct(tgt_geom2.normal)
-    tgt_axis.normalize()
-    
-    # Step 2: Build coordinate systems using intersection line and first plane normal
-    # X = intersection direction, Y = plane1 normal, Z = X cross Y
-    src_x = src_axis.copy()
-    src_y = src_geom1.normal.copy()
-    src_z = src_x.crossProduct(src_y)
-    src_z.normalize()
-    
-    tgt_x = tgt_axis.copy()
-    tgt_y = tgt_geom1.normal.copy()
-    tgt_z = tgt_x.crossProduct(tgt_y)
-    tgt_z.normalize()
-    
-    # Step 3: Use plane 1's origin as the reference point for translation
-    # This ensures plane 1 origin aligns exactly with target 1 origin
-    src_origin = src_geom1.origin.copy()
-    tgt_origin = tgt_geom1.origin.copy()
-    
-    # Step 4: Create the transform using these coordinate systems
-    move_transform = adsk.core.Matrix3D.create()
-    move_transform.setToAlignCoordinateSystems(
-        src_origin,
-        src_x,
-        src_y,
-        src_z,
-        tgt_origin,
-        tgt_x,
-        tgt_y,
-        tgt_z
-    )
-    
-    return move_transform
+    matrix = mesh_align_core.two_plane_transforms(
+        _plane_to_array(src_geom1), _plane_to_array(tgt_geom1),
+        _plane_to_array(src_geom2), _plane_to_array(tgt_geom2))
+    return _array_to_matrix(matrix)
+
+
+def _plane_to_array(geom):
+    """Pack a Plane's origin, normal and uDirection into a 3x3 array for mesh_align_core"""
+    return np.array([
+        [geom.origin.x, geom.origin.y, geom.origin.z],
+        [geom.normal.x, geom.normal.y, geom.normal.z],
+        [geom.uDirection.x, geom.uDirection.y, geom.uDirection.z],
+    ])
+
+
+def _point_to_array(point):
+    """Convert a Point3D into a NumPy array"""
+    return np.array([point.x, point.y, point.z])
+
+
+def _array_to_plane(plane_array):
+    """Convert a 3x3 plane array into a Plane with the same origin, normal and uDirection"""
+    origin, normal, u_direction = [np.asarray(row, dtype=np.float64) for row in plane_array]
+    v_direction = mesh_align_core.normalize(np.cross(normal, u_direction))
+    plane = adsk.core.Plane.create(
+        adsk.core.Point3D.create(*origin), adsk.core.Vector3D.create(*normal))
+    plane.setUVDirections(adsk.core.Vector3D.create(*u_direction), adsk.core.Vector3D.create(*v_direction))
+    return plane
+
+
+def _array_to_matrix(matrix):
+    """Convert a 4x4 NumPy matrix into a Matrix3D"""
+    result = adsk.core.Matrix3D.create()
+    result.setWithArray([float(v) for v in np.asarray(matrix).reshape(16)])
+    return result
+
+
+def _matrix_to_array(matrix):
+    """Convert a Matrix3D into a 4x4 NumPy matrix"""
+    return np.array(matrix.asArray(), dtype=np.float64).reshape(4, 4)
 
 
 def _is_matrix_equal(m1, m2, tol=1e-6):
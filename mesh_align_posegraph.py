@@ -0,0 +1,314 @@
+"""Pose-graph solver for aligning several mesh fragments in one step.
+
+Node 0 is a fixed root (the reference body) and nodes 1..N are fragments.
+Each edge is a relative measurement: a 4x4 matrix (mesh_align_core
+convention) that moves fragment i onto node j where both are now, from a
+plane-pair alignment or a best fit. Aligning the fragments one after another
+adds up the error of every step. Here all the poses are solved together in
+a weighted least-squares sense, so redundant edges (loop closures) spread
+the error instead of pushing it down the chain.
+
+The solver is Gauss-Newton on rigid transforms with sparse normal equations.
+It uses SciPy's sparse solver when SciPy is importable and dense NumPy
+otherwise, which is fine for the few dozen fragments of a dialog run.
+"""
+import collections
+
+import numpy as np
+
+import mesh_align_core
+
+try:
+    from scipy.sparse import coo_matrix as _coo_matrix
+    from scipy.sparse.linalg import spsolve as _spsolve
+except ImportError:
+    _coo_matrix = None
+    _spsolve = None
+
+
+ROOT = 0
+
+# Default length (internal units) that turns a rotation error in radians
+# into a distance, so both parts of an edge residual have the same weight;
+# use the typical fragment radius
+ROTATION_WEIGHT = 10.0
+
+# Each unknown gets this share of the largest Hessian entry added to its
+# diagonal. Directions no edge constrains (e.g. the shift along a single
+# plane pair) then keep their starting value instead of making the normal
+# equations singular.
+DAMPING = 1e-9
+
+
+class PoseGraphResult(object):
+    """Outcome of solve_pose_graph"""
+
+    def __init__(self, poses, iterations, converged, residuals, cost):
+        self.poses = poses
+        self.iterations = iterations
+        self.converged = converged
+        self.residuals = residuals
+        self.cost = cost
+
+    def as_dict(self):
+        return {
+            'poses': self.poses,
+            'iterations': self.iterations,
+            'converged': self.converged,
+            'residuals': self.residuals,
+            'cost': self.cost,
+        }
+
+
+def _skew(vectors):
+    """Cross-product matrices of vectors of shape (..., 3)"""
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+    zero = np.zeros_like(x)
+    return np.stack([
+        np.stack([zero, -z, y], axis=-1),
+        np.stack([z, zero, -x], axis=-1),
+        np.stack([-y, x, zero], axis=-1),
+    ], axis=-2)
+
+
+def rotation_vectors(rotations):
+    """Rotation vectors (axis times angle) of rotation matrices of shape (..., 3, 3)"""
+    rotations = np.asarray(rotations, dtype=np.float64)
+    cos = np.clip((np.trace(rotations, axis1=-2, axis2=-1) - 1.0) * 0.5, -1.0, 1.0)
+    angle = np.arccos(cos)
+    skew = np.stack([
+        rotations[..., 2, 1] - rotations[..., 1, 2],
+        rotations[..., 0, 2] - rotations[..., 2, 0],
+        rotations[..., 1, 0] - rotations[..., 0, 1],
+    ], axis=-1)
+    sin = np.sin(angle)
+    # angle / (2 sin) tends to 1/2 for small angles
+    scale = np.where(sin > 1e-9, angle / (2.0 * np.where(sin > 1e-9, sin, 1.0)), 0.5)
+    vectors = skew * scale[..., None]
+    # Near 180 degrees the skew part vanishes; take the axis from R + I instead
+    flipped = cos < -0.99
+    if np.any(flipped):
+        sym = (rotations[flipped] + np.eye(3)) * 0.5
+        column = np.argmax(np.diagonal(sym, axis1=-2, axis2=-1), axis=-1)
+        axes = mesh_align_core.normalize(sym[np.arange(len(sym)), :, column])
+        # Keep the sign that agrees with the skew part
+        sign = np.where(np.einsum('...i,...i->...', axes, skew[flipped]) < 0, -1.0, 1.0)
+        vectors[flipped] = axes * (sign * angle[flipped])[..., None]
+    return vectors
+
+
+def _inverse_right_jacobians(vectors):
+    """Inverse right Jacobians of SO(3) at rotation vectors of shape (..., 3)"""
+    angle = np.linalg.norm(vectors, axis=-1)
+    skew = _skew(vectors)
+    small = angle < 1e-6
+    safe = np.where(small, 1.0, angle)
+    coefficient = np.where(small, 1.0 / 12.0,
+                           1.0 / safe ** 2 - (1.0 + np.cos(safe)) / (2.0 * safe * np.sin(safe)))
+    return np.eye(3) + 0.5 * skew + coefficient[..., None, None] * (skew @ skew)
+
+
+def _adjoints(matrices):
+    """6x6 adjoints of rigid transforms, for twists ordered (translation, rotation)"""
+    rotation = matrices[..., :3, :3]
+    adjoint = np.zeros(matrices.shape[:-2] + (6, 6))
+    adjoint[..., :3, :3] = rotation
+    adjoint[..., :3, 3:] = _skew(matrices[..., :3, 3]) @ rotation
+    adjoint[..., 3:, 3:] = rotation
+    return adjoint
+
+
+def _rigid_inverse(matrices):
+    rotation_t = np.swapaxes(matrices[..., :3, :3], -1, -2)
+    inverse = mesh_align_core.identity(matrices.shape[:-2])
+    inverse[..., :3, :3] = rotation_t
+    inverse[..., :3, 3] = -np.einsum('...ij,...j->...i', rotation_t, matrices[..., :3, 3])
+    return inverse
+
+
+def _as_edges(edges):
+    """(sources, targets, measurements) arrays of a list of (i, j, matrix) edges"""
+    sources = np.array([i for i, _, _ in edges], dtype=np.intp)
+    targets = np.array([j for _, j, _ in edges], dtype=np.intp)
+    measurements = np.array([m for _, _, m in edges], dtype=np.float64).reshape(-1, 4, 4)
+    return sources, targets, measurements
+
+
+def _edge_errors(poses, sources, targets, measurements):
+    """Per-edge error transforms measurement^-1 pose_j^-1 pose_i, identity when consistent"""
+    return _rigid_inverse(measurements) @ _rigid_inverse(poses[targets]) @ poses[sources]
+
+
+def edge_residuals(poses, edges):
+    """Per-edge misfit of poses: 'translation' (distance) and 'angle' (radians)"""
+    errors = _edge_errors(np.asarray(poses, dtype=np.float64), *_as_edges(edges))
+    return {
+        'translation': np.linalg.norm(errors[:, :3, 3], axis=-1),
+        'angle': np.linalg.norm(rotation_vectors(errors[:, :3, :3]), axis=-1),
+    }
+
+
+def unconnected_nodes(count, edges):
+    """Nodes that no chain of edges links to the root"""
+    neighbours = collections.defaultdict(list)
+    for i, j, _ in edges:
+        neighbours[i].append(j)
+        neighbours[j].append(i)
+    reached = {ROOT}
+    queue = collections.deque([ROOT])
+    while queue:
+        for node in neighbours[queue.popleft()]:
+            if node not in reached:
+                reached.add(node)
+                queue.append(node)
+    return [node for node in range(count) if node not in reached]
+
+
+def initial_poses(count, edges):
+    """Poses from composing edges along a breadth-first spanning tree from the root
+
+    This is what aligning the fragments one after another would give; the
+    solver starts from it. Raises ValueError if a node is not connected.
+    """
+    missing = unconnected_nodes(count, edges)
+    if missing:
+        raise ValueError('Nodes {} are not connected to the root'.format(missing))
+    neighbours = collections.defaultdict(list)
+    for i, j, matrix in edges:
+        matrix = np.asarray(matrix, dtype=np.float64)
+        # pose_i = pose_j @ matrix, and the other way round
+        neighbours[j].append((i, matrix))
+        neighbours[i].append((j, _rigid_inverse(matrix)))
+    poses = mesh_align_core.identity((count,))
+    reached = {ROOT}
+    queue = collections.deque([ROOT])
+    while queue:
+        node = queue.popleft()
+        for other, matrix in neighbours[node]:
+            if other not in reached:
+                poses[other] = poses[node] @ matrix
+                reached.add(other)
+                queue.append(other)
+    return poses
+
+
+def plane_information(src_planes):
+    """Information matrix of an edge measured by aligning plane pairs
+
+    src_planes are the (K, 3, 3) planes on the edge's source node, where it
+    is now. A pair pins the offset along its normal and the tilt about the
+    axes in its plane, and leaves the shift in the plane and the turn about
+    the normal free. One pair constrains 3 of the 6 degrees of freedom, two
+    pairs 5. The result is over the (translation, rotation vector) residual
+    of solve_pose_graph, and the free directions are left to other edges.
+    """
+    normals = mesh_align_core.normalize(mesh_align_core.as_planes(src_planes)[..., mesh_align_core.NORMAL, :])
+    outer = np.einsum('ki,kj->ij', normals.reshape(-1, 3), normals.reshape(-1, 3))
+    information = np.zeros((6, 6))
+    information[:3, :3] = outer
+    information[3:, 3:] = np.trace(outer) * np.eye(3) - outer
+    return information
+
+
+def _range_projectors(matrices):
+    """Orthogonal projectors onto the column spaces of symmetric (..., 3, 3) matrices"""
+    return matrices @ np.linalg.pinv(matrices, rcond=1e-9, hermitian=True)
+
+
+def _solve_normal_equations(rows, columns, values, gradient, size):
+    """Solve the sparse system given by COO entries for the step -H^-1 g"""
+    if _coo_matrix is not None:
+        hessian = _coo_matrix((values, (rows, columns)), shape=(size, size)).tocsc()
+        return _spsolve(hessian, -gradient)
+    hessian = np.zeros((size, size))
+    np.add.at(hessian, (rows, columns), values)
+    return np.linalg.solve(hessian, -gradient)
+
+
+def solve_pose_graph(count, edges, weights=None, rotation_weight=ROTATION_WEIGHT, init=None,
+                     max_iterations=20, tolerance=1e-10, information=None):
+    """Least-squares poses of count nodes from relative (i, j, matrix) edges
+
+    An edge asks for pose_i == pose_j @ matrix, i.e. matrix moves node i
+    onto node j where both are now. The root (node 0) keeps the identity
+    pose. Each edge's error transform is measured by its translation and
+    rotation vector, the rotation scaled by rotation_weight, and weighted by
+    weights (default 1 per edge). information optionally gives each edge a
+    (6, 6) matrix over that residual, for edges that only constrain some
+    directions (see plane_information); the default is the identity.
+    Starts from init, or initial_poses, and runs Gauss-Newton until the
+    update is smaller than tolerance.
+
+    Returns a PoseGraphResult whose poses (count, 4, 4) move each node from
+    where it is now into place. Its residuals are the per-edge translation
+    and angle misfits in the directions the edge constrains. Raises
+    ValueError if a node has no path to the root.
+    """
+    sources, targets, measurements = _as_edges(edges)
+    weights = np.ones(len(sources)) if weights is None else np.asarray(weights, dtype=np.float64)
+    poses = initial_poses(count, edges)
+    if init is not None:
+        poses = np.array(init, dtype=np.float64)
+    scale = np.array([1.0] * 3 + [float(rotation_weight)] * 3)
+    information = np.eye(6) if information is None else np.asarray(information, dtype=np.float64)
+    information = weights[:, None, None] * (scale[:, None] * information * scale)
+
+    # Unknowns are the twists of nodes 1..count-1; -1 marks the fixed root
+    slots = np.arange(count) - 1
+    block = np.arange(6)
+    converged = count < 2
+    iteration = 0
+    for iteration in range(1, 0 if converged else max_iterations + 1):
+        errors = _edge_errors(poses, sources, targets, measurements)
+        rotation = rotation_vectors(errors[:, :3, :3])
+        residual = np.concatenate([errors[:, :3, 3], rotation], axis=1)
+        # Moving node i by twist xi (and node j by -xi) changes the error by
+        # this Jacobian times xi, to first order
+        local = np.zeros((len(sources), 6, 6))
+        local[:, :3, :3] = errors[:, :3, :3]
+        local[:, 3:, 3:] = _inverse_right_jacobians(rotation)
+        jacobian = local @ _adjoints(_rigid_inverse(poses[sources]))
+
+        weighted = information @ jacobian
+        hessian = np.einsum('eki,ekj->eij', jacobian, weighted)
+        gradient = np.einsum('eki,ek->ei', weighted, residual)
+
+        rows, columns, values = [], [], []
+        grad = np.zeros(6 * (count - 1))
+        for a_nodes, b_nodes, sign in ((sources, sources, 1.0), (targets, targets, 1.0),
+                                       (sources, targets, -1.0), (targets, sources, -1.0)):
+            keep = (slots[a_nodes] >= 0) & (slots[b_nodes] >= 0)
+            a = slots[a_nodes[keep]][:, None, None] * 6 + block[None, :, None]
+            b = slots[b_nodes[keep]][:, None, None] * 6 + block[None, None, :]
+            rows.append(np.broadcast_to(a, (len(a), 6, 6)).ravel())
+            columns.append(np.broadcast_to(b, (len(b), 6, 6)).ravel())
+            values.append((sign * hessian[keep]).ravel())
+        diagonal = np.arange(len(grad))
+        rows.append(diagonal)
+        columns.append(diagonal)
+        values.append(np.full(len(grad), DAMPING * np.abs(hessian).max()))
+        for nodes, sign in ((sources, 1.0), (targets, -1.0)):
+            keep = slots[nodes] >= 0
+            np.add.at(grad, (slots[nodes[keep]][:, None] * 6 + block).ravel(), (sign * gradient[keep]).ravel())
+        step = _solve_normal_equations(np.concatenate(rows), np.concatenate(columns),
+                                       np.concatenate(values), grad, len(grad)).reshape(-1, 6)
+
+        # Left update pose <- exp(twist) @ pose
+        angles = np.linalg.norm(step[:, 3:], axis=1)
+        update = mesh_align_core.rotation_about_axis(angles, step[:, 3:], np.zeros(3))
+        update[:, :3, 3] = step[:, :3]
+        poses[1:] = update @ poses[1:]
+        if np.abs(step).max() < tolerance:
+            converged = True
+            break
+
+    errors = _edge_errors(poses, sources, targets, measurements)
+    rotation = rotation_vectors(errors[:, :3, :3])
+    residual = np.concatenate([errors[:, :3, 3], rotation], axis=1)
+    cost = float(np.einsum('ei,eij,ej->', residual, information, residual))
+    # Misfit only in the directions each edge constrains
+    residuals = {
+        'translation': np.linalg.norm(_range_projectors(information[:, :3, :3]) @ errors[:, :3, 3, None], axis=(-2, -1)),
+        'angle': np.linalg.norm(_range_projectors(information[:, 3:, 3:]) @ rotation[:, :, None], axis=(-2, -1)),
+    }
+    return PoseGraphResult(poses, iteration, converged, residuals, cost)
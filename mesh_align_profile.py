@@ -0,0 +1,149 @@
+"""Per-phase timing instrumentation for the mesh align plugin.
+
+Wrap a phase in ``with PROFILER.span('name'):`` to add its wall time to
+cumulative counters and a sample histogram for that phase. Statistics
+(count, total, min, mean, p95, max) can be exported to CSV or JSON. When the
+profiler is disabled, span() hands back a shared no-op context manager, so
+instrumented code pays only for one attribute check.
+
+The profiler starts enabled when the MESH_ALIGN_PROFILE environment variable
+is set to a non-empty value other than "0".
+"""
+import collections
+import csv
+import json
+import math
+import os
+import threading
+import time
+
+
+# Most recent samples kept per phase for the percentile/histogram figures
+MAX_SAMPLES = 10000
+
+STAT_FIELDS = ('phase', 'count', 'total_s', 'min_s', 'mean_s', 'p95_s', 'max_s')
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._profiler.add(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class Profiler(object):
+    """Cumulative per-phase timings
+
+    Spans may be recorded from worker threads; the counters are updated under a lock.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = bool(enabled)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._count = collections.defaultdict(int)
+        self._total = collections.defaultdict(float)
+        self._min = {}
+        self._max = {}
+        self._samples = collections.defaultdict(lambda: collections.deque(maxlen=MAX_SAMPLES))
+
+    def span(self, name):
+        """Context manager timing one occurrence of phase name"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def add(self, name, seconds):
+        """Record one measurement for phase name"""
+        with self._lock:
+            self._count[name] += 1
+            self._total[name] += seconds
+            self._min[name] = min(self._min.get(name, seconds), seconds)
+            self._max[name] = max(self._max.get(name, seconds), seconds)
+            self._samples[name].append(seconds)
+
+    def stats(self):
+        """Per-phase statistics as a list of dicts, in first-seen order"""
+        rows = []
+        with self._lock:
+            names = list(self._count)
+        for name in names:
+            samples = sorted(self._samples[name])
+            rows.append({
+                'phase': name,
+                'count': self._count[name],
+                'total_s': self._total[name],
+                'min_s': self._min[name],
+                'mean_s': self._total[name] / self._count[name],
+                'p95_s': _percentile(samples, 95.0),
+                'max_s': self._max[name],
+            })
+        return rows
+
+    def histogram(self, name, bins=10):
+        """(bin_edges, counts) of the recent samples for phase name"""
+        samples = sorted(self._samples.get(name, ()))
+        if not samples:
+            return [], []
+        low, high = samples[0], samples[-1]
+        width = (high - low) / bins or 1.0
+        counts = [0] * bins
+        for value in samples:
+            counts[min(int((value - low) / width), bins - 1)] += 1
+        return [low + i * width for i in range(bins + 1)], counts
+
+    def export(self, path):
+        """Write the statistics to path; .json gets stats plus histograms, anything else CSV"""
+        rows = self.stats()
+        if path.lower().endswith('.json'):
+            payload = {
+                'phases': rows,
+                'histograms': dict((row['phase'], dict(zip(('edges', 'counts'), self.histogram(row['phase']))))
+                                   for row in rows),
+            }
+            with open(path, 'w') as f:
+                json.dump(payload, f, indent=1)
+        else:
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=STAT_FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+        return path
+
+
+def _percentile(sorted_samples, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_samples:
+        return 0.0
+    rank = max(0, min(len(sorted_samples) - 1, int(math.ceil(percent / 100.0 * len(sorted_samples))) - 1))
+    return sorted_samples[rank]
+
+
+def _enabled_from_environment():
+    value = os.environ.get('MESH_ALIGN_PROFILE', '')
+    return bool(value) and value != '0'
+
+
+# Shared profiler used by the plugin
+PROFILER = Profiler(_enabled_from_environment())
@@ -0,0 +1,146 @@
+"""Alignment quality metrics for the mesh align plugin.
+
+Measures how far aligned mesh vertices are from a reference surface or from
+a set of target planes and summarises the deviations (RMS, max,
+percentiles, histogram) in a report that can be checked against a
+tolerance. Works on plain NumPy arrays like mesh_align_fit.
+"""
+import functools
+
+import numpy as np
+
+import mesh_align_core
+import mesh_align_fit
+import mesh_align_sampling
+from mesh_align_spatial import KDTree, TriangleBVH
+
+
+REPORT_PERCENTILES = (50.0, 90.0, 95.0, 99.0)
+
+# A report passes when this percentile of |deviation| is within tolerance;
+# a few outlier vertices (scan noise, stray triangles) do not fail a run
+TOLERANCE_PERCENTILE = 95.0
+
+
+class SurfaceReference(object):
+    """A reference mesh prepared for repeated deviation queries
+
+    With sample_count the normals come from the full mesh but only that many
+    vertices (see mesh_align_sampling.downsample_indices) are indexed for
+    nearest-neighbour queries, so memory and query time do not grow with
+    the reference resolution. The deviation check measures to the triangles
+    of the full mesh through index, a TriangleBVH (or a function returning
+    one) that is built on first use unless given.
+    """
+
+    def __init__(self, vertices, triangles, sample_count=None, method=mesh_align_sampling.VOXEL, index=None):
+        if index is None:
+            index = functools.partial(TriangleBVH, vertices, triangles)
+        self._index = index
+        normals = mesh_align_fit.vertex_normals(vertices, triangles)
+        if sample_count is not None:
+            keep = mesh_align_sampling.downsample_indices(vertices, sample_count, method)
+            vertices, normals = np.asarray(vertices)[keep], normals[keep]
+        self.tree = KDTree(vertices)
+        self.normals = normals
+
+    @property
+    def index(self):
+        """TriangleBVH over the full reference mesh"""
+        if not isinstance(self._index, TriangleBVH):
+            self._index = self._index()
+        return self._index
+
+
+def deviation_to_surface(points, reference):
+    """Signed point-to-surface deviation of points from a SurfaceReference
+
+    Each point is measured to the closest point of the reference triangles,
+    positive on the side the triangle's normal points to. Unlike the
+    distance to the nearest vertex this does not depend on the vertex
+    spacing. Points beyond the border of the reference are measured to the
+    border.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    distances, triangles, closest = reference.index.closest_points(points)
+    side = np.einsum('ij,ij->i', points - closest, reference.index.triangle_normals[triangles])
+    return np.where(side < 0.0, -distances, distances)
+
+
+def deviation_to_planes(points, planes, band):
+    """Signed distances of points to the nearest of a set of planes
+
+    Only points within band of some plane are measured, since the rest of
+    the mesh is not expected to lie on any of them. Returns (deviations,
+    plane_indices) for the points that were measured.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    planes = mesh_align_core.as_planes(planes).reshape(-1, 3, 3)
+    normals = mesh_align_core.normalize(planes[:, mesh_align_core.NORMAL])
+    offsets = np.einsum('kj,kj->k', normals, planes[:, mesh_align_core.ORIGIN])
+    signed = points @ normals.T - offsets
+    nearest = np.argmin(np.abs(signed), axis=1)
+    deviations = signed[np.arange(len(points)), nearest]
+    keep = np.abs(deviations) <= band
+    return deviations[keep], nearest[keep]
+
+
+def deviation_report(deviations, tolerance=None, bins=20):
+    """Summary statistics of signed deviations
+
+    Returns a dict with the sample count, RMS, mean, signed min/max, max
+    |deviation|, |deviation| percentiles and a histogram of the signed
+    values. With a tolerance it also holds the fraction of points within it
+    and 'passed' (see TOLERANCE_PERCENTILE).
+    """
+    deviations = np.asarray(deviations, dtype=np.float64)
+    report = {'count': int(len(deviations))}
+    if not len(deviations):
+        report['passed'] = False if tolerance is not None else None
+        return report
+    magnitude = np.abs(deviations)
+    counts, edges = np.histogram(deviations, bins=bins)
+    report.update({
+        'rms': float(np.sqrt(np.mean(deviations * deviations))),
+        'mean': float(deviations.mean()),
+        'min': float(deviations.min()),
+        'max': float(deviations.max()),
+        'max_abs': float(magnitude.max()),
+        'percentiles': dict(('p{:g}'.format(p), float(v)) for p, v in
+                            zip(REPORT_PERCENTILES, np.percentile(magnitude, REPORT_PERCENTILES))),
+        'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()},
+    })
+    if tolerance is not None:
+        report['tolerance'] = float(tolerance)
+        report['within_tolerance'] = float(np.count_nonzero(magnitude <= tolerance)) / len(magnitude)
+        report['passed'] = bool(np.percentile(magnitude, TOLERANCE_PERCENTILE) <= tolerance)
+    return report
+
+
+def overlap_scores(points, matrices, reference):
+    """Median distance of transformed points to the reference, per candidate matrix
+
+    All candidates are scored with one batched nearest-neighbour query; lower
+    is better.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    moved = mesh_align_core.transform_points(np.asarray(matrices)[:, None], points[None])
+    distances, _ = reference.tree.query(moved.reshape(-1, 3))
+    return np.median(distances.reshape(len(moved), -1), axis=1)
+
+
+def side_scores(points, matrices, planes):
+    """Fraction of transformed points on the normal side of every plane, per candidate
+
+    A part placed against target planes (e.g. the origin planes) sits on
+    their positive side; higher is better. Points within a small tolerance
+    of a plane count as on it, so the contact face does not decide the score.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    planes = mesh_align_core.as_planes(planes).reshape(-1, 3, 3)
+    normals = mesh_align_core.normalize(planes[:, mesh_align_core.NORMAL])
+    offsets = np.einsum('kj,kj->k', normals, planes[:, mesh_align_core.ORIGIN])
+    moved = mesh_align_core.transform_points(np.asarray(matrices)[:, None], points[None])
+    signed = np.einsum('cni,ki->cnk', moved, normals) - offsets
+    tolerance = 1e-3 * (np.ptp(points, axis=0).max() + 1e-12)
+    return np.mean(np.all(signed >= -tolerance, axis=2), axis=1)
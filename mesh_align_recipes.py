@@ -0,0 +1,143 @@
+"""Alignment recipes: recorded runs that can be replayed without the dialog.
+
+A recipe is a small JSON document with the inputs of one alignment (plane
+geometries, mode, flip), the bodies it was applied to and the resulting
+transform stages. Recipes are stored one per file and keyed by a hash of the
+input geometry, so the same fixture planes always map to the same file and a
+lookup is a single file read.
+"""
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from mesh_align_trace import _jsonable
+
+
+RECIPE_VERSION = 1
+
+# Geometry is rounded to this many decimals (internal units, cm) before
+# hashing so floating point noise does not change the key
+KEY_DECIMALS = 6
+
+
+def geometry_key(mode, arrays=(), **params):
+    """Hex digest identifying an alignment by its input geometry and options"""
+    payload = {
+        'mode': mode,
+        # + 0.0 turns -0.0 into 0.0 so both hash the same
+        'arrays': [(np.round(np.asarray(a, dtype=np.float64), KEY_DECIMALS) + 0.0).tolist() for a in arrays],
+        'params': params,
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def make_recipe(key, mode, stages, bodies=(), **fields):
+    """Build a recipe dict
+
+    stages is the list of (name, 4x4 matrix) that was applied; bodies is a
+    list of dicts with the 'name', 'token' and pre-alignment 'bounds'
+    (min xyz + max xyz) of each moved body. Extra fields (planes, flip,
+    apply mode, ...) are stored as given.
+    """
+    recipe = {
+        'version': RECIPE_VERSION,
+        'key': key,
+        'mode': mode,
+        'created': time.time(),
+        'stages': [{'name': name, 'matrix': np.asarray(m, dtype=np.float64).tolist()} for name, m in stages],
+        'bodies': [dict(b) for b in bodies],
+    }
+    recipe.update(_jsonable(fields))
+    return recipe
+
+
+def recipe_stages(recipe):
+    """The recipe's (name, 4x4 matrix) stages"""
+    return [(stage['name'], np.array(stage['matrix'], dtype=np.float64)) for stage in recipe['stages']]
+
+
+def match_bodies(recipe, candidates, tolerance):
+    """Indices of candidate bodies that a recipe applies to
+
+    candidates is a list of body dicts like the recipe's 'bodies'. A
+    candidate matches a recorded body when its entity token or its name is
+    the same and its bounding box is within tolerance of the recorded
+    pre-alignment box, i.e. it is still in the pose the recipe started from.
+    """
+    matches = []
+    for index, candidate in enumerate(candidates):
+        bounds = np.asarray(candidate['bounds'], dtype=np.float64)
+        for body in recipe.get('bodies', ()):
+            if candidate['token'] != body.get('token') and candidate['name'] != body.get('name'):
+                continue
+            if np.abs(bounds - np.asarray(body['bounds'], dtype=np.float64)).max() <= tolerance:
+                matches.append(index)
+                break
+    return matches
+
+
+class RecipeStore(object):
+    """Folder of recipe files named after their geometry key"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path_for(self, key):
+        return os.path.join(self.folder, key + '.json')
+
+    def get(self, key):
+        """The recipe stored under key, or None"""
+        path = self.path_for(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            return load_recipe(path)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, recipe):
+        """Write recipe under its key and return the file path"""
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        path = self.path_for(recipe['key'])
+        # Write to a temporary file first so a failed write never leaves half a recipe
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(recipe, f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+        return path
+
+    def recipes(self):
+        return load_recipes(self.folder) if os.path.isdir(self.folder) else []
+
+
+def load_recipe(path):
+    with open(path) as f:
+        recipe = json.load(f)
+    if not isinstance(recipe, dict) or recipe.get('version') != RECIPE_VERSION or 'stages' not in recipe:
+        raise ValueError('{} is not a version {} alignment recipe'.format(path, RECIPE_VERSION))
+    return recipe
+
+
+def load_recipes(path, skipped=None):
+    """Load one recipe file, or every recipe in a folder (oldest first)
+
+    A file in a folder that is not a readable recipe is left out, and
+    (file path, reason) is appended to skipped if given. A single file that
+    is not a recipe raises ValueError (IOError/OSError if it can't be read).
+    """
+    if os.path.isdir(path):
+        recipes = []
+        for file_path in sorted(glob.glob(os.path.join(path, '*.json'))):
+            try:
+                recipes.append(load_recipe(file_path))
+            except (IOError, OSError, ValueError) as e:
+                if skipped is not None:
+                    skipped.append((file_path, str(e)))
+        return sorted(recipes, key=lambda r: r.get('created', 0.0))
+    return [load_recipe(path)]
+
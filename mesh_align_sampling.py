@@ -0,0 +1,126 @@
+"""Point-cloud downsampling for the mesh align plugin.
+
+Fitting, scoring and preview need a sample of a mesh whose size is set by a
+budget, not by the scan resolution. A voxel grid keeps one vertex per
+occupied cell, so the sample covers the surface evenly however densely each
+area was scanned; a plain random subset follows the scan density instead.
+Works on plain NumPy arrays like mesh_align_fit.
+"""
+import numpy as np
+
+
+VOXEL = 'voxel'
+RANDOM = 'random'
+
+# The cell size for a target count is searched on a random subset with this
+# many points per wanted point, for at most this many steps
+VOXEL_SEARCH_OVERSAMPLING = 16
+VOXEL_SEARCH_ITERATIONS = 6
+
+# Smallest factor cluster_mesh grows its voxels by when a pass leaves too
+# many triangles
+CLUSTER_MIN_GROWTH = 1.1
+
+# Cell coordinates are packed into one int64 key, so no axis may have more
+# cells than this
+_MAX_CELLS_PER_AXIS = 1 << 20
+
+
+def _voxel_keys(points, voxel_size):
+    """One int64 key per point naming its voxel of edge voxel_size"""
+    low = points.min(axis=0)
+    extent = float(np.max(points.max(axis=0) - low))
+    voxel_size = max(float(voxel_size), extent / _MAX_CELLS_PER_AXIS, 1e-12)
+    cells = ((points - low) / voxel_size).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    return (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+
+def voxel_indices(points, voxel_size, seed=0):
+    """Sorted indices of one point per occupied voxel of edge voxel_size
+
+    Which point of a voxel is kept is random, but fixed for a given seed.
+    """
+    points = np.asarray(points)
+    if not len(points):
+        return np.empty(0, dtype=np.intp)
+    order = np.random.default_rng(seed).permutation(len(points))
+    _, first = np.unique(_voxel_keys(points[order], voxel_size), return_index=True)
+    return np.sort(order[first])
+
+
+def voxel_size_for_count(points, count, seed=0):
+    """Voxel edge length that keeps about count of the points
+
+    Scanned meshes are surfaces, so the number of occupied voxels grows with
+    the inverse square of their size. The search starts from the bounding
+    box and corrects the size by that law on a random subset of the points.
+    """
+    points = np.asarray(points)
+    count = max(int(count), 1)
+    subset_size = VOXEL_SEARCH_OVERSAMPLING * count
+    if len(points) > subset_size:
+        points = points[np.random.default_rng(seed).choice(len(points), subset_size, replace=False)]
+    extent = np.ptp(points, axis=0).astype(np.float64) + 1e-12
+    size = np.sqrt((extent[0] * extent[1] + extent[1] * extent[2] + extent[2] * extent[0]) / count)
+    for _ in range(VOXEL_SEARCH_ITERATIONS):
+        kept = len(voxel_indices(points, size, seed))
+        if abs(kept - count) <= 0.05 * count:
+            break
+        size *= np.sqrt(kept / float(count))
+    return size
+
+
+def downsample_indices(points, count, method=VOXEL, seed=0):
+    """Sorted indices of at most count of the points
+
+    With VOXEL the points are thinned on a voxel grid sized for about count
+    points (see voxel_size_for_count) and any excess is dropped at random;
+    with RANDOM they are a plain random subset. Deterministic for a seed.
+    """
+    total = len(points)
+    if total <= count:
+        return np.arange(total)
+    indices = np.arange(total)
+    if method == VOXEL:
+        indices = voxel_indices(points, voxel_size_for_count(points, count, seed), seed)
+    elif method != RANDOM:
+        raise ValueError('Unknown sampling method {!r}'.format(method))
+    if len(indices) > count:
+        indices = np.sort(np.random.default_rng(seed).choice(indices, count, replace=False))
+    return indices
+
+
+def downsample(points, count, method=VOXEL, seed=0):
+    """At most count of the points (see downsample_indices)"""
+    return points[downsample_indices(points, count, method, seed)]
+
+
+def cluster_mesh(vertices, triangles, count, seed=0):
+    """Decimate a triangle mesh to at most about count triangles by vertex clustering
+
+    The vertices of each voxel are merged into one of them, and triangles
+    that collapse are dropped. Unlike keeping every n-th triangle, this
+    leaves no holes, and the result is spread evenly over the surface. When
+    the voxel size estimate leaves too many triangles, the voxels are grown
+    and the mesh clustered again. Returns (vertices, triangles) of the
+    decimated mesh.
+    """
+    vertices = np.asarray(vertices)
+    triangles = np.asarray(triangles)
+    if len(triangles) <= count:
+        return vertices, triangles
+    # A closed triangle mesh has about twice as many triangles as vertices
+    size = voxel_size_for_count(vertices, max(count // 2, 1), seed)
+    while True:
+        _, representatives, inverse = np.unique(_voxel_keys(vertices, size), return_index=True, return_inverse=True)
+        merged = inverse.reshape(-1)[triangles]
+        keep = (merged[:, 0] != merged[:, 1]) & (merged[:, 1] != merged[:, 2]) & (merged[:, 2] != merged[:, 0])
+        merged = merged[keep]
+        if len(merged) <= count:
+            break
+        # The triangle count falls with the square of the voxel size
+        size *= max(np.sqrt(len(merged) / float(count)), CLUSTER_MIN_GROWTH)
+    # Keep only the vertices the remaining triangles use
+    used, merged = np.unique(merged, return_inverse=True)
+    return vertices[representatives[used]], merged.reshape(-1, 3)
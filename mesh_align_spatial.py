@@ -0,0 +1,477 @@
+"""Spatial indexes used by the mesh align plugin.
+
+KDTree answers nearest-neighbour queries over point clouds. It uses SciPy's
+cKDTree when SciPy is importable (e.g. in a full Python install) and falls
+back to a NumPy octree otherwise, as in Fusion's bundled Python.
+
+TriangleBVH answers closest-point, radius and ray queries against the
+triangles of a mesh, for tasks where the nearest vertex is not good enough.
+Both it and the fallback are built on the same pure NumPy octree, which
+walks whole blocks of queries down the tree at once.
+"""
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree as _cKDTree
+except ImportError:
+    _cKDTree = None
+
+# Threads a SciPy query runs on when KDTree.query is given none; -1 is one
+# per core. Processes that already run one per core set it to 1 (see
+# mesh_align_batch)
+QUERY_WORKERS = -1
+
+
+class KDTree(object):
+    """Nearest-neighbour index over an (N, 3) point array"""
+
+    def __init__(self, points):
+        self.points = np.ascontiguousarray(points, dtype=np.float64)
+        if self.points.ndim != 2 or self.points.shape[1] != 3 or not len(self.points):
+            raise ValueError('KDTree needs a non-empty (N, 3) point array')
+        self._tree = _cKDTree(self.points) if _cKDTree is not None else _PointOctree(self.points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, queries, distance_upper_bound=np.inf, workers=None):
+        """Return (distances, indices) of the nearest point for each query
+
+        Queries with no neighbour within distance_upper_bound get an infinite
+        distance and the index len(self), as with SciPy. workers is the
+        number of threads of a SciPy query (default QUERY_WORKERS); the
+        NumPy fallback always runs on one.
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        if isinstance(self._tree, _PointOctree):
+            sq_distances, indices = self._tree.nearest(
+                queries, np.full(len(queries), float(distance_upper_bound) ** 2))
+            return np.sqrt(sq_distances), indices
+        return self._tree.query(queries, distance_upper_bound=distance_upper_bound,
+                                workers=QUERY_WORKERS if workers is None else workers)
+
+
+# A BVH node with at most this many items is a leaf; queries are
+# walked down the tree in blocks of BVH_QUERY_BLOCK
+BVH_LEAF_SIZE = 8
+BVH_QUERY_BLOCK = 4096
+
+# Octree levels the BVH follows, each taking 3 bits of the Morton codes
+BVH_DEPTH = 10
+
+# Items next to a query's Morton code, in sorted order, whose distance
+# seeds the query's bound before it walks the tree
+BVH_SEED_ITEMS = 4
+
+
+def _spread_bits(values):
+    """Insert two zero bits after each of the low 10 bits (for Morton codes)"""
+    values = values.astype(np.uint64) & np.uint64(0x3FF)
+    values = (values | (values << np.uint64(16))) & np.uint64(0x030000FF)
+    values = (values | (values << np.uint64(8))) & np.uint64(0x0300F00F)
+    values = (values | (values << np.uint64(4))) & np.uint64(0x030C30C3)
+    values = (values | (values << np.uint64(2))) & np.uint64(0x09249249)
+    return values
+
+
+def closest_points_on_triangles(points, a, b, c):
+    """Closest point on each triangle (a, b, c) to the matching point; all (N, 3)
+
+    Degenerate triangles are handled through their edges. Returns
+    (squared distances, closest points).
+    """
+    ab, ac = b - a, c - a
+    normal = np.cross(ab, ac)
+    sq_area = np.einsum('ij,ij->i', normal, normal)
+    safe = np.where(sq_area > 0.0, sq_area, 1.0)
+    # Projection onto the plane, kept when it falls inside the triangle
+    offset = np.einsum('ij,ij->i', points - a, normal) / safe
+    projected = points - offset[:, None] * normal
+    rel = projected - a
+    u = np.einsum('ij,ij->i', np.cross(rel, ac), normal) / safe
+    v = np.einsum('ij,ij->i', np.cross(ab, rel), normal) / safe
+    inside = (sq_area > 0.0) & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0)
+    best = np.where(inside[:, None], projected, a)
+    best_sq = np.where(inside, offset * offset * sq_area, np.inf)
+    for start, edge in ((a, ab), (a, ac), (b, c - b)):
+        length = np.einsum('ij,ij->i', edge, edge)
+        t = np.clip(np.einsum('ij,ij->i', points - start, edge) / np.where(length > 0.0, length, 1.0), 0.0, 1.0)
+        candidate = start + t[:, None] * edge
+        diff = points - candidate
+        sq = np.einsum('ij,ij->i', diff, diff)
+        closer = sq < best_sq
+        best = np.where(closer[:, None], candidate, best)
+        best_sq = np.where(closer, sq, best_sq)
+    return best_sq, best
+
+
+def _group_starts(groups):
+    """Start of each run of equal values in a sorted array"""
+    heads = np.ones(len(groups), dtype=bool)
+    heads[1:] = groups[1:] != groups[:-1]
+    return np.flatnonzero(heads)
+
+
+def _first_per_group(groups, values):
+    """Index of the smallest value in each run of equal (sorted) group ids"""
+    starts = _group_starts(groups)
+    lowest = np.minimum.reduceat(values, starts)
+    hits = np.flatnonzero(values == np.repeat(lowest, np.diff(np.r_[starts, len(groups)])))
+    return hits[_group_starts(groups[hits])]
+
+
+class _Octree(object):
+    """Bounding volume hierarchy over items given by their boxes
+
+    The hierarchy follows an octree over the items' bounding box. Items are
+    sorted by the Morton (Z-order) code of their box centres, so each octree
+    cell holds a contiguous run of them, and every cell with more than
+    BVH_LEAF_SIZE items is split into its occupied octants, down to
+    BVH_DEPTH levels. A node stores the tight box of its own items, so
+    items that stick out of their cell are still found. Everything is kept
+    in flat arrays and built one level at a time.
+
+    Queries are batched: a block of queries walks down the tree together,
+    one level per step, dropping (query, node) pairs whose box cannot
+    matter.
+    """
+
+    def __init__(self, lower, upper, points):
+        """lower and upper are the (N, 3) item boxes; points[i] is a point on item i"""
+        self._low = lower.min(axis=0)
+        self._extent = np.maximum(upper.max(axis=0) - self._low, 1e-12)
+        codes = self._morton_codes((lower + upper) * 0.5)
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        self.order = order
+        self.codes = codes
+        self.item_points = points[order].astype(np.float64)
+        count = len(order)
+
+        # Nodes level by level, each a run [start, stop) of the sorted
+        # items; the children of a node are consecutive
+        level_start, level_stop = np.zeros(1, dtype=np.intp), np.full(1, count, dtype=np.intp)
+        levels = []
+        starts, stops, firsts, counts = [], [], [], []
+        total = 1
+        for depth in range(1, BVH_DEPTH + 2):
+            levels.append(total - len(level_start))
+            starts.append(level_start)
+            stops.append(level_stop)
+            split = level_stop - level_start > BVH_LEAF_SIZE
+            if depth > BVH_DEPTH:
+                split[:] = False
+            sizes = (level_stop - level_start)[split]
+            positions = np.arange(sizes.sum()) + np.repeat(level_start[split] - (np.cumsum(sizes) - sizes), sizes)
+            prefix = codes[positions] >> np.uint64(3 * (BVH_DEPTH - min(depth, BVH_DEPTH)))
+            new = np.ones(len(positions), dtype=bool)
+            new[1:] = (prefix[1:] != prefix[:-1]) | (positions[1:] != positions[:-1] + 1)
+            heads = np.flatnonzero(new)
+            child_start = positions[heads]
+            child_stop = np.append(positions[heads[1:] - 1], positions[-1:]) + 1
+            per_node = np.bincount(np.searchsorted(level_start, child_start, 'right') - 1,
+                                   minlength=len(level_start))
+            counts.append(per_node)
+            firsts.append(total + np.cumsum(per_node) - per_node)
+            total += len(child_start)
+            level_start, level_stop = child_start, child_stop
+            if not len(level_start):
+                break
+        self.start = np.concatenate(starts)
+        self.stop = np.concatenate(stops)
+        self.child_first = np.concatenate(firsts)
+        self.child_count = np.concatenate(counts)
+
+        # Node boxes from the leaves up: the leaves' runs cover the sorted
+        # items once, and the children of one level's nodes cover the next
+        self.lower = np.empty((len(self.start), 3))
+        self.upper = np.empty((len(self.start), 3))
+        leaves = np.flatnonzero(self.child_count == 0)
+        leaves = leaves[np.argsort(self.start[leaves], kind='stable')]
+        self.lower[leaves] = np.minimum.reduceat(lower[order], self.start[leaves], axis=0)
+        self.upper[leaves] = np.maximum.reduceat(upper[order], self.start[leaves], axis=0)
+        levels.append(len(self.start))
+        for first, middle, last in reversed(list(zip(levels[:-2], levels[1:-1], levels[2:]))):
+            parents = first + np.flatnonzero(self.child_count[first:middle])
+            if len(parents):
+                children = self.child_first[parents] - middle
+                self.lower[parents] = np.minimum.reduceat(self.lower[middle:last], children, axis=0)
+                self.upper[parents] = np.maximum.reduceat(self.upper[middle:last], children, axis=0)
+        # A point of the item in the middle of each node's run; its distance
+        # bounds the distance to the node's items
+        self.anchors = self.item_points[(self.start + self.stop) // 2]
+
+    def __len__(self):
+        return len(self.order)
+
+    def _morton_codes(self, points):
+        """Morton codes of points, clamped to the grid over the items' box"""
+        scaled = (points - self._low) / self._extent * ((1 << BVH_DEPTH) - 1) + 0.5
+        cells = np.clip(scaled, 0, (1 << BVH_DEPTH) - 1).astype(np.int64)
+        return (_spread_bits(cells[:, 0]) << np.uint64(2)) | (_spread_bits(cells[:, 1]) << np.uint64(1)) | \
+            _spread_bits(cells[:, 2])
+
+    def _seed_bound(self, points):
+        """Squared distance from each point to the nearest of the items next to it in Morton order
+
+        Items close in Morton order are mostly close in space, so this bounds
+        the distance to the nearest item without walking the tree.
+        """
+        positions = np.searchsorted(self.codes, self._morton_codes(points))
+        window = np.arange(BVH_SEED_ITEMS) - BVH_SEED_ITEMS // 2
+        positions = np.clip(positions[:, None] + window, 0, len(self.codes) - 1)
+        offsets = points[:, None, :] - self.item_points[positions]
+        return np.einsum('ijk,ijk->ij', offsets, offsets).min(axis=1)
+
+    def _blocks(self, points):
+        """Indices of points in blocks of BVH_QUERY_BLOCK, in Morton order
+
+        Points walked together are then close together, and so are the
+        nodes they visit.
+        """
+        order = np.argsort(self._morton_codes(points), kind='stable')
+        for start in range(0, len(points), BVH_QUERY_BLOCK):
+            yield order[start:start + BVH_QUERY_BLOCK]
+
+    def _descend(self, queries, prune):
+        """Walk a block of queries down to the leaves
+
+        prune(query_ids, nodes) returns a mask of the (query, node) pairs to
+        keep at each level. Returns the surviving (query_ids, leaf nodes)
+        pairs, grouped by query.
+        """
+        nodes = np.zeros(len(queries), dtype=np.intp)
+        keep = prune(queries, nodes)
+        queries, nodes = queries[keep], nodes[keep]
+        found_queries, found_nodes = [], []
+        while len(nodes):
+            counts = self.child_count[nodes]
+            leaf = counts == 0
+            found_queries.append(queries[leaf])
+            found_nodes.append(nodes[leaf])
+            queries, nodes, counts = queries[~leaf], nodes[~leaf], counts[~leaf]
+            first = np.repeat(self.child_first[nodes] - (np.cumsum(counts) - counts), counts)
+            queries = np.repeat(queries, counts)
+            nodes = first + np.arange(len(first))
+            keep = prune(queries, nodes)
+            queries, nodes = queries[keep], nodes[keep]
+        if not found_queries:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        queries, nodes = np.concatenate(found_queries), np.concatenate(found_nodes)
+        order = np.argsort(queries, kind='stable')
+        return queries[order], nodes[order]
+
+    def _leaf_pairs(self, queries, nodes):
+        """Expand (query, leaf node) pairs to (query, position in the sorted items) pairs"""
+        counts = self.stop[nodes] - self.start[nodes]
+        items = np.arange(counts.sum()) + np.repeat(self.start[nodes] - (np.cumsum(counts) - counts), counts)
+        return np.repeat(queries, counts), items
+
+    def _box_distances(self, points, nodes):
+        """Squared distances from points to the nearest point of node boxes"""
+        nearest = np.maximum(np.maximum(self.lower[nodes] - points, points - self.upper[nodes]), 0.0)
+        return np.einsum('ij,ij->i', nearest, nearest)
+
+    def _anchor_distances(self, points, nodes):
+        """Squared distances from points to the anchor point of nodes"""
+        offsets = points - self.anchors[nodes]
+        return np.einsum('ij,ij->i', offsets, offsets)
+
+    def _bounded_descend(self, block, bound):
+        """_descend that shrinks bound (squared, per query) to the nearest anchor seen
+
+        The bound starts no larger than the seed of _seed_bound, so the top
+        levels already prune. Boxes further away than the bound are
+        skipped. Returns the surviving (query_ids, leaf nodes) pairs.
+        """
+        np.minimum(bound, self._seed_bound(block), out=bound)
+
+        def prune(queries, nodes):
+            points = block[queries]
+            anchor = self._anchor_distances(points, nodes)
+            heads = _group_starts(queries)
+            bound[queries[heads]] = np.minimum(bound[queries[heads]], np.minimum.reduceat(anchor, heads))
+            return self._box_distances(points, nodes) <= bound[queries]
+
+        return self._descend(np.arange(len(block)), prune)
+
+
+class _PointOctree(_Octree):
+    """_Octree over the points of a cloud, for nearest-neighbour queries"""
+
+    def __init__(self, points):
+        super(_PointOctree, self).__init__(points, points, points)
+        self.points = self.item_points
+
+    def nearest(self, points, sq_bound):
+        """(squared distances, indices) of the nearest point to each of points
+
+        Points with nothing within sq_bound (squared, per point) get an
+        infinite distance and the index len(self).
+        """
+        sq_distances = np.full(len(points), np.inf)
+        indices = np.full(len(points), len(self), dtype=np.intp)
+        for ids in self._blocks(points):
+            block = points[ids]
+            bound = sq_bound[ids]
+            queries, nodes = self._bounded_descend(block, bound)
+            keep = self._box_distances(block[queries], nodes) <= bound[queries]
+            queries, items = self._leaf_pairs(queries[keep], nodes[keep])
+            if not len(queries):
+                continue
+            offsets = block[queries] - self.points[items]
+            sq = np.einsum('ij,ij->i', offsets, offsets)
+            best = _first_per_group(queries, sq)
+            queries, sq, items = queries[best], sq[best], items[best]
+            within = sq <= sq_bound[ids[queries]]
+            sq_distances[ids[queries[within]]] = sq[within]
+            indices[ids[queries[within]]] = self.order[items[within]]
+        return sq_distances, indices
+
+
+class TriangleBVH(_Octree):
+    """Bounding volume hierarchy over the triangles of a mesh
+
+    An _Octree over the triangles' boxes: queries walk it in blocks and the
+    leaves' triangles are tested exactly.
+    """
+
+    def __init__(self, vertices, triangles):
+        self.vertices = np.asarray(vertices)
+        triangles = np.asarray(triangles, dtype=np.intp).reshape(-1, 3)
+        if self.vertices.ndim != 2 or self.vertices.shape[1] != 3 or not len(triangles):
+            raise ValueError('TriangleBVH needs (N, 3) vertices and at least one triangle')
+        a, b, c = (self.vertices[triangles[:, k]] for k in range(3))
+        # The anchors are vertices of the mesh, so their distance bounds the
+        # distance to the node's triangles
+        super(TriangleBVH, self).__init__(np.minimum(np.minimum(a, b), c), np.maximum(np.maximum(a, b), c), a)
+        self.triangles = triangles[self.order]
+        self._normals = None
+
+    @property
+    def triangle_normals(self):
+        """Unit normals of self.triangles (computed on first use)"""
+        if self._normals is None:
+            a, b, c = self.corners(slice(None))
+            normal = np.cross(b - a, c - a)
+            length = np.linalg.norm(normal, axis=1, keepdims=True)
+            self._normals = normal / np.where(length > 0.0, length, 1.0)
+        return self._normals
+
+    def corners(self, triangle_indices):
+        """(a, b, c) float64 corner arrays of the given triangles"""
+        triangles = self.triangles[triangle_indices]
+        return tuple(self.vertices[triangles[:, k]].astype(np.float64) for k in range(3))
+
+    def _closest_in_leaves(self, points, queries, nodes):
+        """Closest point per query among the triangles of its (query, leaf) pairs
+
+        Returns (query ids, squared distances, triangle indices, closest points),
+        one row per query that has any pair.
+        """
+        queries, triangles = self._leaf_pairs(queries, nodes)
+        sq, closest = closest_points_on_triangles(points[queries], *self.corners(triangles))
+        best = _first_per_group(queries, sq)
+        return queries[best], sq[best], triangles[best], closest[best]
+
+    def closest_points(self, points):
+        """Closest point on the mesh to each point
+
+        Returns (distances, triangle indices into self.triangles, closest
+        points). The nearest anchor seen so far bounds each distance, and
+        boxes further away are skipped. At the leaves, the one with the
+        nearest anchor is searched first and its exact distance prunes the
+        others.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        distances = np.empty(len(points))
+        indices = np.empty(len(points), dtype=np.intp)
+        closest = np.empty((len(points), 3))
+        for ids in self._blocks(points):
+            block = points[ids]
+            queries, nodes = self._bounded_descend(block, np.full(len(block), np.inf))
+            first = _first_per_group(queries, self._anchor_distances(block[queries], nodes))
+            rows, sq, triangles, nearest = self._closest_in_leaves(block, queries[first], nodes[first])
+            rest = np.ones(len(queries), dtype=bool)
+            rest[first] = False
+            rest &= self._box_distances(block[queries], nodes) < sq[queries]
+            if np.any(rest):
+                others = self._closest_in_leaves(block, queries[rest], nodes[rest])
+                better = others[1] < sq[others[0]]
+                update = others[0][better]
+                sq[update] = others[1][better]
+                triangles[update] = others[2][better]
+                nearest[update] = others[3][better]
+            distances[ids[rows]] = np.sqrt(sq)
+            indices[ids[rows]] = triangles
+            closest[ids[rows]] = nearest
+        return distances, indices, closest
+
+    def within_radius(self, points, radius):
+        """Triangles within radius (scalar or per point) of each point
+
+        Returns (point indices, triangle indices) pairs, grouped by point.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        sq_radius = np.broadcast_to(np.asarray(radius, dtype=np.float64) ** 2, (len(points),))
+        found = []
+        for start in range(0, len(points), BVH_QUERY_BLOCK):
+            block = points[start:start + BVH_QUERY_BLOCK]
+            block_sq = sq_radius[start:start + BVH_QUERY_BLOCK]
+
+            def prune(queries, nodes):
+                return self._box_distances(block[queries], nodes) <= block_sq[queries]
+
+            queries, triangles = self._leaf_pairs(*self._descend(np.arange(len(block)), prune))
+            sq, _ = closest_points_on_triangles(block[queries], *self.corners(triangles))
+            keep = sq <= block_sq[queries]
+            found.append((queries[keep] + start, triangles[keep]))
+        if not found:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        return np.concatenate([q for q, _ in found]), np.concatenate([t for _, t in found])
+
+    def ray_cast(self, origins, directions, max_distance=np.inf):
+        """First hit of each ray (origin + t * direction, t >= 0) on the mesh
+
+        Returns (t, triangle indices); rays that miss get t = inf and
+        index -1. t is in units of the direction's length.
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.broadcast_to(np.asarray(directions, dtype=np.float64), origins.shape)
+        tiny = np.where(directions < 0.0, -1e-300, 1e-300)
+        inverse = 1.0 / np.where(np.abs(directions) < 1e-300, tiny, directions)
+        hits = np.full(len(origins), np.inf)
+        indices = np.full(len(origins), -1, dtype=np.intp)
+        for start in range(0, len(origins), BVH_QUERY_BLOCK):
+            block_origins = origins[start:start + BVH_QUERY_BLOCK]
+            block_inverse = inverse[start:start + BVH_QUERY_BLOCK]
+
+            def prune(queries, nodes):
+                t1 = (self.lower[nodes] - block_origins[queries]) * block_inverse[queries]
+                t2 = (self.upper[nodes] - block_origins[queries]) * block_inverse[queries]
+                enter = np.minimum(t1, t2).max(axis=1)
+                leave = np.maximum(t1, t2).min(axis=1)
+                return (enter <= leave) & (leave >= 0.0) & (enter <= max_distance)
+
+            queries, triangles = self._leaf_pairs(*self._descend(np.arange(len(block_origins)), prune))
+            # Moller-Trumbore intersection of each surviving pair
+            a, b, c = self.corners(triangles)
+            ray_origins = block_origins[queries]
+            ray_directions = directions[start:start + BVH_QUERY_BLOCK][queries]
+            ab, ac = b - a, c - a
+            p = np.cross(ray_directions, ac)
+            det = np.einsum('ij,ij->i', ab, p)
+            safe = np.where(np.abs(det) > 1e-300, det, 1.0)
+            s = ray_origins - a
+            u = np.einsum('ij,ij->i', s, p) / safe
+            q = np.cross(s, ab)
+            v = np.einsum('ij,ij->i', ray_directions, q) / safe
+            t = np.einsum('ij,ij->i', ac, q) / safe
+            hit = (np.abs(det) > 1e-300) & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t >= 0.0) & (t <= max_distance)
+            if not np.any(hit):
+                continue
+            queries, triangles, t = queries[hit], triangles[hit], t[hit]
+            best = _first_per_group(queries, t)
+            hits[queries[best] + start] = t[best]
+            indices[queries[best] + start] = triangles[best]
+        return hits, indices
@@ -0,0 +1,283 @@
+"""Reflective symmetry detection for the mesh align plugin.
+
+Finds the planes a part is mirror-symmetric about, so a symmetry plane can
+be used as a source plane instead of a hand-built 3-point plane. The plane
+that mirrors one point onto another is the perpendicular bisector of the
+two, and on a symmetric part many point pairs agree on the same bisector.
+Random pairs whose vertex normals mirror onto each other vote in a
+histogram over plane normal and offset, filled in one vectorized pass; each
+peak is then refined by ICP-style iterations that mirror the points, match
+them to their nearest neighbours and move the plane so the mirror images
+land on the tangent planes of their matches.
+Works on plain NumPy arrays like mesh_align_fit.
+"""
+import numpy as np
+
+import mesh_align_core
+import mesh_align_fit
+from mesh_align_spatial import KDTree
+
+
+# Point pairs that vote, and how many of the vote's peaks are refined
+SYMMETRY_PAIR_COUNT = 500000
+SYMMETRY_CANDIDATES = 6
+
+# Vote histogram: normals are binned on the faces of a cube (NORMAL_BINS per
+# face edge, about 3 degrees each), offsets over the bounding sphere diameter
+NORMAL_BINS = 32
+OFFSET_BINS = 64
+
+# Pairs closer than this fraction of the part radius give unreliable normals
+MIN_PAIR_DISTANCE = 0.02
+
+# A pair only votes when one point's normal mirrored by the candidate plane
+# is within this distance of the other's
+MIRROR_NORMAL_TOLERANCE = 0.3
+
+# Refinement matches mirror images to points within SYMMETRY_SEARCH of the
+# part radius at first, halving down to SYMMETRY_MATCH (keep that above the
+# sample spacing). A point counts as mirrored when its mirror image is
+# within SYMMETRY_CONTACT of the radius of the surface at its match.
+SYMMETRY_SEARCH = 0.2
+SYMMETRY_MATCH = 0.05
+SYMMETRY_CONTACT = 0.005
+
+# Points mirrored in each refinement iteration (evenly spread over the
+# sample); the final score mirrors them all. Keeps the brute-force nearest
+# neighbour search used without SciPy affordable.
+SYMMETRY_STEP_POINTS = 1000
+
+# Planes refined to within these of each other (radians, fraction of the
+# radius) are the same plane
+SAME_PLANE_ANGLE = np.radians(2.0)
+SAME_PLANE_OFFSET = 0.01
+
+
+class SymmetryPlane(object):
+    """A detected symmetry plane
+
+    plane is a 3x3 plane array; score is the fraction of points whose mirror
+    image lies on the part (1 for a perfectly symmetric sample) and rms the
+    distance of those mirror images to the surface.
+    """
+
+    def __init__(self, plane, score, rms, votes, iterations):
+        self.plane = plane
+        self.score = score
+        self.rms = rms
+        self.votes = votes
+        self.iterations = iterations
+
+    def as_dict(self):
+        return {
+            'plane': self.plane,
+            'score': self.score,
+            'rms': self.rms,
+            'votes': self.votes,
+            'iterations': self.iterations,
+        }
+
+
+def _canonical(normals, offsets):
+    """Flip (normal, offset) so the largest normal component is positive"""
+    major = np.argmax(np.abs(normals), axis=1)
+    sign = np.where(normals[np.arange(len(normals)), major] < 0, -1.0, 1.0)
+    return normals * sign[:, None], offsets * sign, major
+
+
+def _bins(normals, offsets, major, radius):
+    """Histogram cell (face, u, v, offset) of canonical (normal, offset) votes"""
+    rows = np.arange(len(normals))
+    # The two minor components over the major one lie in [-1, 1] on its cube face
+    minor = np.stack([normals[rows, (major + 1) % 3], normals[rows, (major + 2) % 3]], axis=1)
+    minor /= normals[rows, major][:, None]
+    cells = np.clip(((minor + 1.0) * 0.5 * NORMAL_BINS).astype(np.intp), 0, NORMAL_BINS - 1)
+    offset_cells = np.clip(((offsets / radius + 1.0) * 0.5 * OFFSET_BINS).astype(np.intp), 0, OFFSET_BINS - 1)
+    return np.stack([major, cells[:, 0], cells[:, 1], offset_cells], axis=1)
+
+
+def _box_sum(histogram):
+    """Sum of each cell and its neighbours along the u, v and offset axes"""
+    for axis in (1, 2, 3):
+        padding = [(1, 1) if k == axis else (0, 0) for k in range(histogram.ndim)]
+        padded = np.pad(histogram, padding)
+        size = histogram.shape[axis]
+        histogram = sum(np.take(padded, np.arange(k, k + size), axis=axis) for k in range(3))
+    return histogram
+
+
+def vote_symmetry_planes(points, normals, count=SYMMETRY_CANDIDATES, pair_count=SYMMETRY_PAIR_COUNT, seed=0):
+    """Candidate symmetry planes from a Hough-style vote of random point pairs
+
+    Each pair votes for its perpendicular bisector, if the plane mirrors
+    the normal (from normals, the vertex normals of points) of one point
+    onto that of the other. Votes of neighbouring
+    cells are added up, so a peak split over a cell border still stands out.
+    The fullest neighbourhood gives a candidate (the mean of its votes), its
+    votes are removed, and so on for up to count candidates. Returns a list
+    of (plane array, votes), best first.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 2:
+        return []
+    centroid = points.mean(axis=0)
+    radius = max(float(np.linalg.norm(points - centroid, axis=1).max()), 1e-12)
+    rng = np.random.default_rng(seed)
+    first, second = rng.integers(0, len(points), size=(2, pair_count))
+    chords = points[first] - points[second]
+    lengths = np.linalg.norm(chords, axis=1)
+    keep = lengths > MIN_PAIR_DISTANCE * radius
+    first, second = first[keep], second[keep]
+    pair_normals = chords[keep] / lengths[keep][:, None]
+    offsets = np.einsum('ij,ij->i', pair_normals, (points[first] + points[second]) * 0.5 - centroid)
+    normals = np.asarray(normals, dtype=np.float64)
+    mirrored = normals[first] - 2.0 * np.einsum('ij,ij->i', normals[first], pair_normals)[:, None] * pair_normals
+    consistent = np.linalg.norm(mirrored - normals[second], axis=1) <= MIRROR_NORMAL_TOLERANCE
+    pair_normals, offsets = pair_normals[consistent], offsets[consistent]
+    pair_normals, offsets, major = _canonical(pair_normals, offsets)
+    cells = _bins(pair_normals, offsets, major, radius)
+    shape = (3, NORMAL_BINS, NORMAL_BINS, OFFSET_BINS)
+    keys = np.ravel_multi_index(cells.T, shape)
+
+    # Votes within a few cells of a found plane belong to its peak
+    angle_window = 3.0 * np.pi / 4.0 / NORMAL_BINS
+    offset_window = 3.0 * 2.0 * radius / OFFSET_BINS
+    candidates = []
+    remaining = np.ones(len(keys), dtype=bool)
+    while len(candidates) < count and np.any(remaining):
+        histogram = _box_sum(np.bincount(keys[remaining], minlength=int(np.prod(shape))).reshape(shape))
+        peak = np.array(np.unravel_index(np.argmax(histogram), shape))
+        members = remaining & (cells[:, 0] == peak[0]) & np.all(np.abs(cells[:, 1:] - peak[1:]) <= 1, axis=1)
+        normal = mesh_align_core.normalize(pair_normals[members].mean(axis=0))
+        offset = float(offsets[members].mean())
+        # A vote near a cube edge may have been flipped the other way
+        alignment = pair_normals @ normal
+        near = (np.abs(alignment) >= np.cos(angle_window)) & \
+            (np.abs(np.where(alignment < 0, -offsets, offsets) - offset) <= offset_window)
+        remaining &= ~near
+        candidates.append((_plane_through(centroid + offset * normal, normal, points),
+                           int(np.count_nonzero(members))))
+    return candidates
+
+
+def _plane_through(point, normal, points):
+    """Plane array through point with the main in-plane principal axis of points as uDirection
+
+    The origin is the centroid of points projected onto the plane.
+    """
+    normal = mesh_align_core.normalize(np.asarray(normal, dtype=np.float64))
+    centered = points - points.mean(axis=0)
+    in_plane = centered - np.outer(centered @ normal, normal)
+    _, axes, _ = mesh_align_fit.principal_axes(in_plane)
+    u_direction = mesh_align_core.normalize(axes[:, 0] - np.dot(axes[:, 0], normal) * normal)
+    # The in-plane skew is not changed by the mirror, so it fixes the sign
+    if np.sum((in_plane @ u_direction) ** 3) < 0:
+        u_direction = -u_direction
+    origin = points.mean(axis=0) - np.dot(points.mean(axis=0) - point, normal) * normal
+    return mesh_align_core.make_planes(origin, normal, u_direction)
+
+
+def _tangents(normal):
+    """Two unit vectors perpendicular to normal and to each other"""
+    helper = np.eye(3)[np.argmin(np.abs(normal))]
+    first = mesh_align_core.normalize(np.cross(normal, helper))
+    return first, np.cross(normal, first)
+
+
+def refine_symmetry_plane(points, plane, normals, tree=None, max_iterations=30, tolerance=1e-8):
+    """ICP-style refinement of a symmetry plane
+
+    Every iteration mirrors the points (SYMMETRY_STEP_POINTS of them) and
+    matches each mirror image to its nearest point. A Gauss-Newton step on the plane's normal and offset
+    then minimises the distances of the mirror images to the tangent planes
+    at their matches (normals are the vertex normals of points), as in a
+    point-to-plane ICP; pairs whose normals do not mirror onto each other
+    are left out. The match distance halves from SYMMETRY_SEARCH to
+    SYMMETRY_MATCH of the radius.
+
+    Returns (plane, score, rms, iterations): score is the fraction of points
+    whose mirror image lies on the part (see SYMMETRY_CONTACT) and rms the
+    distance of those mirror images to the surface.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    tree = tree if tree is not None else KDTree(points)
+    centroid = points.mean(axis=0)
+    relative = points - centroid
+    radius = max(float(np.linalg.norm(relative, axis=1).max()), 1e-12)
+    plane = mesh_align_core.as_planes(plane)
+    normal = mesh_align_core.normalize(plane[mesh_align_core.NORMAL])
+    offset = float(np.dot(plane[mesh_align_core.ORIGIN] - centroid, normal))
+    cutoff, floor = SYMMETRY_SEARCH * radius, SYMMETRY_MATCH * radius
+
+    def match(rows, normal, offset, cutoff):
+        """(keep, matches, mirror image distances to the surface, distances to the plane) of points[rows]"""
+        side = relative[rows] @ normal - offset
+        mirrored = relative[rows] - 2.0 * side[:, None] * normal
+        distances, matches = tree.query(mirrored + centroid)
+        keep = distances <= cutoff
+        matches = np.where(keep, matches, 0)
+        mirrored_normals = normals[rows] - 2.0 * (normals[rows] @ normal)[:, None] * normal
+        keep &= np.einsum('ij,ij->i', mirrored_normals, normals[matches]) > 0.5
+        surface = np.einsum('ij,ij->i', mirrored - relative[matches], normals[matches])
+        return keep, matches, surface, side
+
+    normals = np.asarray(normals, dtype=np.float64)
+    rows = np.unique(np.linspace(0, len(points) - 1, min(len(points), SYMMETRY_STEP_POINTS)).astype(np.intp))
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        keep, matches, residuals, side = match(rows, normal, offset, cutoff)
+        if np.count_nonzero(keep) < 3:
+            break
+        # Residual derivatives for the normal turning towards each tangent and the offset
+        m = normals[matches[keep]]
+        facing = m @ normal
+        lever = facing[:, None] * relative[rows[keep]] + side[keep][:, None] * m
+        first, second = _tangents(normal)
+        jacobian = np.stack([-2.0 * lever @ first, -2.0 * lever @ second, 2.0 * facing], axis=1)
+        update = np.linalg.lstsq(jacobian, -residuals[keep], rcond=None)[0]
+        normal = mesh_align_core.normalize(normal + update[0] * first + update[1] * second)
+        offset += float(update[2])
+        step = abs(update[0]) + abs(update[1]) + abs(update[2]) / radius
+        if cutoff > floor:
+            cutoff = max(cutoff * 0.5, floor)
+        elif step < tolerance:
+            break
+
+    # Same canonical side as the votes: largest normal component positive
+    if normal[np.argmax(np.abs(normal))] < 0:
+        normal, offset = -normal, -offset
+    keep, _, residuals, _ = match(np.arange(len(points)), normal, offset, floor)
+    matched = keep & (np.abs(residuals) <= SYMMETRY_CONTACT * radius)
+    rms = float(np.sqrt(np.mean(residuals[matched] ** 2))) if np.any(matched) else float('inf')
+    return _plane_through(centroid + offset * normal, normal, points), float(np.mean(matched)), rms, iteration
+
+
+def detect_symmetry_planes(points, normals, count=SYMMETRY_CANDIDATES, min_score=0.5, seed=0):
+    """Dominant reflective symmetry planes of a point sample, best first
+
+    Votes for candidates (see vote_symmetry_planes), refines each one (see
+    refine_symmetry_plane), merges candidates that end up on the same plane
+    and drops those whose score is below min_score. normals are the vertex
+    normals of points. Returns a list of SymmetryPlane.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 3:
+        return []
+    tree = KDTree(points)
+    radius = max(float(np.linalg.norm(points - points.mean(axis=0), axis=1).max()), 1e-12)
+    found = []
+    for candidate, votes in vote_symmetry_planes(points, normals, count, seed=seed):
+        plane, score, rms, iterations = refine_symmetry_plane(points, candidate, normals, tree)
+        if score < min_score:
+            continue
+        normal = plane[mesh_align_core.NORMAL]
+        same = [other for other in found
+                if abs(np.dot(normal, other.plane[mesh_align_core.NORMAL])) >= np.cos(SAME_PLANE_ANGLE) and
+                abs(np.dot(plane[mesh_align_core.ORIGIN] - other.plane[mesh_align_core.ORIGIN], normal)) <=
+                SAME_PLANE_OFFSET * radius]
+        if same:
+            same[0].votes += votes
+            continue
+        found.append(SymmetryPlane(plane, score, rms, votes, iterations))
+    found.sort(key=lambda result: (-result.score, result.rms))
+    return found
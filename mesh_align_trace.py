@@ -0,0 +1,92 @@
+"""Structured trace recorder for the mesh align plugin.
+
+Records are buffered as dictionaries and appended to a JSON Lines file, one
+record per line, so the history of many runs can be parsed later. A disabled
+recorder does no work at all: record() returns immediately and the fields
+callable passed to it is never invoked.
+"""
+import json
+import time
+import uuid
+
+
+class TraceRecorder(object):
+    """Collects trace records for one alignment run"""
+
+    def __init__(self, path=None, enabled=False, **context):
+        self.path = path
+        self.enabled = bool(enabled)
+        self.records = []
+        self.run_id = uuid.uuid4().hex if self.enabled else None
+        self._context = context
+        self._start = time.perf_counter() if self.enabled else None
+
+    def __bool__(self):
+        return self.enabled
+
+    def record(self, event, fields=None):
+        """Add a record for event
+
+        fields may be a dict or, preferably, a zero-argument callable returning
+        one, so that expensive values are only computed when tracing is on.
+        """
+        if not self.enabled:
+            return
+        if callable(fields):
+            fields = fields()
+        entry = {
+            'run': self.run_id,
+            'seq': len(self.records),
+            'time': time.time(),
+            'elapsed': time.perf_counter() - self._start,
+            'event': event,
+        }
+        if not self.records:
+            entry.update(self._context)
+        if fields:
+            entry.update(_jsonable(fields))
+        self.records.append(entry)
+
+    def lines(self):
+        """Return the buffered records as JSON Lines text"""
+        return ''.join(json.dumps(r, sort_keys=True) + '\n' for r in self.records)
+
+    def flush(self):
+        """Append buffered records to the trace file and clear the buffer
+
+        Returns True when there was nothing to write or the write succeeded.
+        The buffer is kept when the write fails so the caller can show it.
+        """
+        if not self.enabled or not self.records:
+            return True
+        if not self.path:
+            return False
+        try:
+            with open(self.path, 'a') as f:
+                f.write(self.lines())
+        except (IOError, OSError):
+            return False
+        self.records = []
+        return True
+
+
+def read_trace(path):
+    """Load every record from a JSON Lines trace file"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def _jsonable(value):
+    """Convert NumPy arrays/scalars and tuples into plain JSON types"""
+    if isinstance(value, dict):
+        return dict((str(k), _jsonable(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
@@ -0,0 +1,24 @@
+"""The mesh align modules live next to the plugin script, not in a package
+
+bench/ holds the stand-in adsk package that lets mesh_align_plugin import
+outside Fusion.
+"""
+import os
+import sys
+
+import pytest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [_ROOT, os.path.join(_ROOT, 'bench')]
+
+import mesh_align_spatial
+
+
+@pytest.fixture(params=['scipy', 'numpy'])
+def kdtree_backend(request, monkeypatch):
+    """Run a test with SciPy's cKDTree and again with the NumPy octree fallback"""
+    if request.param == 'numpy':
+        monkeypatch.setattr(mesh_align_spatial, '_cKDTree', None)
+    elif mesh_align_spatial._cKDTree is None:
+        pytest.skip('SciPy is not installed')
+    return request.param
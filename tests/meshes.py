@@ -0,0 +1,36 @@
+"""Small test meshes"""
+import numpy as np
+
+import mesh_align_core
+
+
+def lumpy_sphere(rings=24, segments=32, radius=5.0):
+    """Closed (vertices, triangles) mesh of a sphere with bumps, so it has no symmetry"""
+    theta = np.linspace(0.0, np.pi, rings + 1)[1:-1]
+    phi = np.linspace(0.0, 2.0 * np.pi, segments, endpoint=False)
+    t, p = np.meshgrid(theta, phi, indexing='ij')
+    r = radius * (1.0 + 0.15 * np.sin(3.0 * p) * np.sin(2.0 * t) + 0.1 * np.cos(t))
+    ring = np.stack([r * np.sin(t) * np.cos(p), 1.3 * r * np.sin(t) * np.sin(p), 0.8 * r * np.cos(t)], axis=-1)
+    vertices = np.vstack([[[0.0, 0.0, 0.8 * radius * 1.1]], ring.reshape(-1, 3), [[0.0, 0.0, -0.8 * radius * 0.9]]])
+    bottom = len(vertices) - 1
+    triangles = []
+    for j in range(segments):
+        k = (j + 1) % segments
+        triangles.append((0, 1 + j, 1 + k))
+        last = 1 + (rings - 2) * segments
+        triangles.append((bottom, last + k, last + j))
+    for i in range(rings - 2):
+        for j in range(segments):
+            k = (j + 1) % segments
+            a, b = 1 + i * segments + j, 1 + i * segments + k
+            c, d = a + segments, b + segments
+            triangles.extend([(a, c, b), (b, c, d)])
+    return vertices, np.array(triangles, dtype=np.intp)
+
+
+def random_poses(count, rng, angle=0.5, shift=1.0):
+    """count random rigid 4x4 transforms"""
+    poses = mesh_align_core.rotation_about_axis(
+        rng.uniform(-angle, angle, count), rng.normal(size=(count, 3)), rng.normal(size=(count, 3)))
+    poses[:, :3, 3] += rng.uniform(-shift, shift, (count, 3))
+    return poses
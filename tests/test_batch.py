@@ -0,0 +1,54 @@
+import concurrent.futures
+import multiprocessing
+import os
+
+import numpy as np
+
+import mesh_align_batch
+import mesh_align_core
+import mesh_align_spatial
+
+from meshes import lumpy_sphere, random_poses
+
+
+def test_workers_give_the_same_results_as_one_process():
+    vertices, triangles = lumpy_sphere()
+    poses = random_poses(3, np.random.default_rng(0), angle=0.1, shift=0.3)
+    sources = [('scan{}'.format(k), mesh_align_core.transform_points(pose, vertices))
+               for k, pose in enumerate(poses)]
+    sources.append(('empty', np.empty((0, 3))))
+
+    inline = mesh_align_batch.register_batch(sources, (vertices, triangles), tolerance=0.01, workers=1)
+    pooled = mesh_align_batch.register_batch(sources, (vertices, triangles), tolerance=0.01, workers=2)
+
+    assert [r.name for r in inline] == [r.name for r in pooled] == [name for name, _ in sources]
+    for one, many, pose in zip(inline, pooled, poses):
+        assert one.error is None and many.error is None
+        np.testing.assert_allclose(many.matrix, one.matrix, atol=1e-9)
+        # The scans are exact copies, so the fit undoes the pose
+        np.testing.assert_allclose(one.matrix @ pose, np.eye(4), atol=1e-6)
+        assert one.quality['passed'] and many.quality['passed']
+    assert inline[-1].error == pooled[-1].error == 'ValueError: The scan has no vertices'
+
+
+def _thread_settings():
+    return mesh_align_spatial.QUERY_WORKERS, [os.environ.get(name) for name in mesh_align_batch.THREAD_LIMIT_VARIABLES]
+
+
+def test_worker_processes_run_on_one_thread(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', '4')
+    vertices, triangles = lumpy_sphere(rings=6, segments=8)
+    blocks = []
+    try:
+        shared = (mesh_align_batch._share(vertices, blocks), mesh_align_batch._share(triangles, blocks))
+        with mesh_align_batch._single_threaded_workers(), concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('spawn'),
+                initializer=mesh_align_batch._start_worker, initargs=shared) as pool:
+            workers, variables = pool.submit(_thread_settings).result()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    assert workers == 1 and variables == ['1'] * len(variables)
+    # This process keeps its own settings
+    assert mesh_align_spatial.QUERY_WORKERS == -1 and os.environ['OMP_NUM_THREADS'] == '4'
@@ -0,0 +1,36 @@
+import numpy as np
+
+import mesh_align_core
+import mesh_align_plugin
+import mesh_align_quality
+
+from meshes import lumpy_sphere
+
+
+def test_one_plane_pair_and_one_best_fit_link():
+    vertices, triangles = lumpy_sphere()
+    # The fragment is a copy of the reference body, slightly out of place
+    pose = mesh_align_core.rotation_about_axis(0.03, [1.0, 2.0, 0.5], [1.0, 0.0, 0.0])
+    pose[:3, 3] += [0.2, -0.1, 0.15]
+    fragment = mesh_align_core.transform_points(pose, vertices)
+
+    # A plane on the fragment and the same plane on the reference, picked
+    # with another origin and u direction: it pins only 3 of the 6 directions
+    src_plane = mesh_align_core.make_planes([0.0, 0.0, 4.0], [0.0, 0.0, 1.0], [1.0, 0.0, 0.0])
+    tgt_plane = mesh_align_core.make_planes([2.0, -1.0, 4.0], [0.0, 0.0, 1.0],
+                                            mesh_align_core.normalize([1.0, 1.0, 0.0]))
+    src_plane = np.stack([mesh_align_core.transform_points(pose, src_plane[0]),
+                          mesh_align_core.transform_vectors(pose, src_plane[1]),
+                          mesh_align_core.transform_vectors(pose, src_plane[2])])
+
+    result, links, missing = mesh_align_plugin.compute_chain_alignment(
+        2, {(1, 0): ([src_plane], [tgt_plane])}, [(1, 0)],
+        {1: lambda: fragment}, {0: lambda: mesh_align_quality.SurfaceReference(vertices, triangles)},
+        (('test_chain', 'reference'), ('test_chain', 'fragment')), 5.0)
+
+    assert missing == []
+    assert [link['kind'] for link in links] == ['planes', 'best_fit']
+    # The best fit settles what the plane leaves free instead of being
+    # averaged with the plane link's arbitrary slide and turn
+    np.testing.assert_allclose(result.poses[1] @ pose, np.eye(4), atol=1e-4)
+    assert max(link['translation'] for link in links) < 1e-4
@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+
+import mesh_align_core
+from mesh_align_core import NORMAL, ORIGIN, U_DIRECTION
+
+from meshes import random_poses
+
+
+def random_planes(rng, shape):
+    """Planes of the given batch shape with unit normals and in-plane uDirections"""
+    normals = mesh_align_core.normalize(rng.normal(size=shape + (3,)))
+    u_directions = mesh_align_core.normalize(mesh_align_core.cross(normals, rng.normal(size=shape + (3,))))
+    return mesh_align_core.make_planes(rng.uniform(-20.0, 20.0, shape + (3,)), normals, u_directions)
+
+
+def move_planes(matrices, planes):
+    """Planes moved by 4x4 matrices, broadcast against the planes' batch shape"""
+    return mesh_align_core.make_planes(
+        mesh_align_core.transform_points(matrices, planes[..., ORIGIN, :]),
+        mesh_align_core.transform_vectors(matrices, planes[..., NORMAL, :]),
+        mesh_align_core.transform_vectors(matrices, planes[..., U_DIRECTION, :]))
+
+
+def assert_rigid(matrices):
+    rotation = matrices[..., :3, :3]
+    np.testing.assert_allclose(rotation @ np.swapaxes(rotation, -1, -2),
+                               np.broadcast_to(np.eye(3), rotation.shape), atol=1e-9)
+    np.testing.assert_allclose(np.linalg.det(rotation), 1.0, atol=1e-9)
+    np.testing.assert_array_equal(matrices[..., 3, :], np.broadcast_to([0.0, 0.0, 0.0, 1.0], matrices.shape[:-1]))
+
+
+def test_solve_plane_pairs_recovers_known_poses():
+    rng = np.random.default_rng(0)
+    poses = random_poses(8, rng, angle=np.pi, shift=30.0)
+    src = random_planes(rng, (8, 4))
+    matrices, residuals = mesh_align_core.solve_plane_pairs(src, move_planes(poses[:, None], src))
+    np.testing.assert_allclose(matrices, poses, atol=1e-9)
+    assert np.abs(residuals['angle']).max() < 1e-6
+    assert np.abs(residuals['distance']).max() < 1e-9
+
+
+def test_solve_plane_pairs_matches_two_plane_transforms_for_two_pairs():
+    rng = np.random.default_rng(1)
+    poses = random_poses(6, rng, angle=np.pi, shift=30.0)
+    src = random_planes(rng, (6, 2))
+    tgt = move_planes(poses[:, None], src)
+    matrices, _ = mesh_align_core.solve_plane_pairs(src, tgt)
+    # Two planes leave their intersection line free; plane 1's origin pins it
+    np.testing.assert_allclose(matrices, poses, atol=1e-9)
+    np.testing.assert_allclose(
+        matrices, mesh_align_core.two_plane_transforms(src[:, 0], tgt[:, 0], src[:, 1], tgt[:, 1]), atol=1e-9)
+
+
+def test_solve_plane_pairs_ignores_pairs_without_weight():
+    rng = np.random.default_rng(2)
+    pose = random_poses(1, rng, angle=np.pi, shift=30.0)[0]
+    src = random_planes(rng, (4,))
+    tgt = move_planes(pose, src)
+    tgt[3] = random_planes(rng, ())
+    matrix, residuals = mesh_align_core.solve_plane_pairs(src, tgt, weights=[1.0, 1.0, 1.0, 0.0])
+    np.testing.assert_allclose(matrix, pose, atol=1e-9)
+    assert residuals['angle'][3] > 1e-3
+
+
+def test_solve_plane_pairs_with_parallel_planes():
+    # Opposite faces of a slab: the normals agree but nothing fixes the
+    # turn about them or the slide along the faces
+    rng = np.random.default_rng(3)
+    pose = random_poses(1, rng, angle=np.pi, shift=30.0)[0]
+    src = mesh_align_core.make_planes([[0.0, 0.0, 0.0], [1.0, 2.0, 5.0]], [[0.0, 0.0, 1.0], [0.0, 0.0, -1.0]],
+                                      [[1.0, 0.0, 0.0], [1.0, 0.0, 0.0]])
+    tgt = move_planes(pose, src)
+    matrix, residuals = mesh_align_core.solve_plane_pairs(src, tgt)
+    assert_rigid(matrix)
+    assert np.abs(residuals['angle']).max() < 1e-6
+    assert np.abs(residuals['distance']).max() < 1e-9
+    np.testing.assert_allclose(mesh_align_core.transform_points(matrix, src[0, ORIGIN]), tgt[0, ORIGIN], atol=1e-9)
+
+
+def test_solve_plane_pairs_with_nearly_parallel_normals():
+    rng = np.random.default_rng(4)
+    pose = random_poses(1, rng, angle=np.pi, shift=30.0)[0]
+    tilt = 1e-7
+    src = mesh_align_core.make_planes(
+        [[0.0, 0.0, 0.0], [3.0, 1.0, 2.0], [-1.0, 4.0, 0.5]],
+        [[0.0, 0.0, 1.0], [np.sin(tilt), 0.0, np.cos(tilt)], [0.0, np.sin(tilt), np.cos(tilt)]],
+        [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [1.0, 0.0, 0.0]])
+    matrix, residuals = mesh_align_core.solve_plane_pairs(src, move_planes(pose, src))
+    assert np.all(np.isfinite(matrix))
+    assert_rigid(matrix)
+    # The normals still land on their targets; the poorly fixed turn about them may not
+    assert np.abs(residuals['angle']).max() < 1e-6
+    assert np.abs(residuals['distance']).max() < 1e-6
+
+
+def test_solve_plane_pairs_never_mirrors():
+    rng = np.random.default_rng(5)
+    src = random_planes(rng, (5, 3))
+    mirror = np.diag([1.0, 1.0, -1.0, 1.0])
+    matrices, residuals = mesh_align_core.solve_plane_pairs(src, move_planes(mirror, src))
+    assert_rigid(matrices)
+    assert residuals['angle'].max() > 1e-3
+
+
+def test_solve_plane_pairs_needs_two_pairs():
+    with pytest.raises(ValueError):
+        mesh_align_core.solve_plane_pairs(random_planes(np.random.default_rng(6), (1,)),
+                                          random_planes(np.random.default_rng(7), (1,)))
+
+
+def test_flip_turns_the_aligned_plane_over_about_the_hinge():
+    rng = np.random.default_rng(8)
+    src, tgt = random_planes(rng, (5,)), random_planes(rng, (5,))
+    align = mesh_align_core.single_plane_transforms(src, tgt)
+    axes, centers, flips = mesh_align_core.flip_transforms(src, tgt, align, hinge_offset=10.0)
+    assert_rigid(flips)
+    np.testing.assert_allclose(axes, tgt[:, U_DIRECTION], atol=1e-12)
+    np.testing.assert_allclose(centers, tgt[:, ORIGIN] + 10.0 * tgt[:, NORMAL], atol=1e-9)
+
+    moved = move_planes(mesh_align_core.compose_transforms([align, flips]), src)
+    # The origin swings to the far side of the hinge, the plane faces back
+    # and its uDirection (the hinge) is kept
+    np.testing.assert_allclose(moved[:, ORIGIN], tgt[:, ORIGIN] + 20.0 * tgt[:, NORMAL], atol=1e-9)
+    np.testing.assert_allclose(moved[:, NORMAL], -tgt[:, NORMAL], atol=1e-9)
+    np.testing.assert_allclose(moved[:, U_DIRECTION], tgt[:, U_DIRECTION], atol=1e-9)
+
+
+def test_flip_composition():
+    rng = np.random.default_rng(9)
+    src, tgt = random_planes(rng, (5,)), random_planes(rng, (5,))
+    align = mesh_align_core.single_plane_transforms(src, tgt)
+    _, _, flips = mesh_align_core.flip_transforms(src, tgt, align)
+    # Flipping twice undoes the flip
+    np.testing.assert_allclose(flips @ flips, mesh_align_core.identity((5,)), atol=1e-9)
+    # compose_transforms applies first to last
+    composed = mesh_align_core.compose_transforms([align, flips])
+    np.testing.assert_allclose(composed, flips @ align, atol=1e-12)
+    points = rng.normal(size=(5, 3))
+    np.testing.assert_allclose(
+        mesh_align_core.transform_points(composed, points),
+        mesh_align_core.transform_points(flips, mesh_align_core.transform_points(align, points)), atol=1e-9)
+    # A zero hinge turns the plane over in place
+    _, _, in_place = mesh_align_core.flip_transforms(src, tgt, align, hinge_offset=0.0)
+    np.testing.assert_allclose(mesh_align_core.transform_points(in_place @ align, src[:, ORIGIN]),
+                               tgt[:, ORIGIN], atol=1e-9)
+
+
+def test_orientation_turns():
+    rng = np.random.default_rng(10)
+    src, tgt = random_planes(rng, ()), random_planes(rng, ())
+    align = mesh_align_core.single_plane_transforms(src, tgt)
+    turns = mesh_align_core.orientation_turns(src, tgt, align)
+    assert turns.shape == (len(mesh_align_core.ORIENTATIONS), 4, 4)
+    assert_rigid(turns)
+    none, spin, flip_u, flip_v = turns
+    np.testing.assert_allclose(none, np.eye(4), atol=1e-12)
+
+    normal, u_direction = tgt[NORMAL], tgt[U_DIRECTION]
+    expected = {'spin': (normal, -u_direction), 'flip_u': (-normal, u_direction), 'flip_v': (-normal, -u_direction)}
+    for name, turn in zip(mesh_align_core.ORIENTATIONS[1:], turns[1:]):
+        moved = move_planes(turn @ align, src)
+        # Every turn keeps the aligned origin on the target origin
+        np.testing.assert_allclose(moved[ORIGIN], tgt[ORIGIN], atol=1e-9)
+        np.testing.assert_allclose(moved[NORMAL], expected[name][0], atol=1e-9)
+        np.testing.assert_allclose(moved[U_DIRECTION], expected[name][1], atol=1e-9)
+        np.testing.assert_allclose(turn @ turn, np.eye(4), atol=1e-9)
+
+    # Half turns about perpendicular axes through one point compose to the third
+    np.testing.assert_allclose(spin @ flip_u, flip_v, atol=1e-9)
+    np.testing.assert_allclose(flip_u @ flip_v, spin, atol=1e-9)
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import mesh_align_core
+import mesh_align_fit
+
+from meshes import lumpy_sphere, random_poses
+
+
+@pytest.fixture(scope='module')
+def sphere():
+    vertices, triangles = lumpy_sphere()
+    return vertices, mesh_align_fit.vertex_normals(vertices, triangles)
+
+
+def test_icp_recovers_a_small_offset(sphere, kdtree_backend):
+    target, normals = sphere
+    pose = random_poses(1, np.random.default_rng(0), angle=0.05, shift=0.2)[0]
+    source = mesh_align_core.transform_points(np.linalg.inv(pose), target)
+    iterations = []
+    result = mesh_align_fit.icp_point_to_plane(source, target, normals, max_iterations=100,
+                                               callback=lambda i, total, rms: iterations.append(i))
+    assert result.converged
+    np.testing.assert_allclose(result.matrix, pose, atol=1e-6)
+    assert result.rms < 1e-6 and result.inliers == len(source)
+    assert iterations == list(range(1, result.iterations + 1))
+
+
+def test_icp_starts_from_init(sphere, kdtree_backend):
+    target, normals = sphere
+    pose = random_poses(1, np.random.default_rng(1), angle=0.8, shift=2.0)[0]
+    source = mesh_align_core.transform_points(np.linalg.inv(pose), target)
+    # A rough guess close to the pose is refined onto it
+    guess = mesh_align_core.rotation_about_axis(0.03, [0.0, 1.0, 0.0], [0.0, 0.0, 0.0]) @ pose
+    result = mesh_align_fit.icp_point_to_plane(source, target, normals, init=guess, max_iterations=100)
+    np.testing.assert_allclose(result.matrix, pose, atol=1e-6)
+
+
+def test_coarse_register_recovers_large_turns(sphere, kdtree_backend):
+    target, normals = sphere
+    for pose in random_poses(4, np.random.default_rng(2), angle=np.pi, shift=10.0):
+        source = mesh_align_core.transform_points(np.linalg.inv(pose), target)
+        matrix, scores = mesh_align_fit.coarse_register(source, target, sample_count=300)
+        assert scores.shape == (len(mesh_align_fit.AXIS_TURNS),)
+        np.testing.assert_allclose(matrix, pose, atol=1e-6)
+        # and hands ICP a start it keeps
+        result = mesh_align_fit.icp_point_to_plane(source, target, normals, init=matrix)
+        np.testing.assert_allclose(result.matrix, pose, atol=1e-6)
+
+
+def test_coarse_register_of_a_partial_scan(sphere, kdtree_backend):
+    target, normals = sphere
+    pose = random_poses(1, np.random.default_rng(3), angle=np.pi, shift=10.0)[0]
+    rng = np.random.default_rng(4)
+    # A noisy, thinned scan of the same part
+    source = target[rng.random(len(target)) < 0.6]
+    source = source + rng.normal(0.0, 0.01, source.shape)
+    source = mesh_align_core.transform_points(np.linalg.inv(pose), source)
+    matrix, _ = mesh_align_fit.coarse_register(source, target)
+    result = mesh_align_fit.icp_point_to_plane(source, target, normals, init=matrix, max_iterations=100)
+    np.testing.assert_allclose(result.matrix[:3, :3], pose[:3, :3], atol=5e-3)
+    np.testing.assert_allclose(result.matrix[:3, 3], pose[:3, 3], atol=5e-2)
+
+
+def _plane_points(rng, count, noise):
+    normal = mesh_align_core.normalize(rng.normal(size=3))
+    u_direction = mesh_align_core.normalize(np.cross(normal, rng.normal(size=3)))
+    v_direction = np.cross(normal, u_direction)
+    origin = rng.uniform(-5.0, 5.0, 3)
+    # Longer along u, so the in-plane principal axis is u
+    uv = rng.uniform(-1.0, 1.0, (count, 2)) * [4.0, 1.0]
+    points = origin + uv[:, :1] * u_direction + uv[:, 1:] * v_direction + rng.normal(0.0, noise, (count, 1)) * normal
+    return points, origin, normal, u_direction
+
+
+def test_fit_plane_ignores_outliers():
+    rng = np.random.default_rng(5)
+    points, origin, normal, u_direction = _plane_points(rng, 800, 0.002)
+    outliers = origin + rng.uniform(-4.0, 4.0, (200, 3))
+    plane, inliers = mesh_align_fit.fit_plane(np.vstack([points, outliers]))
+    assert abs(plane[mesh_align_core.NORMAL] @ normal) > 1 - 1e-4
+    assert abs(plane[mesh_align_core.U_DIRECTION] @ u_direction) > 1 - 1e-3
+    assert abs((plane[mesh_align_core.ORIGIN] - origin) @ normal) < 2e-3
+    assert inliers[:800].mean() > 0.95 and inliers[800:].mean() < 0.1
+
+
+def test_fit_plane_orientation():
+    rng = np.random.default_rng(6)
+    points, origin, normal, _ = _plane_points(rng, 300, 0.0)
+    # Perfectly flat input still gets a plane through it
+    plane, inliers = mesh_align_fit.fit_plane(points)
+    assert inliers.all()
+    assert abs((points - plane[mesh_align_core.ORIGIN]) @ plane[mesh_align_core.NORMAL]).max() < 1e-9
+    for side in (1.0, -1.0):
+        plane, _ = mesh_align_fit.fit_plane(points, outward_from=origin - side * normal)
+        assert plane[mesh_align_core.NORMAL] @ normal * side > 0.999
+    u_direction = plane[mesh_align_core.U_DIRECTION]
+    assert u_direction[np.argmax(np.abs(u_direction))] > 0
+
+
+def test_fit_plane_needs_three_points():
+    with pytest.raises(ValueError):
+        mesh_align_fit.fit_plane(np.zeros((2, 3)))
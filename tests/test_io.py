@@ -0,0 +1,179 @@
+import json
+
+import numpy as np
+import pytest
+
+import mesh_align_cli
+import mesh_align_core
+import mesh_align_fit
+import mesh_align_io
+
+from meshes import lumpy_sphere, random_poses
+
+
+def write_binary_stl(path, vertices, triangles):
+    records = np.zeros(len(triangles), dtype=mesh_align_io.STL_DTYPE)
+    corners = vertices[triangles]
+    records['vertices'] = corners
+    records['normal'] = mesh_align_core.normalize(
+        np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]))
+    records['attributes'] = np.arange(len(triangles)) % 7
+    with open(path, 'wb') as f:
+        f.write(b'binary test mesh'.ljust(80, b' '))
+        f.write(np.uint32(len(triangles)).tobytes())
+        f.write(records.tobytes())
+
+
+def write_ascii_stl(path, vertices, triangles):
+    corners = vertices[triangles]
+    normals = mesh_align_core.normalize(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]))
+    with open(path, 'w') as f:
+        f.write('solid test\n')
+        for normal, triangle in zip(normals, corners):
+            f.write('  facet normal {:.9g} {:.9g} {:.9g}\n    outer loop\n'.format(*normal))
+            for corner in triangle:
+                f.write('      vertex {:.9g} {:.9g} {:.9g}\n'.format(*corner))
+            f.write('    endloop\n  endfacet\n')
+        f.write('endsolid test\n')
+
+
+def write_obj(path, vertices, triangles, normals):
+    with open(path, 'w') as f:
+        f.write('# test mesh\no sphere\n')
+        f.writelines('v {:.9g} {:.9g} {:.9g}\n'.format(*v) for v in vertices)
+        f.writelines('vn {:.9g} {:.9g} {:.9g}\n'.format(*n) for n in normals)
+        f.writelines('f {0}//{0} {1}//{1} {2}//{2}\n'.format(*(t + 1)) for t in triangles)
+
+
+FORMATS = ('obj', 'stl', 'stl-ascii')
+
+
+@pytest.fixture(scope='module')
+def sphere():
+    vertices, triangles = lumpy_sphere(rings=8, segments=10)
+    return vertices, triangles, mesh_align_fit.vertex_normals(vertices, triangles)
+
+
+def write_mesh(directory, file_format, sphere, name='mesh'):
+    vertices, triangles, normals = sphere
+    path = str(directory / (name + ('.obj' if file_format == 'obj' else '.stl')))
+    if file_format == 'obj':
+        write_obj(path, vertices, triangles, normals)
+    elif file_format == 'stl':
+        write_binary_stl(path, vertices, triangles)
+    else:
+        write_ascii_stl(path, vertices, triangles)
+    return path
+
+
+@pytest.mark.parametrize('file_format', FORMATS)
+def test_read_mesh_round_trip(tmp_path, sphere, file_format):
+    vertices, triangles, _ = sphere
+    path = write_mesh(tmp_path, file_format, sphere)
+    assert mesh_align_io.mesh_format(path) == file_format
+    read_vertices, read_triangles = mesh_align_io.read_mesh(path)
+    # STL corners are merged back into shared vertices
+    assert len(read_vertices) == len(vertices) and len(read_triangles) == len(triangles)
+    np.testing.assert_allclose(read_vertices[read_triangles], vertices[triangles], atol=1e-6)
+
+    np.testing.assert_allclose(mesh_align_io.read_bounds(path),
+                               np.concatenate([vertices.min(axis=0), vertices.max(axis=0)]), atol=1e-6)
+    sample = mesh_align_io.sample_vertices(path, 50)
+    assert sample.shape == (50, 3)
+    assert np.abs(sample[:, None] - vertices[None]).sum(axis=2).min(axis=1).max() < 1e-5
+
+
+@pytest.mark.parametrize('file_format', FORMATS)
+def test_transform_file_round_trip(tmp_path, sphere, file_format):
+    vertices, triangles, normals = sphere
+    path = write_mesh(tmp_path, file_format, sphere)
+    pose = random_poses(1, np.random.default_rng(0), angle=np.pi, shift=20.0)[0]
+    moved_path = path.replace('mesh.', 'moved.')
+    back_path = path.replace('mesh.', 'back.')
+
+    count = mesh_align_io.transform_file(path, moved_path, pose, chunk_size=7)
+    assert count == (len(vertices) if file_format == 'obj' else 3 * len(triangles))
+    moved_vertices, moved_triangles = mesh_align_io.read_mesh(moved_path)
+    np.testing.assert_allclose(moved_vertices[moved_triangles],
+                               mesh_align_core.transform_points(pose, vertices[triangles]), atol=1e-5)
+
+    mesh_align_io.transform_file(moved_path, back_path, np.linalg.inv(pose))
+    back_vertices, back_triangles = mesh_align_io.read_mesh(back_path)
+    np.testing.assert_allclose(back_vertices[back_triangles], vertices[triangles], atol=1e-5)
+
+    if file_format == 'stl':
+        original, moved = mesh_align_io._map_binary_stl(path), mesh_align_io._map_binary_stl(moved_path)
+        # Facet normals turn with the mesh; the header and attributes are kept
+        np.testing.assert_allclose(moved['normal'], mesh_align_core.transform_vectors(pose, original['normal']),
+                                   atol=1e-6)
+        np.testing.assert_array_equal(moved['attributes'], original['attributes'])
+        with open(path, 'rb') as f, open(moved_path, 'rb') as g:
+            assert f.read(mesh_align_io.STL_HEADER_SIZE) == g.read(mesh_align_io.STL_HEADER_SIZE)
+    else:
+        with open(path) as f, open(moved_path) as g:
+            lines, moved_lines = f.readlines(), g.readlines()
+        assert len(lines) == len(moved_lines)
+        coordinates = ('v', 'vn', 'vertex', 'facet')
+        # Lines without coordinates are copied unchanged
+        assert [line for line in lines if line.split()[0] not in coordinates] == \
+               [line for line in moved_lines if line.split()[0] not in coordinates]
+        if file_format == 'obj':
+            moved_normals = np.array([line.split()[1:] for line in moved_lines if line.startswith('vn ')], dtype=float)
+            np.testing.assert_allclose(moved_normals, mesh_align_core.transform_vectors(pose, normals), atol=1e-6)
+
+
+def test_transform_in_place(tmp_path, sphere):
+    vertices, triangles, _ = sphere
+    pose = random_poses(1, np.random.default_rng(1), angle=1.0, shift=5.0)[0]
+    path = write_mesh(tmp_path, 'stl', sphere)
+    mesh_align_io.transform_file(path, path, pose)
+    moved_vertices, moved_triangles = mesh_align_io.read_mesh(path)
+    np.testing.assert_allclose(moved_vertices[moved_triangles],
+                               mesh_align_core.transform_points(pose, vertices[triangles]), atol=1e-5)
+
+    text = write_mesh(tmp_path, 'stl-ascii', sphere, 'text')
+    with pytest.raises(ValueError):
+        mesh_align_io.transform_file(text, text, pose)
+
+
+def test_unsupported_file_type(tmp_path):
+    with pytest.raises(ValueError):
+        mesh_align_io.mesh_format(str(tmp_path / 'mesh.3mf'))
+
+
+def test_cli_best_fit_smoke(tmp_path, capsys):
+    vertices, triangles = lumpy_sphere()
+    reference = str(tmp_path / 'reference.stl')
+    write_binary_stl(reference, vertices, triangles)
+    pose = random_poses(1, np.random.default_rng(2), angle=0.1, shift=0.3)[0]
+    scan = str(tmp_path / 'scan.stl')
+    write_binary_stl(scan, mesh_align_core.transform_points(pose, vertices), triangles)
+    aligned = str(tmp_path / 'aligned.stl')
+
+    status = mesh_align_cli.main([scan, aligned, '--reference', reference, '--tolerance', '0.01', '--json'])
+    info = json.loads(capsys.readouterr().out)
+    assert status == 0
+    assert info['stages'] == ['best_fit'] and info['best_fit']['converged']
+    assert info['quality']['passed'] and info['vertices'] == 3 * len(triangles)
+    np.testing.assert_allclose(np.array(info['matrix']) @ pose, np.eye(4), atol=1e-4)
+    aligned_vertices, aligned_triangles = mesh_align_io.read_mesh(aligned)
+    np.testing.assert_allclose(aligned_vertices[aligned_triangles], vertices[triangles], atol=1e-4)
+
+
+def test_cli_planes_and_matrix_smoke(tmp_path, capsys, sphere):
+    vertices, triangles, _ = sphere
+    path = write_mesh(tmp_path, 'obj', sphere)
+    out = str(tmp_path / 'out.obj')
+    plane = ['0', '0', '0', '0', '0', '1', '1', '0', '0']
+    target = ['0', '0', '5', '0', '0', '1', '1', '0', '0']
+    assert mesh_align_cli.main([path, out, '--src-plane'] + plane + ['--tgt-plane'] + target) == 0
+    assert 'stages: align' in capsys.readouterr().out
+    np.testing.assert_allclose(mesh_align_io.read_mesh(out)[0], vertices + [0.0, 0.0, 5.0], atol=1e-6)
+
+    # Without an output file only the matrix is printed
+    shift = '1 0 0 2  0 1 0 0  0 0 1 0  0 0 0 1'.split()
+    assert mesh_align_cli.main([path, '--matrix'] + shift) == 0
+    assert 'stages: matrix' in capsys.readouterr().out
+
+    with pytest.raises(SystemExit):
+        mesh_align_cli.main([path, out])
@@ -0,0 +1,41 @@
+import threading
+
+import mesh_align_jobs
+
+
+def test_job_records_result_error_and_cancellation():
+    job = mesh_align_jobs.Job().run(lambda job, value: value * 2, 21)
+    assert job.state == mesh_align_jobs.DONE and job.result == 42
+
+    def fail(job):
+        raise RuntimeError('broken')
+    job = mesh_align_jobs.Job().run(fail)
+    assert job.state == mesh_align_jobs.FAILED and 'RuntimeError: broken' in job.error
+
+    def stop(job):
+        job.cancel()
+        job.checkpoint(0.5)
+        return 'unreachable'
+    job = mesh_align_jobs.Job().run(stop)
+    assert job.state == mesh_align_jobs.CANCELLED and job.result is None
+
+
+def test_runner_notifies_and_pops_finished_jobs():
+    events = []
+    finished = threading.Event()
+
+    def notify(job, event):
+        events.append((job.id, event))
+        if event == 'finished':
+            finished.set()
+
+    runner = mesh_align_jobs.JobRunner(notify)
+    try:
+        job = runner.submit('double', lambda job, value: value * 2, 4)
+        assert finished.wait(5.0)
+        assert events[-1] == (job.id, 'finished')
+        assert runner.active() == []
+        assert runner.pop(job.id).result == 8
+        assert runner.pop(job.id) is None
+    finally:
+        runner.shutdown(wait=True)
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+import mesh_align_core
+import mesh_align_posegraph
+
+from meshes import random_poses
+
+
+def _edge(poses, i, j):
+    """The noise-free measurement of edge (i, j): pose_i == pose_j @ matrix"""
+    return i, j, np.linalg.inv(poses[j]) @ poses[i]
+
+
+def test_noise_free_graph_is_solved_exactly():
+    rng = np.random.default_rng(0)
+    poses = np.concatenate([mesh_align_core.identity((1,)), random_poses(5, rng)])
+    pairs = [(1, 0), (2, 1), (3, 2), (4, 3), (5, 4), (5, 0), (3, 1), (4, 0)]
+    edges = [_edge(poses, i, j) for i, j in pairs]
+    # Start away from the answer so the solver has to work
+    init = mesh_align_posegraph.initial_poses(6, edges)
+    init[1:] = random_poses(5, rng, angle=0.2, shift=0.5) @ init[1:]
+
+    result = mesh_align_posegraph.solve_pose_graph(6, edges, init=init)
+
+    assert result.converged
+    np.testing.assert_allclose(result.poses, poses, atol=1e-9)
+    assert result.residuals['translation'].max() < 1e-9
+    assert result.residuals['angle'].max() < 1e-9
+    assert result.cost < 1e-16
+
+
+def test_spanning_tree_start_is_exact_without_noise():
+    rng = np.random.default_rng(1)
+    poses = np.concatenate([mesh_align_core.identity((1,)), random_poses(3, rng)])
+    edges = [_edge(poses, 1, 0), _edge(poses, 2, 1), _edge(poses, 3, 1)]
+    np.testing.assert_allclose(mesh_align_posegraph.initial_poses(4, edges), poses, atol=1e-12)
+
+
+def test_unconnected_node_is_reported():
+    edges = [(1, 0, np.eye(4))]
+    assert mesh_align_posegraph.unconnected_nodes(3, edges) == [2]
+    with pytest.raises(ValueError):
+        mesh_align_posegraph.solve_pose_graph(3, edges)
+
+
+def _moved_planes(pose, planes):
+    planes = np.array(planes, dtype=np.float64)
+    moved = planes.copy()
+    moved[:, mesh_align_core.ORIGIN] = mesh_align_core.transform_points(pose, planes[:, mesh_align_core.ORIGIN])
+    for row in (mesh_align_core.NORMAL, mesh_align_core.U_DIRECTION):
+        moved[:, row] = mesh_align_core.transform_vectors(pose, planes[:, row])
+    return moved
+
+
+@pytest.mark.parametrize('pairs', [1, 2])
+def test_plane_link_leaves_free_directions_to_the_best_fit_link(pairs):
+    rng = np.random.default_rng(2)
+    pose = random_poses(1, rng)[0]
+    src_planes = mesh_align_core.make_planes(
+        rng.normal(size=(pairs, 3)), mesh_align_core.normalize(rng.normal(size=(pairs, 3))),
+        mesh_align_core.normalize(rng.normal(size=(pairs, 3))))
+    src_planes[:, mesh_align_core.U_DIRECTION] = mesh_align_core.normalize(np.cross(
+        src_planes[:, mesh_align_core.NORMAL], rng.normal(size=(pairs, 3))))
+    tgt_planes = _moved_planes(pose, src_planes)
+    # The same target planes with another origin and u direction: the planes
+    # fix only part of the pose, so plane_matrix is off in the free directions
+    slid = tgt_planes.copy()
+    for plane in slid:
+        normal = plane[mesh_align_core.NORMAL]
+        offset = rng.normal(size=3)
+        plane[mesh_align_core.ORIGIN] += offset - (offset @ normal) * normal
+        plane[mesh_align_core.U_DIRECTION] = mesh_align_core.transform_vectors(
+            mesh_align_core.rotation_about_axis(rng.uniform(0.2, 1.0), normal, np.zeros(3)),
+            plane[mesh_align_core.U_DIRECTION])
+    if pairs == 1:
+        plane_matrix, _ = mesh_align_core.plane_alignment(src_planes, slid)
+    else:
+        plane_matrix, _ = mesh_align_core.solve_plane_pairs(src_planes, slid)
+    assert not np.allclose(plane_matrix, pose, atol=1e-3)
+    information = mesh_align_posegraph.plane_information(src_planes)
+    assert np.linalg.matrix_rank(information) == 3 + 2 * (pairs - 1)
+
+    edges = [(1, 0, plane_matrix), (1, 0, pose)]
+    result = mesh_align_posegraph.solve_pose_graph(
+        2, edges, weights=[1.0, 0.3], information=[information, np.eye(6)])
+
+    assert result.converged
+    np.testing.assert_allclose(result.poses[1], pose, atol=1e-8)
+    np.testing.assert_allclose(_moved_planes(result.poses[1], src_planes), tgt_planes, atol=1e-8)
+
+
+def test_three_plane_pairs_constrain_every_direction():
+    planes = mesh_align_core.make_planes(np.zeros((3, 3)), np.eye(3), np.roll(np.eye(3), 1, axis=0))
+    assert np.linalg.matrix_rank(mesh_align_posegraph.plane_information(planes)) == 6
+
+
+def test_plane_link_alone_keeps_the_free_directions():
+    rng = np.random.default_rng(3)
+    pose = random_poses(1, rng)[0]
+    src_planes = mesh_align_core.make_planes([[0.0, 0.0, 1.0]], [[0.0, 0.0, 1.0]], [[1.0, 0.0, 0.0]])
+    edges = [(1, 0, pose)]
+    result = mesh_align_posegraph.solve_pose_graph(
+        2, edges, information=[mesh_align_posegraph.plane_information(src_planes)])
+    assert result.converged
+    np.testing.assert_allclose(result.poses[1], pose, atol=1e-9)
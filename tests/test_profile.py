@@ -0,0 +1,11 @@
+from mesh_align_profile import _percentile
+
+
+def test_percentile_is_nearest_rank():
+    samples = list(range(1, 21))
+    assert _percentile(samples, 95) == 19
+    assert _percentile(samples, 100) == 20
+    assert _percentile(samples, 50) == 10
+    assert _percentile(samples, 0) == 1
+    assert _percentile([7.0], 95) == 7.0
+    assert _percentile([], 95) == 0.0
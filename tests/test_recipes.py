@@ -0,0 +1,21 @@
+import json
+
+import numpy as np
+import pytest
+
+import mesh_align_recipes
+
+
+def test_load_recipes_skips_bad_files_in_a_folder(tmp_path):
+    store = mesh_align_recipes.RecipeStore(str(tmp_path))
+    path = store.save(mesh_align_recipes.make_recipe('good', 'Best Fit', [('best_fit', np.eye(4))]))
+    (tmp_path / 'broken.json').write_text('{"version": ')
+    (tmp_path / 'other.json').write_text(json.dumps(['not', 'a', 'recipe']))
+
+    skipped = []
+    recipes = mesh_align_recipes.load_recipes(str(tmp_path), skipped)
+    assert [r['key'] for r in recipes] == ['good']
+    assert sorted(p for p, _ in skipped) == [str(tmp_path / 'broken.json'), str(tmp_path / 'other.json')]
+    assert mesh_align_recipes.load_recipes(path)[0]['key'] == 'good'
+    with pytest.raises(ValueError):
+        mesh_align_recipes.load_recipes(str(tmp_path / 'other.json'))
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import mesh_align_sampling
+
+from meshes import lumpy_sphere
+
+
+@pytest.mark.parametrize('method', [mesh_align_sampling.VOXEL, mesh_align_sampling.RANDOM])
+def test_downsample_indices_are_sorted_bounded_and_repeatable(method):
+    points = np.random.default_rng(0).normal(size=(5000, 3))
+    indices = mesh_align_sampling.downsample_indices(points, 500, method, seed=3)
+    assert 0 < len(indices) <= 500
+    assert np.all(np.diff(indices) > 0)
+    np.testing.assert_array_equal(indices, mesh_align_sampling.downsample_indices(points, 500, method, seed=3))
+
+
+def test_voxel_indices_keep_one_point_per_voxel():
+    points = np.random.default_rng(1).uniform(0.0, 1.0, (2000, 3))
+    kept = points[mesh_align_sampling.voxel_indices(points, 0.25)]
+    cells = np.floor((kept - points.min(axis=0)) / 0.25).astype(int)
+    assert len(np.unique(cells, axis=0)) == len(kept) == len(np.unique(
+        np.floor((points - points.min(axis=0)) / 0.25).astype(int), axis=0))
+
+
+def test_unknown_method_is_rejected():
+    with pytest.raises(ValueError):
+        mesh_align_sampling.downsample_indices(np.zeros((10, 3)), 5, 'nearest')
+
+
+@pytest.mark.parametrize('count', [50, 200, 1000, 3000])
+def test_cluster_mesh_gives_a_valid_smaller_mesh(count):
+    vertices, triangles = lumpy_sphere(rings=48, segments=64)
+    small_vertices, small_triangles = mesh_align_sampling.cluster_mesh(vertices, triangles, count)
+    assert 0 < len(small_triangles) <= count
+    assert small_triangles.min() == 0 and small_triangles.max() == len(small_vertices) - 1
+    # Every kept vertex is one of the original ones
+    assert len(np.unique(np.vstack([vertices, small_vertices]), axis=0)) == len(vertices)
+    # The sphere stays closed: no triangle was dropped to meet the count, so
+    # every edge is still shared by an even number of triangles
+    edges = np.sort(small_triangles[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    _, uses = np.unique(edges, axis=0, return_counts=True)
+    assert np.all(uses % 2 == 0)
@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+
+import mesh_align_spatial
+from mesh_align_spatial import KDTree, TriangleBVH, closest_points_on_triangles
+
+from meshes import lumpy_sphere
+
+
+@pytest.fixture(scope='module')
+def bvh():
+    return TriangleBVH(*lumpy_sphere())
+
+
+def test_kdtree_matches_brute_force(kdtree_backend):
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(3000, 3)) * [5.0, 2.0, 0.5]
+    # Queries near the cloud, far from it, and on its points
+    queries = np.vstack([rng.normal(size=(300, 3)) * 3.0, rng.uniform(-50.0, 50.0, (50, 3)), points[:20]])
+    sq = ((queries[:, None, :] - points[None, :, :]) ** 2).sum(axis=2)
+    tree = KDTree(points)
+    distances, indices = tree.query(queries)
+    np.testing.assert_allclose(distances, np.sqrt(sq.min(axis=1)), rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(sq[np.arange(len(queries)), indices], sq.min(axis=1), rtol=1e-12, atol=1e-12)
+
+    distances, indices = tree.query(queries, distance_upper_bound=0.2)
+    missed = np.sqrt(sq.min(axis=1)) > 0.2
+    assert np.all(np.isinf(distances[missed])) and np.all(indices[missed] == len(tree))
+    np.testing.assert_allclose(distances[~missed], np.sqrt(sq.min(axis=1))[~missed], rtol=1e-12, atol=1e-12)
+
+    # The thread count does not change the answer
+    one_thread = tree.query(queries, workers=1)
+    np.testing.assert_array_equal(one_thread[1], tree.query(queries)[1])
+
+
+def test_kdtree_handles_duplicate_points(kdtree_backend):
+    points = np.repeat([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]], 50, axis=0)
+    distances, indices = KDTree(points).query([[0.9, 0.0, 0.0], [0.1, 0.0, 0.0]])
+    np.testing.assert_allclose(distances, [0.1, 0.1])
+    assert indices[0] >= 50 and indices[1] < 50
+
+
+def _brute_force_closest(bvh, points):
+    """(squared distances, triangles) of the closest triangle to each point, over all pairs"""
+    a, b, c = bvh.corners(slice(None))
+    count = len(bvh)
+    sq, _ = closest_points_on_triangles(np.repeat(points, count, axis=0),
+                                        np.tile(a, (len(points), 1)), np.tile(b, (len(points), 1)),
+                                        np.tile(c, (len(points), 1)))
+    sq = sq.reshape(len(points), count)
+    return sq, np.argmin(sq, axis=1)
+
+
+def test_closest_points_match_brute_force(bvh):
+    points = np.random.default_rng(1).uniform(-9.0, 9.0, (200, 3))
+    distances, triangles, closest = bvh.closest_points(points)
+    sq, expected = _brute_force_closest(bvh, points)
+    np.testing.assert_allclose(distances, np.sqrt(sq.min(axis=1)), rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(np.linalg.norm(points - closest, axis=1), distances, rtol=1e-9, atol=1e-12)
+    # Ties between triangles sharing the closest edge or corner may pick either
+    np.testing.assert_allclose(sq[np.arange(len(points)), triangles], sq[np.arange(len(points)), expected],
+                               rtol=1e-9, atol=1e-12)
+
+
+def test_closest_points_near_the_surface(bvh, monkeypatch):
+    # Small blocks, so the points are reordered across several of them
+    monkeypatch.setattr(mesh_align_spatial, 'BVH_QUERY_BLOCK', 64)
+    rng = np.random.default_rng(4)
+    points = bvh.vertices[rng.integers(0, len(bvh.vertices), 300)] + rng.normal(0.0, 0.01, (300, 3))
+    distances, triangles, closest = bvh.closest_points(points)
+    sq, _ = _brute_force_closest(bvh, points)
+    np.testing.assert_allclose(distances, np.sqrt(sq.min(axis=1)), rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(sq[np.arange(len(points)), triangles], sq.min(axis=1), rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(np.linalg.norm(points - closest, axis=1), distances, rtol=1e-9, atol=1e-12)
+
+
+def test_within_radius_matches_brute_force(bvh):
+    points = np.random.default_rng(2).uniform(-7.0, 7.0, (100, 3))
+    radius = 1.5
+    found = set(zip(*(array.tolist() for array in bvh.within_radius(points, radius))))
+    sq, _ = _brute_force_closest(bvh, points)
+    # Leave out pairs right at the radius, where rounding decides
+    clear = np.abs(np.sqrt(sq) - radius) > 1e-9
+    expected = set(zip(*np.nonzero((sq <= radius * radius) & clear)))
+    assert expected <= found
+    assert not {pair for pair in found if clear[pair] and pair not in expected}
+
+
+def test_ray_cast_matches_brute_force(bvh):
+    rng = np.random.default_rng(3)
+    origins = rng.uniform(-2.0, 2.0, (100, 3))
+    directions = rng.normal(size=(100, 3))
+    hits, triangles = bvh.ray_cast(origins, directions)
+    # Every ray starts inside the closed mesh, so it hits; check against all triangles
+    assert np.all(triangles >= 0)
+    for origin, direction, t, triangle in zip(origins, directions, hits, triangles):
+        a, b, c = bvh.corners(slice(None))
+        normal = np.cross(b - a, c - a)
+        denominator = normal @ direction
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ts = np.einsum('ij,ij->i', normal, a - origin) / denominator
+        points = origin + ts[:, None] * direction
+        sq, _ = closest_points_on_triangles(points, a, b, c)
+        scale = np.sqrt(np.einsum('ij,ij->i', normal, normal))
+        inside = (ts >= 0.0) & (sq <= (1e-9 * scale) ** 2)
+        assert t == pytest.approx(ts[inside].min(), rel=1e-9)
+        assert ts[triangle] == pytest.approx(t, rel=1e-9)
+
+
+def test_queries_that_miss_the_mesh(bvh):
+    far = np.array([[100.0, 100.0, 100.0], [-100.0, 0.0, 0.0]])
+
+    hits, triangles = bvh.ray_cast(far, [0.0, 0.0, 1.0])
+    assert np.all(np.isinf(hits)) and np.all(triangles == -1)
+    hits, triangles = bvh.ray_cast(far[1:], [1.0, 0.0, 0.0], max_distance=10.0)
+    assert np.isinf(hits[0]) and triangles[0] == -1
+
+    points, triangles = bvh.within_radius(far, 1.0)
+    assert points.dtype == np.intp and triangles.dtype == np.intp
+    assert len(points) == 0 and len(triangles) == 0
+
+    # The closest point always exists; far away it is still the right one
+    distances, triangles, _ = bvh.closest_points(far)
+    sq, _ = _brute_force_closest(bvh, far)
+    np.testing.assert_allclose(distances, np.sqrt(sq.min(axis=1)), rtol=1e-9)
@@ -0,0 +1,79 @@
+import numpy as np
+
+import mesh_align_core
+import mesh_align_fit
+import mesh_align_plugin
+import mesh_align_symmetry
+from mesh_align_spatial import KDTree, TriangleBVH
+
+from meshes import lumpy_sphere, random_poses
+
+
+def box_mesh(size=(4.0, 3.0, 2.0), steps=12):
+    """Closed (vertices, triangles) box centred on the origin, each face a steps x steps grid"""
+    grid = np.linspace(-1.0, 1.0, steps + 1)
+    u, v = [a.ravel() for a in np.meshgrid(grid, grid, indexing='ij')]
+    i, j = [a.ravel() for a in np.meshgrid(np.arange(steps), np.arange(steps), indexing='ij')]
+    a = i * (steps + 1) + j
+    quads = np.stack([a, a + steps + 1, a + steps + 2, a + 1], axis=1)
+    face = np.vstack([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+    vertices, triangles = [], []
+    for axis in range(3):
+        for side in (1.0, -1.0):
+            points = np.empty((len(u), 3))
+            points[:, axis] = side
+            points[:, (axis + 1) % 3], points[:, (axis + 2) % 3] = u, v
+            # Wind every face outward
+            triangles.append((face if side > 0 else face[:, ::-1]) + len(u) * len(vertices))
+            vertices.append(points)
+    return np.vstack(vertices) * np.asarray(size) / 2.0, np.vstack(triangles)
+
+
+def test_detect_symmetry_plane_of_a_mirrored_mesh():
+    vertices, triangles = lumpy_sphere()
+    # The bumps repeat under x -> -x, so the yz plane mirrors the mesh onto itself
+    mirrored = vertices * [-1.0, 1.0, 1.0]
+    assert KDTree(vertices).query(mirrored)[0].max() < 1e-9
+
+    pose = random_poses(1, np.random.default_rng(0), angle=np.pi, shift=5.0)[0]
+    fitted = mesh_align_plugin.detect_symmetry_plane(mesh_align_core.transform_points(pose, vertices), triangles)
+    assert fitted is not None
+    origin, normal = fitted.plane_array[mesh_align_core.ORIGIN], fitted.plane_array[mesh_align_core.NORMAL]
+    expected = mesh_align_core.transform_vectors(pose, [1.0, 0.0, 0.0])
+    assert abs(normal @ expected) > np.cos(np.radians(0.5))
+    assert abs((origin - pose[:3, 3]) @ expected) < 1e-2
+    # Nearly every sampled vertex has its mirror image on the mesh
+    assert fitted.inlier_count > 0.9 * len(vertices)
+
+
+def test_refine_symmetry_plane_from_a_rough_guess():
+    vertices, triangles = lumpy_sphere()
+    normals = mesh_align_fit.vertex_normals(vertices, triangles)
+    guess = mesh_align_core.make_planes([0.1, 0.0, 0.0], mesh_align_core.normalize([1.0, 0.05, -0.05]), [0.0, 1.0, 0.0])
+    plane, score, rms, _ = mesh_align_symmetry.refine_symmetry_plane(vertices, guess, normals)
+    assert abs(plane[mesh_align_core.NORMAL][0]) > 1 - 1e-6
+    assert abs(plane[mesh_align_core.ORIGIN][0]) < 1e-6
+    assert score > 0.9 and rms < 1e-6
+
+
+def test_no_symmetry_plane_without_triangles():
+    assert mesh_align_plugin.detect_symmetry_plane(np.zeros((0, 3)), np.zeros((0, 3), dtype=np.intp)) is None
+
+
+def test_fit_plane_at_point_picks_the_face_under_the_seed():
+    vertices, triangles = box_mesh()
+    pose = random_poses(1, np.random.default_rng(1), angle=np.pi, shift=5.0)[0]
+    index = TriangleBVH(mesh_align_core.transform_points(pose, vertices), triangles)
+    top = mesh_align_core.transform_vectors(pose, [0.0, 0.0, 1.0])
+    top_origin = mesh_align_core.transform_points(pose, [0.0, 0.0, 1.0])
+    # Seeds just above the top face and just inside the box, near a corner;
+    # both snap onto the top face and the region stays on it
+    for seed in ([0.0, 0.0, 1.1], [1.5, 1.0, 0.95]):
+        fitted = mesh_align_plugin.fit_plane_at_point(
+            index, mesh_align_core.transform_points(pose, np.array([seed])), 0.4)
+        assert fitted is not None and fitted.inlier_count >= 3
+        normal = fitted.plane_array[mesh_align_core.NORMAL]
+        # The normal points out of the body
+        assert normal @ top > 1 - 1e-9
+        assert abs((fitted.plane_array[mesh_align_core.ORIGIN] - top_origin) @ top) < 1e-9
+    assert mesh_align_plugin.fit_plane_at_point(None, np.zeros((1, 3)), 0.4) is None